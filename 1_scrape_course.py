@@ -1,52 +1,127 @@
-import requests
+import httpx
+import asyncio
+import hashlib
 import re
 import json
 import os
 
-BASE_URL = "https://tds.s-anand.net/"
-SAVE_DIR = r"C:\Users\user\Documents\TDS_Project1\scrape_course_data" #saved to local
-JSON_FILENAME = "all_course_data.json"
+BASE_URL = os.getenv("COURSE_BASE_URL", "https://tds.s-anand.net/")
+SAVE_DIR = os.getenv("COURSE_OUTPUT_DIR", os.path.dirname(os.path.abspath(__file__)))
+JSON_FILENAME = "3_all_course_data.json"
+# ETag / Last-Modified per file, so unchanged pages cost a 304
+STATE_FILENAME = "3_course_fetch_state.json"
+# Which files changed in the last run, for the embedding and upload steps
+MANIFEST_FILENAME = "3_course_changes.json"
 
-def get_sidebar():
-    r = requests.get(BASE_URL + "_sidebar.md")
-    r.raise_for_status()
+CONCURRENCY = int(os.getenv("COURSE_CONCURRENCY", "8"))
+
+def load_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_json(data, path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+def conditional_headers(entry):
+    headers = {}
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+async def fetch_conditional(client, file, state, previous):
+    """
+    Returns the file's content, using a 304 from the server to reuse the previous copy.
+    Updates state[file] with the new validators; returns None on failure.
+    """
+    entry = state.get(file, {}) if file == "_sidebar.md" or file in previous else {}
+    try:
+        r = await client.get(BASE_URL + file, headers=conditional_headers(entry))
+    except httpx.HTTPError as e:
+        print(f" Failed to fetch {file}: {e}")
+        return None
+
+    if r.status_code == 304:
+        return entry.get("content") if file == "_sidebar.md" else previous.get(file)
+    if r.status_code != 200:
+        print(f" Failed to fetch {file}")
+        return None
+
+    state[file] = {
+        "etag": r.headers.get("ETag"),
+        "last_modified": r.headers.get("Last-Modified"),
+    }
+    if file == "_sidebar.md":
+        state[file]["content"] = r.text
     return r.text
 
 def extract_md_links(sidebar_md):
     # Matches markdown links like: [Title](filename.md)
     return re.findall(r"\]\(([^)]+\.md)\)", sidebar_md)
 
-def fetch_md_content(file):
-    url = BASE_URL + file
-    r = requests.get(url)
-    if r.status_code == 200:
-        return r.text
-    else:
-        print(f" Failed to fetch {file}")
-        return None
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
-def main():
-    sidebar = get_sidebar()
-    md_files = extract_md_links(sidebar)
+async def scrape():
+    os.makedirs(SAVE_DIR, exist_ok=True)
+    json_path = os.path.join(SAVE_DIR, JSON_FILENAME)
+    state_path = os.path.join(SAVE_DIR, STATE_FILENAME)
+
+    previous = load_json(json_path, {})
+    state = load_json(state_path, {})
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def fetch(client, file):
+        async with semaphore:
+            return file, await fetch_conditional(client, file, state, previous)
+
+    limits = httpx.Limits(max_connections=CONCURRENCY, max_keepalive_connections=CONCURRENCY)
+    async with httpx.AsyncClient(timeout=30, limits=limits) as client:
+        sidebar = await fetch_conditional(client, "_sidebar.md", state, previous)
+        if sidebar is None:
+            raise RuntimeError("Could not fetch _sidebar.md")
+        md_files = list(dict.fromkeys(extract_md_links(sidebar)))
+        results = await asyncio.gather(*(fetch(client, md_file) for md_file in md_files))
 
     all_data = {}
-    for md_file in md_files:
-        content = fetch_md_content(md_file)
+    for md_file, content in results:
         if content:
             all_data[md_file] = content
+        elif md_file in previous:
+            all_data[md_file] = previous[md_file]  # Keep the last good copy on a failed fetch
 
-    # Make sure save directory exists
-    os.makedirs(SAVE_DIR, exist_ok=True)
-
-    # Save all content to one JSON file
-    json_path = os.path.join(SAVE_DIR, JSON_FILENAME)
-    with open(json_path, "w", encoding="utf-8") as f:
-        json.dump(all_data, f, ensure_ascii=False, indent=2)
+    manifest = {
+        "added": sorted(f for f in all_data if f not in previous),
+        "changed": sorted(f for f in all_data if f in previous and content_hash(all_data[f]) != content_hash(previous[f])),
+        "removed": sorted(f for f in previous if f not in all_data),
+    }
+    manifest["unchanged"] = len(all_data) - len(manifest["added"]) - len(manifest["changed"])
 
-    print(f" All data saved to {json_path}")
+    if manifest["added"] or manifest["changed"] or manifest["removed"]:
+        # Save all content to one JSON file
+        save_json(all_data, json_path)
+        print(f" All data saved to {json_path}")
+    else:
+        print(f" No changes; {json_path} left as is")
+    save_json(manifest, os.path.join(SAVE_DIR, MANIFEST_FILENAME))
 
-if __name__ == "__main__":
-    main()
+    # Validators last (dropping those of pages that disappeared from the sidebar): if the run dies
+    # before this, the next one refetches instead of getting 304s for pages whose new content was never saved
+    for file in manifest["removed"]:
+        state.pop(file, None)
+    save_json(state, state_path)
 
+    print(f" {len(manifest['added'])} added, {len(manifest['changed'])} changed, "
+          f"{len(manifest['removed'])} removed, {manifest['unchanged']} unchanged")
 
+def main():
+    asyncio.run(scrape())
 
+if __name__ == "__main__":
+    main()
@@ -1,147 +1,295 @@
 import os
 import json
-import requests
+import random
+import asyncio
+import argparse
+import httpx
+
+import embedding_cache
+import embedding_store
+from chunking import CHUNK_WORDS, CHUNK_OVERLAP_WORDS
+from corpus import DOC_READERS, load_json, split_docs
 
 # Get API token from environment
 API_TOKEN = os.getenv("JINA_API_KEY")
 if not API_TOKEN:
     raise ValueError("JINA_API_KEY environment variable is not set")
 
-print(f"DEBUG: Using JINA_API_KEY = {API_TOKEN[:10]}...")  
+print(f"DEBUG: Using JINA_API_KEY = {API_TOKEN[:10]}...")
 
 # Jina embedding endpoint
-API_URL = "https://api.jina.ai/v1/embeddings"
+API_URL = os.getenv("JINA_EMBEDDING_URL", "https://api.jina.ai/v1/embeddings")
+MODEL = "jina-embeddings-v2-base-en"
 
 HEADERS = {
     "Authorization": f"Bearer {API_TOKEN}",
     "Content-Type": "application/json"
 }
 
-# Windows paths via WSL (adjust if using native Windows Python)
-input_path = "/mnt/c/Users/user/Documents/TDS_Project1/all_course_data.json"
-output_path = "/mnt/c/Users/user/Documents/TDS_Project1/embedded_data_768.json"
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-# Optional: Limit text size to avoid token overflow
-MAX_TOKENS = 512
+# Input file -> output store prefix for each corpus (see embedding_store.py for the format)
+CORPORA = {
+    "course": {
+        "input": os.path.join(BASE_DIR, "3_all_course_data.json"),
+        "output": os.path.join(BASE_DIR, "6_embedded_data_768"),
+    },
+    "discourse": {
+        "input": os.path.join(BASE_DIR, "4_discourse_posts_2025.json"),
+        "output": os.path.join(BASE_DIR, "7_embedded_discourse_768"),
+    },
+}
 
-def truncate_text(text, max_tokens=MAX_TOKENS):
-    return " ".join(text.split()[:max_tokens])
+# Jina accepts a list of inputs per request; several requests run at once
+BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))
+CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "6"))
+REQUEST_TIMEOUT = float(os.getenv("EMBED_TIMEOUT", "60"))
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
 
-def load_json(filepath):
-    with open(filepath, "r", encoding="utf-8") as f:
-        return json.load(f)
+# --- Persistent embedding store ---
+# Every embedding is kept in SQLite keyed by (model, sha256 of the normalized input text), so a
+# rerun only calls Jina for text it has never embedded, whatever changed in the corpus. Identical
+# texts within a run are embedded once. Entries no output store references any more are deleted
+# after each run. Keep this file separate from the API's EMBEDDING_CACHE_PATH, or its question
+# embeddings would be garbage-collected too.
+EMBED_STORE_PATH = os.getenv("EMBED_STORE_PATH", os.path.join(BASE_DIR, "jina_embeddings.sqlite"))
 
 def save_json(data, filepath):
     with open(filepath, "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
 
-def get_embedding(input_data, input_type="text"):
-    if input_type == "text":
-        payload = {
-            "model": "jina-embeddings-v2-base-en",
-            "input": input_data
-        }
-    elif input_type == "image":
-        payload = {
-            "model": "jina-clip-v2",
-            "input": {
-                "image_url": input_data
-            }
-        }
-    else:
-        raise ValueError("input_type must be 'text' or 'image'")
+# --- Checkpointing ---
+# Each finished batch is appended to <output prefix>.partial.jsonl as
+# {"key": ..., "text_key": ..., "embedding": [...]}, so a rerun after a crash only embeds what is
+# missing. text_key is the content address of the embedded text: a unit whose text changed since
+# is embedded again.
+
+def checkpoint_path(output_path):
+    return embedding_store.store_prefix(output_path) + ".partial.jsonl"
 
-    response = requests.post(API_URL, headers=HEADERS, json=payload)
+def load_checkpoint(path):
+    """Returns {key: (text_key, embedding)}; text_key is None for records written without one."""
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # Truncated last line from an interrupted write
+            done[record["key"]] = (record.get("text_key"), record["embedding"])
+    return done
 
-    try:
-        response.raise_for_status()
-    except requests.exceptions.HTTPError as e:
-        print(f"HTTP error: {e}")
-        print(f"Response content: {response.text}")
-        raise
+def append_checkpoint(path, keys, text_keys, embeddings):
+    with open(path, "a", encoding="utf-8") as f:
+        for key, text_key, embedding in zip(keys, text_keys, embeddings):
+            f.write(json.dumps({"key": key, "text_key": text_key, "embedding": embedding}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
 
-    response_json = response.json()
-    print("API response:", response_json)  # DEBUG
+# --- Jina API ---
 
-    if "data" not in response_json or not response_json["data"]:
-        raise KeyError(f"No embedding data returned: {response_json}")
+def retry_delay(response, attempt):
+    """Honours Retry-After when present, otherwise exponential backoff with full jitter."""
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+    return random.uniform(0, min(60, 2 ** attempt))
 
-    embedding = response_json["data"][0]["embedding"]
-    print(f"Embedding length: {len(embedding)}")  # Verify dimension
+async def embed_batch(client, texts):
+    """Embeds a list of texts in one request, retrying on rate limits and transient errors."""
+    payload = {
+        "model": MODEL,
+        "input": texts
+    }
+    for attempt in range(MAX_RETRIES + 1):
+        response = None
+        try:
+            response = await client.post(API_URL, headers=HEADERS, json=payload)
+            if response.status_code not in RETRYABLE_STATUS:
+                response.raise_for_status()
+                data = sorted(response.json()["data"], key=lambda item: item["index"])
+                if len(data) != len(texts):
+                    raise KeyError(f"Expected {len(texts)} embeddings, got {len(data)}")
+                return [item["embedding"] for item in data]
+        except httpx.TransportError as e:
+            print(f"WARNING: Request failed ({e}), attempt {attempt + 1}/{MAX_RETRIES + 1}")
+        except httpx.HTTPStatusError as e:
+            print(f"HTTP error: {e}")
+            print(f"Response content: {response.text[:500]}")
+            raise
 
-    return embedding
+        if attempt == MAX_RETRIES:
+            break
+        delay = retry_delay(response, attempt)
+        status = response.status_code if response is not None else "network error"
+        print(f"WARNING: Retrying batch of {len(texts)} in {delay:.1f}s ({status})")
+        await asyncio.sleep(delay)
 
+    raise RuntimeError(f"Giving up on batch of {len(texts)} after {MAX_RETRIES + 1} attempts")
 
-#This is for all_course_data.json
-def main():
+# --- Job ---
+
+def embed_input(unit):
+    return unit.get("embed_text", unit["text"])
+
+def unit_metadata(unit):
+    return {field: unit[field] for field in ("source_name", "chunk_id", "chunk_index", "url", "content", "text", "links") if field in unit}
+
+def save_output(units, done, errors, output_path, output_format, dtype):
+    """Writes a binary store (default) or the legacy indented JSON layout."""
+    if output_format == "json":
+        embedded_data = {}
+        for unit in units:
+            record = {**unit_metadata(unit), "embedding": done.get(unit["key"])}
+            if unit["key"] in errors:
+                record["error"] = errors[unit["key"]]
+            embedded_data[unit["key"]] = record
+        output_path = embedding_store.store_prefix(output_path) + ".json"
+        save_json(embedded_data, output_path)
+        return output_path
+
+    embedded = [unit for unit in units if unit["key"] in done]
+    embedding_store.write_store(output_path, [unit_metadata(unit) for unit in embedded],
+                                [done[unit["key"]] for unit in embedded], dtype=dtype)
+    return embedding_store.store_prefix(output_path) + embedding_store.MATRIX_SUFFIX
+
+async def embed_corpus(corpus, input_path, output_path, batch_size=BATCH_SIZE, concurrency=CONCURRENCY,
+                       output_format="store", dtype="float32", chunk_words=CHUNK_WORDS,
+                       chunk_overlap=CHUNK_OVERLAP_WORDS, chunk=True, store=None):
+    """
+    Embeds one corpus. With `store` (an embedding_cache.SQLiteEmbeddingStore), texts already in it
+    are not sent to Jina; returns the reuse counts.
+    """
     data = load_json(input_path)
-    embedded_data = {}
+    docs = list(DOC_READERS[corpus](data))
+    units = list(split_docs(corpus, docs, chunk_words, chunk_overlap, chunk))
+    if chunk:
+        print(f"Split {len(docs)} {corpus} docs into {len(units)} chunks")
 
-    for filename, content in data.items():
-        if content:
+    done = {}
+    # Content addresses: units with the same normalized text share one embedding
+    text_keys = {unit["key"]: embedding_cache.text_key(MODEL, embed_input(unit)) for unit in units}
+
+    ckpt = checkpoint_path(output_path)
+    checkpointed = load_checkpoint(ckpt)
+    resumed = {key: embedding for key, (text_key, embedding) in checkpointed.items()
+               if key in text_keys and text_key == text_keys[key]}
+    if checkpointed:
+        print(f"Resuming {corpus}: {len(resumed)} embeddings already in {ckpt}"
+              f" ({len(checkpointed) - len(resumed)} stale ones dropped)")
+    done.update(resumed)
+    pending = [unit for unit in units if unit["key"] not in done]
+    stored = store.get_many({text_keys[unit["key"]] for unit in pending}) if store is not None else {}
+    for unit in pending:
+        if text_keys[unit["key"]] in stored:
+            done[unit["key"]] = stored[text_keys[unit["key"]]]
+    reused = sum(1 for unit in pending if unit["key"] in done)
+    if store is not None:
+        print(f"Reusing {reused} embeddings of unchanged {corpus} text from {store.path}")
+
+    by_text = {}
+    for unit in pending:
+        if unit["key"] not in done:
+            by_text.setdefault(text_keys[unit["key"]], []).append(unit)
+    duplicates = sum(len(group) - 1 for group in by_text.values())
+    pending = [group[0] for group in by_text.values()]
+    batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    print(f"Embedding {len(pending)} {corpus} texts in {len(batches)} batches (concurrency {concurrency})")
+
+    errors = {}
+    embedded_texts = set()
+    semaphore = asyncio.Semaphore(concurrency)
+    write_lock = asyncio.Lock()
+
+    async def run_batch(client, batch):
+        groups = [by_text[text_keys[unit["key"]]] for unit in batch]
+        async with semaphore:
             try:
-                truncated_content = truncate_text(content)
-                embedding = get_embedding(truncated_content, input_type="text")
-                embedded_data[filename] = {
-                    "content": content,
-                    "embedding": embedding
-                }
+                embeddings = await embed_batch(client, [embed_input(unit) for unit in batch])
             except Exception as e:
-                print(f"Failed to embed {filename}: {e}")
-                embedded_data[filename] = {
-                    "content": content,
-                    "embedding": None,
-                    "error": str(e)
-                }
-        else:
-            embedded_data[filename] = {
-                "content": content,
-                "embedding": None
-            }
-
-    save_json(embedded_data, output_path)
+                print(f"Failed to embed batch starting at {batch[0]['key']}: {e}")
+                for group in groups:
+                    for unit in group:
+                        errors[unit["key"]] = str(e)
+                return
+        keys = [unit["key"] for group in groups for unit in group]
+        embeddings_per_key = [embedding for group, embedding in zip(groups, embeddings) for _ in group]
+        async with write_lock:
+            append_checkpoint(ckpt, keys, [text_keys[key] for key in keys], embeddings_per_key)
+            fresh = {text_keys[unit["key"]]: embedding for unit, embedding in zip(batch, embeddings)}
+            if store is not None:
+                store.set_many(fresh)
+            embedded_texts.update(fresh)
+            done.update(zip(keys, embeddings_per_key))
+        print(f"Embedded {len(done)}/{len(units)} {corpus} units")
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=REQUEST_TIMEOUT, limits=limits) as client:
+        await asyncio.gather(*(run_batch(client, batch) for batch in batches))
+
+    if store is not None:
+        # Embeddings resumed from a checkpoint seed the store for later runs
+        store.set_many({text_keys[key]: embedding for key, embedding in done.items()
+                        if key in text_keys and text_keys[key] not in stored and text_keys[key] not in embedded_texts})
+        store.set_refs(os.path.basename(embedding_store.store_prefix(output_path)), {text_keys[key] for key in done if key in text_keys})
+
+    output_path = save_output(units, done, errors, output_path, output_format, dtype)
+    if errors:
+        print(f"\n {len(errors)} units failed; rerun to retry them (progress kept in {ckpt})")
+    elif os.path.exists(ckpt):
+        os.remove(ckpt)
     print(f"\n Embedding data saved to {output_path}")
+    return {"units": len(units), "reused": reused, "duplicates": duplicates, "embedded": len(embedded_texts), "failed": len(errors)}
 
-"""
-#This is for discourse_posts_2025.json
 def main():
-    data = load_json(input_path)  # data is a list of threads
-    embedded_data = {}
-
-    for thread in data:
-        thread_title = thread.get("title", "untitled_thread")
-        posts = thread.get("posts", [])
-        
-        for i, post in enumerate(posts):
-            content_html = post.get("content_html", "")
-            print(f"Content causing error: {content_html[:200]}")
-            key = f"{thread_title}_post_{i}"
-            if content_html:
-                try:
-                    truncated_content = truncate_text(content_html)
-                    embedding = get_embedding(truncated_content, input_type="text")
-                    # Create a unique key for storage, e.g., thread_title + post number
-                    key = f"{thread_title}_post_{i}"
-                    embedded_data[key] = {
-                        "content_html": content_html,
-                        "embedding": embedding
-                    }
-                except Exception as e:
-                    print(f"Failed to embed post {i} in thread '{thread_title}': {e}")
-                    embedded_data[key] = {
-                        "content_html": content_html,
-                        "embedding": None,
-                        "error": str(e)
-                    }
-            else:
-                embedded_data[key] = {
-                    "content_html": content_html,
-                    "embedding": None
-                }
-
-    save_json(embedded_data, output_path)
-    print(f"\n Embedding data saved to {output_path}")
-"""
+    parser = argparse.ArgumentParser(description="Embed course and/or Discourse content with Jina.")
+    parser.add_argument("corpus", nargs="?", default="all", choices=["all", *CORPORA])
+    parser.add_argument("--input", help="Input JSON (single corpus only)")
+    parser.add_argument("--output", help="Output store prefix (single corpus only)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--format", choices=["store", "json"], default="store",
+                        help="store: .npy matrix + .meta.jsonl (default); json: legacy indented JSON")
+    parser.add_argument("--float16", action="store_true", help="Store vectors as float16")
+    parser.add_argument("--chunk-words", type=int, default=CHUNK_WORDS, help="Max words per chunk")
+    parser.add_argument("--chunk-overlap", type=int, default=CHUNK_OVERLAP_WORDS, help="Words shared by neighbouring chunks")
+    parser.add_argument("--no-chunk", action="store_true", help="Embed whole documents (first 512 words) instead of chunks")
+    parser.add_argument("--store", default=EMBED_STORE_PATH, help="SQLite store of embeddings reused across runs (EMBED_STORE_PATH)")
+    parser.add_argument("--no-store", action="store_true", help="Embed everything again and leave the store untouched")
+    parser.add_argument("--no-gc", action="store_true", help="Keep store entries no output references any more")
+    args = parser.parse_args()
+
+    corpora = list(CORPORA) if args.corpus == "all" else [args.corpus]
+    if (args.input or args.output) and len(corpora) > 1:
+        parser.error("--input/--output require a single corpus")
+
+    store = None if args.no_store else embedding_cache.SQLiteEmbeddingStore(args.store)
+    totals = {"units": 0, "reused": 0, "duplicates": 0, "embedded": 0, "failed": 0}
+    for corpus in corpora:
+        input_path = args.input or CORPORA[corpus]["input"]
+        output_path = args.output or CORPORA[corpus]["output"]
+        counts = asyncio.run(embed_corpus(corpus, input_path, output_path, args.batch_size, args.concurrency,
+                                          args.format, "float16" if args.float16 else "float32",
+                                          args.chunk_words, args.chunk_overlap, not args.no_chunk, store))
+        for name, count in counts.items():
+            totals[name] += count
+
+    if store is not None:
+        deleted = 0 if args.no_gc else store.collect_garbage(f"{MODEL}:")
+        stats = store.stats()
+        store.close()
+        reuse_rate = totals["reused"] / totals["units"] if totals["units"] else 0.0
+        print(f"\n Store {args.store}: reused {totals['reused']}/{totals['units']} units ({reuse_rate:.1%}), "
+              f"embedded {totals['embedded']} new texts ({totals['duplicates']} duplicate units shared them), "
+              f"{totals['failed']} failed; {stats['entries']} entries ({stats['vector_bytes'] / 1e6:.1f} MB), "
+              f"{deleted} unreferenced entries removed")
 
 if __name__ == "__main__":
     main()
@@ -1,46 +1,147 @@
-from supabase import create_client, Client
+from supabase import create_client
+from postgrest import SyncPostgrestClient, ReturnMethod
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
+import hashlib
 import json
 import os
 
-url = "https://cbhembzupxtksglokupq.supabase.co"
-key = ""  #key to be added
-supabase: Client = create_client(url, key)
+import numpy as np
 
-base_path = "/mnt/c/Users/user/Documents/TDS_Project1"
+import embedding_store
 
-# Upload discourse_768 data
-with open(os.path.join(base_path, "embedded_discourse_768.json"), "r") as f:
-    discourse_data = json.load(f)
+# Both tables need a content_hash column so unchanged rows can be skipped:
+#   alter table discourse_768 add column if not exists content_hash text;
+#   alter table courseinfo_768 add column if not exists content_hash text;
+# Chunked embeddings (the default in 5_embedding_768.py) store several rows per source_name,
+# keyed by chunk_id and carrying the parent page url:
+#   alter table <table> add column if not exists chunk_id text unique;
+#   alter table <table> add column if not exists url text;
+#   alter table <table> drop constraint if exists <table>_source_name_key;
+# Plain text and links extracted at ingest time, so the API does not parse HTML per request
+# (match_all_vectors must return both columns too):
+#   alter table <table> add column if not exists text text;
+#   alter table <table> add column if not exists links jsonb;
 
-for filename, item in discourse_data.items():
-    record = {
-        "source_name": filename,
-        "content": item["content_html"],
-        "embedding": item["embedding"],
-    }
-    try:
-        response = supabase.table("discourse_768").upsert(record, on_conflict="source_name").execute()
-        print(f"[discourse_768] Inserted/Updated {filename}")
-    except Exception as e:
-        print(f"[discourse_768] Error inserting {filename}: {e}")
-
-# Upload courseinfo_768 data
-with open(os.path.join(base_path, "embedded_data_768.json"), "r") as f:
-    course_data = json.load(f)
-
-for filename, item in course_data.items():
-    record = {
-        "source_name": filename,
-        "content": item["content"],
-        "embedding": item["embedding"],
-    }
+url = os.getenv("SUPABASE_URL", "https://cbhembzupxtksglokupq.supabase.co")
+key = os.getenv("SUPABASE_KEY", "")  #key to be added
+# Point at a plain PostgREST server (e.g. http://localhost:3000 over a local Postgres) for testing
+postgrest_url = os.getenv("POSTGREST_URL")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+base_path = os.getenv("EMBEDDINGS_DIR", BASE_DIR)
+
+# Table -> embedding store prefix written by 5_embedding_768.py (legacy <prefix>.json also works)
+UPLOADS = {
+    "discourse_768": "7_embedded_discourse_768",
+    "courseinfo_768": "6_embedded_data_768",
+}
+
+BATCH_SIZE = int(os.getenv("UPLOAD_BATCH_SIZE", "200"))
+CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "4"))
+PAGE_SIZE = 1000
+
+def create_db_client():
+    if postgrest_url:
+        db = SyncPostgrestClient(postgrest_url)
+        if key:
+            db.auth(key)
+        return db
+    return create_client(url, key).postgrest
+
+def content_hash(content, embedding, extra=None):
+    """
+    Changes whenever the text or its vector changes (e.g. after switching embedding models),
+    or any of the derived fields in `extra`.
+    """
+    digest = hashlib.sha256(content.encode("utf-8"))
+    digest.update(np.asarray(embedding, dtype=np.float32).tobytes())
+    if extra:
+        digest.update(json.dumps(extra, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+def fetch_existing_hashes(db, table, key_column):
+    """
+    Returns {key: content_hash} for rows already in the table, paging through PostgREST.
+    Pages are ordered by the key; without an ORDER BY, Postgres may return overlapping pages.
+    """
+    hashes = {}
+    start = 0
+    while True:
+        rows = db.table(table).select(f"{key_column},content_hash").order(key_column).range(start, start + PAGE_SIZE - 1).execute().data
+        for row in rows:
+            hashes[row[key_column]] = row.get("content_hash")
+        if len(rows) < PAGE_SIZE:
+            return hashes
+        start += PAGE_SIZE
+
+def upsert_batch(db, table, records, key_column):
+    db.table(table).upsert(records, on_conflict=key_column, returning=ReturnMethod.minimal).execute()
+    return len(records)
+
+def upload_table(db, table, prefix, batch_size=BATCH_SIZE, concurrency=CONCURRENCY, force=False, dry_run=False):
+    path = os.path.join(base_path, prefix)
     try:
-        response = supabase.table("courseinfo_768").upsert(record, on_conflict="source_name").execute()
-        print(f"[courseinfo_768] Inserted/Updated {filename}")
-    except Exception as e:
-        print(f"[courseinfo_768] Error inserting {filename}: {e}")
+        records = []
+        for item in embedding_store.iter_records(path):
+            derived = {field: item[field] for field in ("text", "links") if item.get(field) is not None}
+            record = {
+                "source_name": item["source_name"],
+                "content": item["content"],
+                "embedding": item["embedding"],
+                "content_hash": content_hash(item["content"], item["embedding"], derived),
+                **derived,
+            }
+            for field in ("chunk_id", "url"):
+                if item.get(field):
+                    record[field] = item[field]
+            records.append(record)
+    except FileNotFoundError:
+        print(f"[{table}] No embeddings found at {path}, skipping")
+        return {"sent": 0, "skipped": 0, "failed": 0}
+
+    key_column = "chunk_id" if records and "chunk_id" in records[0] else "source_name"
+    existing = {} if force else fetch_existing_hashes(db, table, key_column)
+    changed = [r for r in records if existing.get(r[key_column]) != r["content_hash"]]
+    summary = {"sent": 0, "skipped": len(records) - len(changed), "failed": 0}
+    print(f"[{table}] {len(changed)} new or changed rows, {summary['skipped']} unchanged")
+    if dry_run or not changed:
+        return summary
+
+    batches = [changed[i:i + batch_size] for i in range(0, len(changed), batch_size)]
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {pool.submit(upsert_batch, db, table, batch, key_column): batch for batch in batches}
+        for future in as_completed(futures):
+            batch = futures[future]
+            try:
+                summary["sent"] += future.result()
+                print(f"[{table}] Inserted/Updated {len(batch)} rows ({summary['sent']}/{len(changed)})")
+            except Exception as e:
+                summary["failed"] += len(batch)
+                print(f"[{table}] Error upserting batch starting at {batch[0][key_column]}: {e}")
+    return summary
 
-print(" All uploads completed.")
+def main():
+    parser = argparse.ArgumentParser(description="Upload embeddings to Supabase, sending only new or changed rows.")
+    parser.add_argument("tables", nargs="*", help=f"Tables to upload: {', '.join(UPLOADS)} (default: all)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--force", action="store_true", help="Upload every row, ignoring stored content hashes")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be sent")
+    args = parser.parse_args()
+    unknown = [table for table in args.tables if table not in UPLOADS]
+    if unknown:
+        parser.error(f"unknown table(s): {', '.join(unknown)}")
 
+    db = create_db_client()
+    totals = {"sent": 0, "skipped": 0, "failed": 0}
+    for table in args.tables or list(UPLOADS):
+        summary = upload_table(db, table, UPLOADS[table], args.batch_size, args.concurrency, args.force, args.dry_run)
+        print(f"[{table}] sent={summary['sent']} skipped={summary['skipped']} failed={summary['failed']}")
+        for field in totals:
+            totals[field] += summary[field]
 
+    print(f" All uploads completed: sent={totals['sent']} skipped={totals['skipped']} failed={totals['failed']}")
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+def answer_context(url: Optional[str], image: Optional[str]) -> str:
+    """Inputs besides the question that must match exactly for a cached answer to be reused."""
+    image_hash = hashlib.sha256(image.encode("utf-8")).hexdigest() if image else ""
+    return f"{url or ''}|{image_hash}"
+
+
+class CachedAnswer:
+    __slots__ = ("vector", "context", "response", "cost_seconds", "stored_at")
+
+    def __init__(self, vector: np.ndarray, context: str, response: Dict, cost_seconds: float, stored_at: float):
+        self.vector = vector
+        self.context = context
+        self.response = response
+        self.cost_seconds = cost_seconds
+        self.stored_at = stored_at
+
+
+class AnswerCache:
+    """
+    Semantic cache of final answers. A question is served from the cache when a previously
+    answered question with the same url/image inputs has a question embedding within
+    `threshold` cosine similarity. Bounded by entry count (LRU) and TTL, and cleared
+    whenever the corpus version changes.
+    """
+
+    def __init__(self, max_entries: int = 512, ttl_seconds: float = 24 * 3600, threshold: float = 0.95):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.threshold = threshold
+        self.corpus_version: Optional[str] = None
+        self._entries: "OrderedDict[int, CachedAnswer]" = OrderedDict()
+        # Per-context stacked vectors, rebuilt lazily after the context's entries change
+        self._matrices: Dict[str, tuple] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.seconds_saved = 0.0
+
+    def check_corpus(self, version: str) -> None:
+        """Drops every entry when the corpus answers were built from has been re-ingested."""
+        with self._lock:
+            if self.corpus_version is not None and version != self.corpus_version:
+                self._entries.clear()
+                self._matrices.clear()
+                self.invalidations += 1
+            self.corpus_version = version
+
+    def lookup(self, embedding: List[float], context: str, elapsed: float = 0.0,
+               threshold: Optional[float] = None) -> Optional[Dict]:
+        """
+        Returns a copy of the stored response for the closest matching question, or None.
+        `elapsed` is the time already spent on this request, subtracted from the latency saved.
+        `threshold` overrides the configured similarity threshold, e.g. to accept a looser
+        match when no fresh answer can be generated.
+        """
+        if self.max_entries <= 0:
+            return None
+        query = self._normalize(embedding)
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            ids, matrix = self._matrix_for(context)
+            if not ids or query is None or matrix.shape[1] != query.shape[0]:
+                self.misses += 1
+                return None
+            similarities = matrix @ query
+            best = int(np.argmax(similarities))
+            if similarities[best] < (self.threshold if threshold is None else threshold):
+                self.misses += 1
+                return None
+            entry = self._entries[ids[best]]
+            self._entries.move_to_end(ids[best])
+            self.hits += 1
+            self.seconds_saved += max(0.0, entry.cost_seconds - elapsed)
+            return {"answer": entry.response["answer"], "links": [dict(link) for link in entry.response["links"]]}
+
+    def put(self, embedding: List[float], context: str, response: Dict, cost_seconds: float) -> None:
+        if self.max_entries <= 0:
+            return
+        vector = self._normalize(embedding)
+        if vector is None:
+            return
+        entry = CachedAnswer(vector, context, response, cost_seconds, time.time())
+        with self._lock:
+            self._entries[self._next_id] = entry
+            self._next_id += 1
+            self._matrices.pop(context, None)
+            while len(self._entries) > self.max_entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._matrices.pop(evicted.context, None)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "seconds_saved": round(self.seconds_saved, 3),
+            }
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> Optional[np.ndarray]:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if vector.ndim != 1 or norm == 0:
+            return None
+        return vector / norm
+
+    def _expire(self, now: float) -> None:
+        # Entries are in LRU order, not insertion order, so scan them all; the cache is small
+        expired = [key for key, entry in self._entries.items() if now - entry.stored_at > self.ttl_seconds]
+        for key in expired:
+            self._matrices.pop(self._entries.pop(key).context, None)
+
+    def _matrix_for(self, context: str) -> tuple:
+        if context not in self._matrices:
+            ids = [key for key, entry in self._entries.items() if entry.context == context]
+            matrix = np.stack([self._entries[key].vector for key in ids]) if ids else np.empty((0, 0), dtype=np.float32)
+            self._matrices[context] = (ids, matrix)
+        return self._matrices[context]
@@ -0,0 +1,119 @@
+"""
+Recall and latency of the IVF index (ANN_INDEX_PATH) against exact search, i.e. what the
+numpy backend and the match_all_vectors RPC return today.
+
+Queries are stored vectors with a little noise added (stand-ins for paraphrased questions).
+`--synthetic N` grows the corpus to N rows of vectors clustered around the stored ones, to see how
+the index behaves at the sizes a multi-term corpus reaches. The index is built on the first
+`--prebuilt` fraction of the rows and the rest are added with incremental inserts, as happens
+when new posts are embedded after the offline build.
+
+    python bench/ann_benchmark.py
+    python bench/ann_benchmark.py --synthetic 200000 --nprobe 4,8,16,32 --k 2,10
+"""
+import argparse
+import os
+import sys
+import time
+from typing import List, Sequence
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+import embedding_store  # noqa: E402
+from ann_index import IVFIndex, load_corpus_rows  # noqa: E402
+from vector_index import VectorIndex  # noqa: E402
+
+
+def int_list(text: str) -> List[int]:
+    return [int(part) for part in text.split(",") if part]
+
+
+def grow(vectors: np.ndarray, n_rows: int, noise: float, rng: np.random.Generator) -> np.ndarray:
+    """
+    The stored vectors followed by synthetic ones, `n_rows` in total: topics are noisy copies of
+    stored vectors and each synthetic row is a topic with half as much noise again, so the corpus
+    keeps many small neighbourhoods like a real one instead of a few huge blobs of near-duplicates.
+    """
+    extra = n_rows - len(vectors)
+    if extra <= 0:
+        return vectors
+    topics = vectors[rng.integers(0, len(vectors), max(1, extra // 20))]
+    topics = embedding_store.normalize_rows(topics + rng.standard_normal(topics.shape).astype(np.float32) * noise)
+    rows = topics[rng.integers(0, len(topics), extra)]
+    rows = rows + rng.standard_normal(rows.shape).astype(np.float32) * noise / 2
+    return np.concatenate([vectors, embedding_store.normalize_rows(rows)])
+
+
+def timed_search(index: VectorIndex, queries: np.ndarray, k: int, threshold: float):
+    results = []
+    started = time.perf_counter()
+    for query in queries:
+        results.append([r["row"] for r in index.search(query, threshold, k)])
+    return results, (time.perf_counter() - started) / len(queries)
+
+
+def recall(expected: Sequence[List[int]], found: Sequence[List[int]]) -> float:
+    total = sum(len(e) for e in expected)
+    hits = sum(len(set(e) & set(f)) for e, f in zip(expected, found))
+    return hits / total if total else 1.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare IVF recall@k and latency with exact vector search.")
+    parser.add_argument("--files", default=os.getenv("VECTOR_INDEX_FILES", "6_embedded_data_768,7_embedded_discourse_768"))
+    parser.add_argument("--synthetic", type=int, default=0, help="Grow the corpus to this many rows")
+    parser.add_argument("--noise", type=float, default=0.02, help="Per-dimension noise of synthetic topics (rows and queries get half)")
+    parser.add_argument("--lists", type=int, default=None, help="IVF lists (default ~4*sqrt(rows))")
+    parser.add_argument("--nprobe", type=int_list, default=int_list("1,4,8,16,32"))
+    parser.add_argument("--k", type=int_list, default=int_list("2,10"), help="match_count values to measure")
+    parser.add_argument("--threshold", type=float, default=-1.0,
+                        help="match_threshold; the default keeps every result so recall@k is exact")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--prebuilt", type=float, default=0.9, help="Fraction of rows in the offline build")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    paths = [os.path.join(BASE_DIR, p.strip()) for p in args.files.split(",") if p.strip()]
+    paths = [p for p in paths if embedding_store.store_exists(p) or os.path.exists(embedding_store.store_prefix(p) + ".json")]
+    if not paths:
+        parser.error(f"none of {args.files} exist under {BASE_DIR}")
+    rng = np.random.default_rng(args.seed)
+    vectors, _ = load_corpus_rows(paths)
+    vectors = grow(vectors, args.synthetic, args.noise, rng)
+    n_rows = len(vectors)
+    keys = [str(i) for i in range(n_rows)]
+    metadata = [{"source_name": key, "row": i} for i, key in enumerate(keys)]
+
+    queries = vectors[rng.integers(0, n_rows, args.queries)]
+    queries = queries + rng.standard_normal(queries.shape).astype(np.float32) * args.noise / 2
+
+    prebuilt = max(1, int(n_rows * args.prebuilt))
+    started = time.perf_counter()
+    ann = IVFIndex.build(vectors[:prebuilt], keys[:prebuilt], args.lists, seed=args.seed)
+    build_seconds = time.perf_counter() - started
+    exact = VectorIndex(vectors, metadata)
+    approximate = VectorIndex(vectors, metadata)
+    started = time.perf_counter()
+    inserted = approximate.attach_ann(ann, args.nprobe[0])
+    insert_seconds = time.perf_counter() - started
+    sizes = np.diff(ann.offsets)
+
+    print(f" {n_rows} rows x {vectors.shape[1]} dims, {len(queries)} queries, threshold {args.threshold}")
+    print(f" IVF: {ann.n_lists} lists (mean {sizes.mean():.0f}, max {sizes.max()} rows), built on {prebuilt} rows in "
+          f"{build_seconds:.1f}s, {inserted} rows inserted incrementally in {insert_seconds * 1e3:.0f} ms\n")
+    print(f" {'k':>4} {'search':>12} {'recall@k':>9} {'ms/query':>9} {'speed-up':>9}")
+    for k in args.k:
+        expected, exact_seconds = timed_search(exact, queries, k, args.threshold)
+        print(f" {k:>4} {'exact':>12} {1.0:>9.4f} {exact_seconds * 1e3:>9.3f} {1.0:>8.1f}x")
+        for nprobe in args.nprobe:
+            approximate.nprobe = nprobe
+            found, seconds = timed_search(approximate, queries, k, args.threshold)
+            print(f" {k:>4} {'nprobe=' + str(nprobe):>12} {recall(expected, found):>9.4f} {seconds * 1e3:>9.3f} "
+                  f"{exact_seconds / seconds:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Compares answering a set of questions one /api/ request each with a single /api/batch request,
+against the local stubs (bench/stubs.py).
+
+Both runs use distinct questions with the caches sized to zero, and the same number of LLM calls
+in flight (--concurrency clients vs BATCH_CONCURRENCY), so the difference is the embedding and
+vector search work the batch shares. Reports wall time and the upstream calls each run made.
+
+    python bench/batch_test.py
+    python bench/batch_test.py --questions 300 --concurrency 8 --backend supabase
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from typing import Dict, List, Tuple
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import stubs  # noqa: E402
+from load_test import QUESTIONS, free_port, start_api, start_stubs, wait_until_ready  # noqa: E402
+
+UPSTREAMS = ("jina", "supabase", "llm")
+
+
+def build_questions(n: int, rng: random.Random) -> List[Dict]:
+    return [{"question": f"{rng.choice(QUESTIONS)} #{rng.getrandbits(32):08x}"} for _ in range(n)]
+
+
+async def one_by_one(client: httpx.AsyncClient, bodies: List[Dict], concurrency: int) -> Tuple[int, int]:
+    """(answered, failed) sending each question to /api/ from `concurrency` clients."""
+    queue: "asyncio.Queue[Dict]" = asyncio.Queue()
+    for body in bodies:
+        queue.put_nowait(body)
+    outcomes = []
+
+    async def worker():
+        while not queue.empty():
+            body = queue.get_nowait()
+            try:
+                outcomes.append((await client.post("/api/", json=body)).status_code == 200)
+            except httpx.HTTPError:
+                outcomes.append(False)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return sum(outcomes), len(outcomes) - sum(outcomes)
+
+
+async def batched(client: httpx.AsyncClient, bodies: List[Dict]) -> Tuple[int, int]:
+    """(answered, failed) from one /api/batch stream."""
+    answered = failed = 0
+    event = None
+    async with client.stream("POST", "/api/batch", json=bodies) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if line.startswith("event:"):
+                event = line[len("event:"):].strip()
+            elif line.startswith("data:") and event in ("result", "error"):
+                answered += event == "result"
+                failed += event == "error"
+    return answered, failed
+
+
+async def run(api_url: str, stub_url: str, args: argparse.Namespace) -> None:
+    rng = random.Random(args.seed)
+    async with httpx.AsyncClient(base_url=api_url, timeout=600) as client, \
+            httpx.AsyncClient(base_url=stub_url, timeout=10) as stub_client:
+        print(f" {'run':<10} {'answered':>9} {'failed':>7} {'seconds':>8}" + "".join(f"{name + ' calls':>15}" for name in UPSTREAMS))
+        for name in ("one_by_one", "batch"):
+            bodies = build_questions(args.questions, rng)
+            before = (await stub_client.get("/stats")).json()
+            started = time.perf_counter()
+            if name == "batch":
+                answered, failed = await batched(client, bodies)
+            else:
+                answered, failed = await one_by_one(client, bodies, args.concurrency)
+            seconds = time.perf_counter() - started
+            after = (await stub_client.get("/stats")).json()
+            calls = "".join(f"{after[u] - before[u]:>15}" for u in UPSTREAMS)
+            print(f" {name:<10} {answered:>9} {failed:>7} {seconds:>8.2f}{calls}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-question /api/ requests with one /api/batch request.")
+    parser.add_argument("--questions", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=4, help="/api/ clients, and BATCH_CONCURRENCY of the API")
+    parser.add_argument("--backend", choices=("numpy", "supabase"), default="numpy", help="RETRIEVAL_BACKEND of the API")
+    parser.add_argument("--seed", type=int, default=1)
+    stubs.add_latency_arguments(parser)
+    parser.set_defaults(jina_latency=0.1, llm_latency=0.3, supabase_latency=0.05)
+    args = parser.parse_args()
+
+    stub_port = free_port()
+    stub_url = f"http://127.0.0.1:{stub_port}"
+    stubs_server = start_stubs(stub_port, stubs.latency_from_args(args), args.jitter)
+    api_port = free_port()
+    api_url = f"http://127.0.0.1:{api_port}"
+    env = {"BATCH_CONCURRENCY": str(args.concurrency)}
+    if args.backend == "numpy":
+        # The stub embeddings are nowhere near the stored vectors; match anything so questions reach the LLM
+        env["MATCH_THRESHOLD"] = "-1"
+    api = start_api(api_port, stub_url, 1, False, args.backend, env)
+    try:
+        wait_until_ready(api_url)
+        print(f" {args.questions} questions against {api_url} ({args.backend} backend, upstream latency "
+              f"{json.dumps(stubs.latency_from_args(args))})")
+        asyncio.run(run(api_url, stub_url, args))
+    finally:
+        api.terminate()
+        api.wait(timeout=10)
+        stubs_server.should_exit = True
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+Fault-injection run for the upstream resilience layer (resilience.py), against the local stubs.
+
+Starts the stubs and `uvicorn main:app` like load_test.py, then goes through phases that change
+the stubs' faults at runtime (POST /faults) and reports, per phase, how the answers and latencies
+held up and what the layer did (retries, hedges, timeouts, calls rejected by an open circuit):
+
+  baseline      no faults; fills the latency windows the adaptive timeouts and hedging use
+  slow_tail     10% of Jina calls take --slow-latency seconds
+  flaky_llm     30% of LLM calls fail with 503
+  image_outage  every image embedding fails; the circuit opens and images fall back to text-only
+  llm_outage    every LLM call fails; the circuit opens, and questions close to answered ones get
+                the cached answer instead of an error
+  recovery      faults cleared; after CIRCUIT_OPEN_SECONDS a probe closes the circuits again
+
+    python bench/fault_test.py
+    python bench/fault_test.py --requests 100 --concurrency 8 --slow-latency 2
+"""
+import argparse
+import asyncio
+import os
+import random
+import re
+import sys
+import time
+from typing import Dict, List, Tuple
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import stubs  # noqa: E402
+from load_test import QUESTIONS, TINY_IMAGE, free_port, percentile, start_api, start_stubs, wait_until_ready  # noqa: E402
+
+LLM_ERROR_ANSWER = "Sorry, I couldn't process the answer at this moment due to an internal error."
+FALLBACK_RE = re.compile(r'^tds_fallbacks_total\{kind="([^"]+)"\} ([0-9.e+]+)$', re.MULTILINE)
+COUNTERS = ("calls", "retries", "timeouts", "hedges", "hedge_wins", "short_circuits")
+
+
+def phases(slow_latency: float) -> List[Tuple[str, Dict, Dict[str, float], bool]]:
+    """(name, faults to set, request mix, paraphrase earlier questions)"""
+    return [
+        ("baseline", {}, {"text": 3, "image": 1}, False),
+        ("slow_tail", {"jina": {"slow_rate": 0.1, "slow_latency": slow_latency}}, {"text": 3, "image": 1}, False),
+        ("flaky_llm", {"jina": {}, "llm": {"error_rate": 0.3, "status": 503}}, {"text": 1}, False),
+        ("image_outage", {"llm": {}, "jina_image": {"error_rate": 1.0, "status": 503}}, {"image": 1}, False),
+        ("llm_outage", {"jina_image": {}, "llm": {"error_rate": 1.0, "status": 503}}, {"text": 1}, True),
+        ("recovery", {"llm": {}}, {"text": 3, "image": 1}, False),
+    ]
+
+
+def build_requests(n: int, mix: Dict[str, float], paraphrase: bool, rng: random.Random) -> List[Dict]:
+    """
+    Distinct questions: each is a course question plus two random tokens, so they are too far apart
+    for the answer cache. Paraphrases are the bare questions, close to every variant asked before.
+    """
+    requests = []
+    for kind in rng.choices(list(mix), weights=list(mix.values()), k=n):
+        question = rng.choice(QUESTIONS)
+        if not paraphrase:
+            question = f"{question} #{rng.getrandbits(32):08x} #{rng.getrandbits(32):08x}"
+        body = {"question": question}
+        if kind == "image":
+            body["image"] = TINY_IMAGE
+        requests.append(body)
+    return requests
+
+
+async def drive(client: httpx.AsyncClient, requests: List[Dict], concurrency: int) -> List[Tuple[str, float]]:
+    """Sends the requests, returning (outcome, seconds) per request: ok, llm_error or http_<status>/failed."""
+    queue: "asyncio.Queue[Dict]" = asyncio.Queue()
+    for body in requests:
+        queue.put_nowait(body)
+    results = []
+
+    async def worker():
+        while not queue.empty():
+            body = queue.get_nowait()
+            started = time.perf_counter()
+            try:
+                response = await client.post("/api/", json=body)
+                if response.status_code != 200:
+                    outcome = f"http_{response.status_code}"
+                else:
+                    outcome = "llm_error" if response.json().get("answer") == LLM_ERROR_ANSWER else "ok"
+            except (httpx.HTTPError, ValueError):
+                outcome = "failed"
+            results.append((outcome, time.perf_counter() - started))
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return results
+
+
+async def snapshot(client: httpx.AsyncClient) -> Tuple[Dict, Dict[str, float]]:
+    upstreams = (await client.get("/api/stats")).json()["upstreams"]
+    fallbacks = {kind: float(value) for kind, value in FALLBACK_RE.findall((await client.get("/metrics")).text)}
+    return upstreams, fallbacks
+
+
+def report(name: str, results: List[Tuple[str, float]], before: Tuple[Dict, Dict], after: Tuple[Dict, Dict]) -> None:
+    outcomes: Dict[str, int] = {}
+    for outcome, _ in results:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    latencies = sorted(seconds for _, seconds in results)
+    print(f"\n {name}: {len(results)} requests, " + ", ".join(f"{k} {v}" for k, v in sorted(outcomes.items())))
+    print(f"   latency ms p50 {percentile(latencies, 50) * 1000:.0f}  p95 {percentile(latencies, 95) * 1000:.0f}  "
+          f"p99 {percentile(latencies, 99) * 1000:.0f}  max {latencies[-1] * 1000:.0f}")
+    fallbacks = {kind: after[1][kind] - before[1].get(kind, 0.0) for kind in after[1]}
+    fallbacks = {kind: int(count) for kind, count in fallbacks.items() if count}
+    if fallbacks:
+        print("   fallbacks " + ", ".join(f"{kind} {count}" for kind, count in sorted(fallbacks.items())))
+    print(f"   {'upstream':<11} {'circuit':<10}" + "".join(f"{c:>15}" for c in COUNTERS) + f"{'timeout s':>11}")
+    for upstream, row in after[0].items():
+        deltas = "".join(f"{row[c] - before[0][upstream][c]:>15}" for c in COUNTERS)
+        print(f"   {upstream:<11} {row['circuit']:<10}{deltas}{row['attempt_timeout_s']:>11}")
+
+
+async def run(api_url: str, stub_url: str, args: argparse.Namespace) -> None:
+    rng = random.Random(args.seed)
+    async with httpx.AsyncClient(base_url=api_url, timeout=120) as client, \
+            httpx.AsyncClient(base_url=stub_url, timeout=10) as stub_client:
+        for name, faults, mix, paraphrase in phases(args.slow_latency):
+            if name == "recovery":
+                # Let the open circuits reach their probe time
+                await asyncio.sleep(args.open_seconds + 0.5)
+            if faults:
+                (await stub_client.post("/faults", json=faults)).raise_for_status()
+            before = await snapshot(client)
+            results = await drive(client, build_requests(args.requests, mix, paraphrase, rng), args.concurrency)
+            report(name, results, before, await snapshot(client))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exercise the upstream resilience layer against fault-injecting stubs.")
+    parser.add_argument("--requests", type=int, default=60, help="Requests per phase")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--slow-latency", type=float, default=1.0, help="Seconds taken by the slow Jina calls in slow_tail")
+    parser.add_argument("--open-seconds", type=float, default=3.0, help="CIRCUIT_OPEN_SECONDS for the API under test")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--target", help="Use this running API (started with JINA/LLM URLs pointing at --stub-url)")
+    parser.add_argument("--stub-url", help="Stubs already running for --target")
+    stubs.add_latency_arguments(parser)
+    parser.set_defaults(jina_latency=0.05, llm_latency=0.3, supabase_latency=0.02)
+    args = parser.parse_args()
+
+    stubs_server = None
+    api = None
+    try:
+        if args.stub_url:
+            stub_url = args.stub_url.rstrip("/")
+        else:
+            stub_port = free_port()
+            stub_url = f"http://127.0.0.1:{stub_port}"
+            stubs_server = start_stubs(stub_port, stubs.latency_from_args(args), args.jitter)
+        if args.target:
+            api_url = args.target.rstrip("/")
+        else:
+            api_port = free_port()
+            api_url = f"http://127.0.0.1:{api_port}"
+            # The embedding cache would hide the image calls; the answer cache serves the llm_outage phase
+            api = start_api(api_port, stub_url, 1, True, "supabase", {
+                "EMBEDDING_CACHE_SIZE": "0",
+                "LOG_LEVEL": os.getenv("LOG_LEVEL", "ERROR"),
+                "CIRCUIT_OPEN_SECONDS": str(args.open_seconds),
+            })
+        wait_until_ready(api_url)
+        print(f" Fault test against {api_url} (stubs {stub_url}, upstream latency {stubs.latency_from_args(args)})")
+        asyncio.run(run(api_url, stub_url, args))
+    finally:
+        if api is not None:
+            api.terminate()
+            api.wait(timeout=10)
+        if stubs_server is not None:
+            stubs_server.should_exit = True
+
+
+if __name__ == "__main__":
+    main()
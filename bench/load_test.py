@@ -0,0 +1,245 @@
+"""
+Load test for /api/ against local stub upstreams (bench/stubs.py), so no paid API is called.
+
+Starts the stubs in-process and `uvicorn main:app` as a subprocess pointed at them, then sends a
+weighted mix of text-only, image and Discourse-URL questions from `--concurrency` clients and
+reports p50/p95/p99 latency and throughput per request kind.
+
+    python bench/load_test.py --requests 300 --concurrency 16 --mix text=6,image=2,url=2
+    python bench/load_test.py --llm-latency 0.5 --workers 2 --json results.json
+    python bench/load_test.py --target http://localhost:8000   # an already running server
+
+Caches and request coalescing are defeated by default (every question is distinct and the
+caches are sized to zero); pass --caches to measure a warm, repetitive workload instead.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+import uvicorn
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import stubs  # noqa: E402
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+QUESTIONS = [
+    "I know Docker but have not used Podman before. Should I use Docker for this course?",
+    "If a student scores 10/10 on GA4 as well as a bonus, how would it appear on the dashboard?",
+    "Should I use gpt-4o-mini or gpt-3.5-turbo-0125 for the assignment?",
+    "How do I set up VS Code with the course dev container?",
+    "What is the deadline for submitting Project 1?",
+    "How are the graded assignments weighted in the final score?",
+]
+# 1x1 transparent PNG
+TINY_IMAGE = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII="
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_stubs(port: int, latency: Dict[str, float], jitter: float,
+                faults: Optional[Dict[str, Dict[str, float]]] = None) -> uvicorn.Server:
+    server = uvicorn.Server(uvicorn.Config(stubs.create_app(latency, jitter, faults), host="127.0.0.1", port=port,
+                                           log_level="warning", lifespan="off"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def start_api(port: int, stub_url: str, workers: int, caches: bool, backend: str,
+              extra_env: Optional[Dict[str, str]] = None) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "SUPABASE_URL": stub_url,
+        "SUPABASE_KEY": os.getenv("SUPABASE_KEY", "bench"),
+        "LLM_API_TOKEN": "bench",
+        "JINA_API_TOKEN": "bench",
+        "LLM_API_URL": f"{stub_url}/openrouter/v1/chat/completions",
+        "JINA_EMBEDDING_URL": f"{stub_url}/v1/embeddings",
+        "RETRIEVAL_BACKEND": backend,
+        "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+    }
+    if not caches:
+        env.update(EMBEDDING_CACHE_SIZE="0", ANSWER_CACHE_SIZE="0", PAGE_CACHE_MAX_BYTES="0")
+    env.update(extra_env or {})
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=BASE_DIR, env=env,
+    )
+
+
+def wait_until_ready(url: str, timeout: float = 60.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{url}/api/stats", timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"API at {url} did not come up within {timeout}s")
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in ("text", "image", "url"):
+            raise argparse.ArgumentTypeError(f"unknown request kind '{kind}' (use text, image, url)")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def build_requests(n: int, mix: Dict[str, float], stub_url: str, distinct: bool, seed: int) -> List[Tuple[str, Dict]]:
+    rng = random.Random(seed)
+    kinds = rng.choices(list(mix), weights=list(mix.values()), k=n)
+    requests = []
+    for i, kind in enumerate(kinds):
+        question = rng.choice(QUESTIONS)
+        if distinct:
+            question = f"{question} (variant {i})"
+        body = {"question": question}
+        if kind == "image":
+            body["image"] = TINY_IMAGE
+        elif kind == "url":
+            topic = rng.randrange(50) if not distinct else i
+            body["url"] = f"{stub_url}/t/topic-{topic}/{topic}"
+        requests.append((kind, body))
+    return requests
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return float("nan")
+    rank = max(1, int(round(q / 100 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+async def drive(url: str, requests: List[Tuple[str, Dict]], concurrency: int, timeout: float) -> Tuple[List[Tuple[str, float, bool]], float]:
+    queue: "asyncio.Queue[Tuple[str, Dict]]" = asyncio.Queue()
+    for item in requests:
+        queue.put_nowait(item)
+    results: List[Tuple[str, float, bool]] = []
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits) as client:
+        async def worker():
+            while True:
+                try:
+                    kind, body = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                started = time.perf_counter()
+                try:
+                    response = await client.post("/api/", json=body)
+                    ok = response.status_code == 200 and "answer" in response.json()
+                except (httpx.HTTPError, ValueError):
+                    ok = False
+                results.append((kind, time.perf_counter() - started, ok))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return results, elapsed
+
+
+def summarize(results: List[Tuple[str, float, bool]], elapsed: float) -> Dict[str, Dict[str, float]]:
+    summary = {}
+    groups = {"all": results}
+    for kind, _, _ in results:
+        groups.setdefault(kind, [r for r in results if r[0] == kind])
+    for name, rows in groups.items():
+        latencies = sorted(latency for _, latency, ok in rows if ok)
+        summary[name] = {
+            "requests": len(rows),
+            "errors": sum(1 for _, _, ok in rows if not ok),
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "mean_ms": sum(latencies) / len(latencies) * 1000 if latencies else float("nan"),
+            "rps": len(latencies) / elapsed if elapsed else 0.0,
+        }
+    return summary
+
+
+def print_summary(summary: Dict[str, Dict[str, float]], elapsed: float) -> None:
+    print(f"\n Completed in {elapsed:.2f}s")
+    print(f" {'kind':<6} {'reqs':>6} {'errors':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'mean ms':>9} {'req/s':>8}")
+    for name, row in summary.items():
+        print(f" {name:<6} {row['requests']:>6} {row['errors']:>6} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} "
+              f"{row['p99_ms']:>9.1f} {row['mean_ms']:>9.1f} {row['rps']:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test /api/ against local stub upstreams.")
+    parser.add_argument("--requests", type=int, default=200, help="Total requests to send")
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight at once")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("text=6,image=2,url=2"),
+                        help="Weighted request kinds, e.g. text=6,image=2,url=2")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers for main:app")
+    parser.add_argument("--backend", choices=["supabase", "numpy"], default="supabase", help="RETRIEVAL_BACKEND for main:app")
+    parser.add_argument("--caches", action="store_true", help="Keep the caches on and repeat questions")
+    parser.add_argument("--warmup", type=int, default=10, help="Requests sent before measuring")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Client timeout per request")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--target", help="Benchmark this running API instead of starting main:app (stubs still start for url requests)")
+    parser.add_argument("--json", metavar="PATH", help="Also write the summary as JSON")
+    stubs.add_latency_arguments(parser)
+    stubs.add_fault_arguments(parser)
+    args = parser.parse_args()
+
+    stub_port = free_port()
+    stub_url = f"http://127.0.0.1:{stub_port}"
+    stubs_server = start_stubs(stub_port, stubs.latency_from_args(args), args.jitter, stubs.faults_from_args(args))
+    api: Optional[subprocess.Popen] = None
+    try:
+        if args.target:
+            api_url = args.target.rstrip("/")
+        else:
+            api_port = free_port()
+            api_url = f"http://127.0.0.1:{api_port}"
+            api = start_api(api_port, stub_url, args.workers, args.caches, args.backend)
+        wait_until_ready(api_url)
+
+        distinct = not args.caches
+        if args.warmup:
+            warmup = build_requests(args.warmup, args.mix, stub_url, distinct, args.seed + 1)
+            asyncio.run(drive(api_url, warmup, min(args.concurrency, args.warmup), args.timeout))
+
+        requests = build_requests(args.requests, args.mix, stub_url, distinct, args.seed)
+        print(f" Sending {len(requests)} requests to {api_url} with concurrency {args.concurrency} "
+              f"(mix {args.mix}, upstream latency {stubs.latency_from_args(args)})")
+        results, elapsed = asyncio.run(drive(api_url, requests, args.concurrency, args.timeout))
+        summary = summarize(results, elapsed)
+        print_summary(summary, elapsed)
+
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump({"args": {k: v for k, v in vars(args).items() if k != "json"}, "elapsed": elapsed,
+                           "summary": summary}, f, indent=2)
+    finally:
+        if api is not None:
+            api.terminate()
+            api.wait(timeout=10)
+        stubs_server.should_exit = True
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Microbenchmarks for the CPU-bound helpers on the request path.
+
+    python bench/microbench.py                          # print timings
+    python bench/microbench.py --save bench/baseline.json
+    python bench/microbench.py --compare bench/baseline.json --tolerance 0.25
+
+With --compare the exit status is 1 if any benchmark got slower than the baseline by more
+than the tolerance, so it can gate a deploy.
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+from typing import Callable, Dict, List
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+# main.py refuses to import without these; no request is made
+for name in ("SUPABASE_URL", "SUPABASE_KEY", "LLM_API_TOKEN", "JINA_API_TOKEN"):
+    os.environ.setdefault(name, "http://127.0.0.1:9" if name == "SUPABASE_URL" else "bench")
+os.environ.setdefault("RETRIEVAL_BACKEND", "supabase")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import main  # noqa: E402
+from text_processing import DISCOURSE_BASE_URL, extract_links_from_html  # noqa: E402
+
+
+def sample_posts(limit: int = 200) -> List[str]:
+    """Cooked Discourse HTML from the scraped posts, or a synthetic post if they are not present."""
+    path = os.path.join(BASE_DIR, "4_discourse_posts_2025.json")
+    posts = []
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            for topic in json.load(f):
+                posts.extend(post["content_html"] for post in topic.get("posts", []) if post.get("content_html"))
+    if not posts:
+        posts = ['<p>See <a href="https://tds.s-anand.net/#/docker">Docker</a> and '
+                 '<a href="/t/podman-setup/1234">this thread</a>.</p>' * 5]
+    return posts[:limit]
+
+
+def candidate_links(n: int, discourse: bool) -> List[Dict[str, str]]:
+    links = [{"url": "https://tds.s-anand.net/#/docker", "text": "docker.md"},
+             {"url": "https://podman.io/docs", "text": "Podman docs"}]
+    for i in range(n):
+        if discourse and i % 2:
+            links.append({"url": f"{DISCOURSE_BASE_URL}/t/topic-{i}/{i}", "text": f"Topic {i}"})
+        else:
+            links.append({"url": f"https://example.com/page-{i}", "text": f"Page {i}"})
+    return links
+
+
+def benchmarks() -> Dict[str, Callable[[], object]]:
+    posts = sample_posts()
+    long_html = "".join(posts)
+    course_links = candidate_links(20, discourse=False)
+    forum_links = candidate_links(20, discourse=True)
+    contexts = ["Docker and Podman are both container runtimes. " * 40] * 2
+    docs = [{"source_name": "docker.md", "url": "https://tds.s-anand.net/#/docker"}] * 2
+
+    return {
+        "extract_links_from_html/200_posts": lambda: [extract_links_from_html(post) for post in posts],
+        "extract_links_from_html/page": lambda: extract_links_from_html(long_html, base_url=DISCOURSE_BASE_URL),
+        "select_links/course": lambda: main.select_links(None, course_links, contexts, docs, False),
+        "select_links/discourse": lambda: main.select_links(f"{DISCOURSE_BASE_URL}/t/topic-1/1", forum_links, contexts, docs, True),
+    }
+
+
+def measure(fn: Callable[[], object], repeat: int = 5) -> float:
+    """Best-of-`repeat` seconds per call; each repeat runs for at least 0.2s (timeit.autorange)."""
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for link extraction and link selection.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--save", metavar="PATH", help="Write the timings as a JSON baseline")
+    parser.add_argument("--compare", metavar="PATH", help="Fail if slower than this baseline by more than --tolerance")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative slowdown (default 0.25)")
+    args = parser.parse_args()
+
+    results = {}
+    for name, fn in benchmarks().items():
+        results[name] = measure(fn, args.repeat)
+        print(f" {name:<34} {results[name] * 1e6:>12.1f} us/call")
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f" Baseline saved to {args.save}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = []
+        for name, seconds in results.items():
+            if name in baseline and seconds > baseline[name] * (1 + args.tolerance):
+                regressions.append(f"{name}: {baseline[name] * 1e6:.1f} -> {seconds * 1e6:.1f} us/call")
+        if regressions:
+            print(" Regressions beyond {:.0%}:\n  ".format(args.tolerance) + "\n  ".join(regressions))
+            sys.exit(1)
+        print(f" No regressions beyond {args.tolerance:.0%} against {args.compare}")
+
+
+if __name__ == "__main__":
+    main_cli()
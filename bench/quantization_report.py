@@ -0,0 +1,108 @@
+"""
+Recall-versus-memory report for the quantized vector index (VECTOR_QUANTIZATION).
+
+Every stored vector is used once as a query against the other vectors of the same corpora
+(leave-one-out), and the top-k of each index variant is compared with the exact float32 top-k.
+
+    python bench/quantization_report.py
+    python bench/quantization_report.py --files 6_embedded_data_768,7_embedded_discourse_768 --output bench/quantization_report.md
+"""
+import argparse
+import os
+import sys
+import time
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+import embedding_store  # noqa: E402
+from vector_index import VectorIndex  # noqa: E402
+
+VARIANTS = [("none", 0), ("float16", 0), ("float16", 32), ("int8", 0), ("int8", 16), ("int8", 32)]
+RECALL_AT = (1, 2, 5, 10)
+
+
+def top_ids(index: VectorIndex, query: np.ndarray, k: int, exclude: int) -> List[int]:
+    """Row ids of the best k matches for `query`, leaving out row `exclude` (the query itself)."""
+    results = index.search(query, match_threshold=-2.0, match_count=k + 1)
+    return [r["row"] for r in results if r["row"] != exclude][:k]
+
+
+def evaluate(paths: Sequence[str], queries: int, seed: int) -> Tuple[int, int, List[Dict]]:
+    exact = VectorIndex.from_files(paths)
+    n = len(exact)
+    # Row numbers in the metadata let results be matched without relying on source names being unique
+    for row, record in enumerate(exact.metadata):
+        record["row"] = row
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(n, size=min(queries, n), replace=False)
+    k_max = max(RECALL_AT)
+    truth = {int(i): top_ids(exact, np.asarray(exact.matrix[i]), k_max, int(i)) for i in sample}
+
+    rows = []
+    for quantization, rerank in VARIANTS:
+        index = VectorIndex.from_files(paths, quantization, rerank)
+        index.metadata = exact.metadata
+        hits = {k: 0 for k in RECALL_AT}
+        started = time.perf_counter()
+        found = {int(i): top_ids(index, np.asarray(exact.matrix[i]), k_max, int(i)) for i in sample}
+        seconds = (time.perf_counter() - started) / len(sample)
+        for i, expected in truth.items():
+            for k in RECALL_AT:
+                hits[k] += len(set(expected[:k]) & set(found[i][:k]))
+        rows.append({
+            "quantization": quantization,
+            "rerank": rerank,
+            "search_bytes": index.search_bytes,
+            "recall": {k: hits[k] / (len(sample) * min(k, n - 1)) for k in RECALL_AT},
+            "us_per_query": seconds * 1e6,
+        })
+    return n, exact.dim, rows
+
+
+def render(paths: Sequence[str], n: int, dim: int, sample: int, rows: List[Dict]) -> str:
+    baseline = rows[0]["search_bytes"]
+    lines = [
+        "# Vector quantization: recall vs memory",
+        "",
+        f"Corpora: {', '.join(os.path.basename(p) for p in paths)} ({n} vectors x {dim} dims). "
+        f"{min(sample, n)} stored vectors used as leave-one-out queries; recall@k is the overlap with the exact float32 top-k.",
+        "Search bytes are what each query scans (quantized codes plus int8 scales); re-ranking additionally reads the "
+        "exact rows of the candidates from the memory-mapped store. Latency is machine-dependent.",
+        "",
+        "| quantization | rerank | search bytes | vs float32 | " + " | ".join(f"recall@{k}" for k in RECALL_AT) + " | us/query |",
+        "|---|---:|---:|---:|" + "---:|" * len(RECALL_AT) + "---:|",
+    ]
+    for row in rows:
+        recalls = " | ".join(f"{row['recall'][k]:.4f}" for k in RECALL_AT)
+        lines.append(f"| {row['quantization']} | {row['rerank'] or '-'} | {row['search_bytes']:,} | "
+                     f"{row['search_bytes'] / baseline:.2f}x | {recalls} | {row['us_per_query']:.0f} |")
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure recall and memory of the quantized vector index variants.")
+    parser.add_argument("--files", default=os.getenv("VECTOR_INDEX_FILES", "6_embedded_data_768,7_embedded_discourse_768"),
+                        help="Comma-separated store prefixes or embedded JSON files")
+    parser.add_argument("--queries", type=int, default=1000, help="Leave-one-out queries to sample")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", metavar="PATH", help="Also write the report as markdown")
+    args = parser.parse_args()
+
+    paths = [os.path.join(BASE_DIR, p.strip()) for p in args.files.split(",") if p.strip()]
+    paths = [p for p in paths if embedding_store.store_exists(p) or os.path.exists(embedding_store.store_prefix(p) + ".json")]
+    if not paths:
+        parser.error(f"none of {args.files} exist under {BASE_DIR}")
+    n, dim, rows = evaluate(paths, args.queries, args.seed)
+    report = render(paths, n, dim, args.queries, rows)
+    print(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report)
+
+
+if __name__ == "__main__":
+    main()
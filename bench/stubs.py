@@ -0,0 +1,238 @@
+"""
+Local stand-ins for the paid upstreams used by main.py, so the API can be load-tested for free:
+
+  POST /v1/embeddings                       Jina embeddings (text and image inputs)
+  POST /rest/v1/rpc/match_all_vectors       Supabase match_all_vectors RPC
+  POST /openrouter/v1/chat/completions      aipipe chat completions (JSON, or SSE with "stream": true)
+  GET  /t/{slug}/{topic_id}                 a Discourse-like topic page for `url` requests
+
+Each route waits for its configured latency (+/- jitter) before answering.
+
+Faults can be injected per upstream ("jina", "jina_image" for image inputs, "supabase", "llm",
+"page"): `error_rate` of the calls fail with `status`, and `slow_rate` of them take `slow_latency`
+seconds instead of the normal latency. Set them on the command line or at runtime:
+
+  GET  /faults                              current faults
+  POST /faults                              e.g. {"llm": {"error_rate": 1.0}} (merged; {"llm": {}} clears)
+
+    python bench/stubs.py --port 8900 --jina-latency 0.15 --llm-latency 1.5
+    python bench/stubs.py --fault llm:error_rate=0.3,status=503 --fault jina:slow_rate=0.05,slow_latency=3
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import sys
+import re
+from typing import Dict, List, Optional
+
+import numpy as np
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import HTMLResponse, StreamingResponse
+from starlette.requests import ClientDisconnect
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+import embedding_store  # noqa: E402
+
+# Seconds, roughly what the real services take for a single short question
+DEFAULT_LATENCY = {
+    "jina": 0.15,
+    "supabase": 0.05,
+    "llm": 1.5,
+    "page": 0.2,
+}
+DEFAULT_JITTER = 0.2
+FAULT_UPSTREAMS = ("jina", "jina_image", "supabase", "llm", "page")
+FAULT_DEFAULTS = {"error_rate": 0.0, "status": 503, "slow_rate": 0.0, "slow_latency": 5.0}
+EMBEDDING_DIM = 768
+ANSWER = ("Use Podman for the course since it is the recommended container runtime, "
+          "though Docker works too for most exercises and the commands are largely compatible.")
+
+
+def word_vector(word: str, dim: int) -> np.ndarray:
+    seed = int.from_bytes(hashlib.sha256(word.encode("utf-8")).digest()[:8], "little")
+    return np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+
+
+def fake_embedding(text: str, dim: int = EMBEDDING_DIM) -> List[float]:
+    """
+    Deterministic unit vector per input: the normalized sum of a random vector per word, so repeated
+    questions embed identically and questions sharing most of their words are close, as paraphrases are.
+    """
+    words = re.findall(r"\w+", text.lower()) or [text]
+    vector = np.sum([word_vector(word, dim) for word in words], axis=0)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def load_docs() -> List[Dict]:
+    """Rows returned by the fake RPC: the committed course store, or a placeholder doc."""
+    try:
+        _, metadata = embedding_store.load_corpus(os.path.join(BASE_DIR, "6_embedded_data_768"))
+    except FileNotFoundError:
+        metadata = []
+    return metadata or [{"source_name": "docker.md", "content": "Docker and Podman basics.", "url": None}]
+
+
+def create_app(latency: Dict[str, float], jitter: float = DEFAULT_JITTER,
+               faults: Optional[Dict[str, Dict[str, float]]] = None) -> FastAPI:
+    app = FastAPI()
+    docs = load_docs()
+    app.state.calls = {name: 0 for name in FAULT_UPSTREAMS}
+    app.state.injected = {name: 0 for name in FAULT_UPSTREAMS}
+    app.state.faults = {name: dict(FAULT_DEFAULTS) for name in FAULT_UPSTREAMS}
+    for name, fault in (faults or {}).items():
+        app.state.faults[name].update(fault)
+
+    def delay(name: str, base: float) -> float:
+        fault = app.state.faults[name]
+        if random.random() < fault["slow_rate"]:
+            app.state.injected[name] += 1
+            return fault["slow_latency"]
+        return max(0.0, base * random.uniform(1 - jitter, 1 + jitter))
+
+    def maybe_fail(name: str) -> None:
+        fault = app.state.faults[name]
+        if random.random() < fault["error_rate"]:
+            app.state.injected[name] += 1
+            raise HTTPException(status_code=int(fault["status"]), detail=f"injected {name} fault")
+
+    async def read_json(request: Request) -> Dict:
+        # Clients drop requests they no longer need, e.g. the losing copy of a hedged call
+        try:
+            return await request.json()
+        except ClientDisconnect:
+            raise HTTPException(status_code=499, detail="client disconnected")
+
+    async def wait(name: str, latency_name: Optional[str] = None) -> None:
+        app.state.calls[name] += 1
+        seconds = delay(name, latency.get(latency_name or name, 0.0))
+        if seconds > 0:
+            await asyncio.sleep(seconds)
+        maybe_fail(name)
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await read_json(request)
+        await wait("jina_image" if body.get("input_type") == "image" else "jina", "jina")
+        return {"data": [{"index": i, "embedding": fake_embedding(str(text))} for i, text in enumerate(body["input"])]}
+
+    @app.post("/rest/v1/rpc/match_all_vectors")
+    async def match_all_vectors(request: Request):
+        body = await read_json(request)
+        await wait("supabase")
+        embedding = body.get("query_embedding") or [0.0]
+        start = int(abs(embedding[0]) * 1e6) % len(docs)
+        count = int(body.get("match_count", 2))
+        rows = [docs[(start + i) % len(docs)] for i in range(count)]
+        return [{**row, "similarity": 0.9 - 0.01 * i} for i, row in enumerate(rows)]
+
+    @app.post("/openrouter/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await read_json(request)
+        if not body.get("stream"):
+            await wait("llm")
+            return {"choices": [{"message": {"role": "assistant", "content": ANSWER}}]}
+
+        app.state.calls["llm"] += 1
+        maybe_fail("llm")
+
+        async def events():
+            # Time to first token is about a third of the total; the rest is spread over the tokens
+            total = delay("llm", latency.get("llm", 0.0))
+            words = ANSWER.split(" ")
+            await asyncio.sleep(total / 3)
+            for i, word in enumerate(words):
+                chunk = {"choices": [{"delta": {"content": word if i == 0 else " " + word}}]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+                await asyncio.sleep(2 * total / 3 / len(words))
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.get("/t/{slug}/{topic_id}")
+    async def topic_page(slug: str, topic_id: int):
+        await wait("page")
+        paragraphs = "".join(
+            f"<p>Post {i} in {slug}: containers, Docker and Podman are discussed here at some length.</p>"
+            for i in range(20)
+        )
+        links = "".join(f'<a href="/t/related-{n}/{n}">Related topic {n}</a> ' for n in range(topic_id, topic_id + 5))
+        return HTMLResponse(f"<html><head><title>{slug} - TDS KB</title></head>"
+                            f"<body><main>{paragraphs}{links}</main></body></html>")
+
+    @app.get("/stats")
+    async def stats():
+        return {**app.state.calls, "injected_faults": app.state.injected}
+
+    @app.get("/faults")
+    async def get_faults():
+        return app.state.faults
+
+    @app.post("/faults")
+    async def set_faults(request: Request):
+        body = await request.json()
+        for name, fault in body.items():
+            if name not in app.state.faults:
+                raise HTTPException(status_code=400, detail=f"unknown upstream '{name}'")
+            app.state.faults[name] = {**FAULT_DEFAULTS, **app.state.faults[name], **fault} if fault else dict(FAULT_DEFAULTS)
+        return app.state.faults
+
+    return app
+
+
+def add_latency_arguments(parser: argparse.ArgumentParser) -> None:
+    for name, seconds in DEFAULT_LATENCY.items():
+        parser.add_argument(f"--{name}-latency", type=float, default=seconds, help=f"Seconds per {name} call (default {seconds})")
+    parser.add_argument("--jitter", type=float, default=DEFAULT_JITTER, help="Relative +/- jitter on every latency")
+
+
+def latency_from_args(args: argparse.Namespace) -> Dict[str, float]:
+    return {name: getattr(args, f"{name}_latency") for name in DEFAULT_LATENCY}
+
+
+def parse_fault(text: str) -> Dict[str, Dict[str, float]]:
+    """'llm:error_rate=0.3,status=503' -> {"llm": {"error_rate": 0.3, "status": 503.0}}"""
+    name, _, settings = text.partition(":")
+    if name not in FAULT_UPSTREAMS:
+        raise argparse.ArgumentTypeError(f"unknown upstream '{name}' (use {', '.join(FAULT_UPSTREAMS)})")
+    fault = {}
+    for part in settings.split(","):
+        key, _, value = part.partition("=")
+        if key not in FAULT_DEFAULTS:
+            raise argparse.ArgumentTypeError(f"unknown fault setting '{key}' (use {', '.join(FAULT_DEFAULTS)})")
+        fault[key] = float(value)
+    return {name: fault}
+
+
+def add_fault_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--fault", type=parse_fault, action="append", default=[], metavar="UPSTREAM:KEY=VALUE,...",
+                        help="Inject faults, e.g. llm:error_rate=0.3,status=503 or jina:slow_rate=0.05,slow_latency=3")
+
+
+def faults_from_args(args: argparse.Namespace) -> Dict[str, Dict[str, float]]:
+    faults: Dict[str, Dict[str, float]] = {}
+    for fault in args.fault:
+        for name, settings in fault.items():
+            faults.setdefault(name, {}).update(settings)
+    return faults
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run local stub upstreams (Jina, Supabase RPC, aipipe, Discourse pages).")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    add_latency_arguments(parser)
+    add_fault_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(create_app(latency_from_args(args), args.jitter, faults_from_args(args)),
+                host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import re
+from typing import Dict, List, Optional, Tuple
+
+from text_processing import html_blocks
+
+# Sized for jina-embeddings-v2-base-en: small enough to retrieve precise passages,
+# large enough to keep a paragraph or a short section together.
+CHUNK_WORDS = 256
+CHUNK_OVERLAP_WORDS = 40
+
+HEADING_RE = re.compile(r"^#{1,6}\s")
+FENCE_RE = re.compile(r"^(```|~~~)")
+
+
+def word_windows(text: str, max_words: int = CHUNK_WORDS, overlap: int = CHUNK_OVERLAP_WORDS) -> List[str]:
+    """
+    Splits text into windows of at most max_words words, each sharing `overlap` words with
+    the previous one. Original whitespace (newlines in code blocks, lists) is preserved.
+    """
+    tokens = re.findall(r"\S+\s*", text)
+    if len(tokens) <= max_words:
+        return [text.strip()] if tokens else []
+    step = max(1, max_words - overlap)
+    windows = []
+    for start in range(0, len(tokens), step):
+        windows.append("".join(tokens[start:start + max_words]).strip())
+        if start + max_words >= len(tokens):
+            break
+    return windows
+
+
+def markdown_sections(markdown: str) -> List[Tuple[Optional[str], str]]:
+    """Splits markdown at headings (ignoring '#' lines inside code fences). Returns (heading, section) pairs."""
+    sections = []
+    heading = None
+    lines: List[str] = []
+    in_fence = False
+    for line in markdown.splitlines():
+        if FENCE_RE.match(line.strip()):
+            in_fence = not in_fence
+        if not in_fence and HEADING_RE.match(line) and lines:
+            sections.append((heading, "\n".join(lines).strip()))
+            lines = []
+        if not in_fence and HEADING_RE.match(line):
+            heading = line.lstrip("#").strip()
+        lines.append(line)
+    if lines:
+        sections.append((heading, "\n".join(lines).strip()))
+    return [(h, s) for h, s in sections if s]
+
+
+def chunk_markdown(markdown: str, max_words: int = CHUNK_WORDS, overlap: int = CHUNK_OVERLAP_WORDS) -> List[Dict[str, str]]:
+    """
+    Chunks a course page by heading. Consecutive short sections are packed together;
+    long sections are cut into overlapping word windows, each prefixed with its heading.
+    Returns [{"content": ..., "text": ...}] where both are the markdown chunk.
+    """
+    chunks = []
+    pending: List[str] = []
+    pending_words = 0
+
+    def flush():
+        nonlocal pending, pending_words
+        if pending:
+            text = "\n\n".join(pending)
+            chunks.append({"content": text, "text": text})
+        pending, pending_words = [], 0
+
+    for heading, section in markdown_sections(markdown):
+        n_words = len(section.split())
+        if n_words > max_words:
+            flush()
+            for i, window in enumerate(word_windows(section, max_words, overlap)):
+                text = window if i == 0 or not heading else f"{heading}\n\n{window}"
+                chunks.append({"content": text, "text": text})
+            continue
+        if pending_words + n_words > max_words:
+            flush()
+        pending.append(section)
+        pending_words += n_words
+    flush()
+    return chunks
+
+
+def chunk_html(content_html: str, max_words: int = CHUNK_WORDS, overlap: int = CHUNK_OVERLAP_WORDS) -> List[Dict[str, str]]:
+    """
+    Chunks a Discourse post by paragraph. Paragraphs are packed into windows of up to
+    max_words words; trailing paragraphs totalling at most `overlap` words are repeated
+    at the start of the next window. Returns [{"content": html fragment, "text": plain text}].
+    """
+    chunks = []
+    window: List[Tuple[str, str, int]] = []
+    window_words = 0
+
+    def flush():
+        if window:
+            chunks.append({
+                "content": "\n".join(html for html, _, _ in window),
+                "text": "\n\n".join(text for _, text, _ in window),
+            })
+
+    for html, text in html_blocks(content_html):
+        n_words = len(text.split())
+        if n_words > max_words:
+            # A single oversized block (long code sample, huge quote): fall back to word windows
+            flush()
+            window, window_words = [], 0
+            for piece in word_windows(text, max_words, overlap):
+                chunks.append({"content": piece, "text": piece})
+            continue
+        if window and window_words + n_words > max_words:
+            flush()
+            carried = []
+            carried_words = 0
+            for block in reversed(window):
+                if carried_words + block[2] > overlap:
+                    break
+                carried.insert(0, block)
+                carried_words += block[2]
+            window, window_words = carried, carried_words
+        window.append((html, text, n_words))
+        window_words += n_words
+    flush()
+    return chunks
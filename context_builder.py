@@ -0,0 +1,176 @@
+"""
+Assembles the LLM context from retrieved passages within a token budget.
+
+Passages are {"text", "score", "links"} dicts, optionally with "max_tokens" capping how much of
+the budget that passage may take (e.g. a long fetched page). Markup is stripped, exact and near-duplicate
+passages are dropped (their links move to the passage they duplicate, so link selection still
+sees every source whose content reaches the prompt) and the highest-scoring passages are packed
+into the budget, truncating the last one that only partly fits.
+
+Tokens are counted with tiktoken for the target model when it is installed, and estimated at
+~4 characters per token otherwise.
+"""
+import importlib.util
+import logging
+import math
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional, Set
+
+from text_processing import html_to_text
+
+if importlib.util.find_spec("tiktoken") is not None:
+    import tiktoken
+else:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+CHARS_PER_TOKEN = 4
+# A passage is a near-duplicate of a kept one when their word 5-gram sets overlap this much
+# (Jaccard), or when this share of its 5-grams already appears in the kept passage
+NEAR_DUPLICATE_JACCARD = 0.8
+NEAR_DUPLICATE_CONTAINMENT = 0.9
+SHINGLE_WORDS = 5
+# Don't bother truncating a passage into less room than this
+MIN_TRUNCATED_TOKENS = 64
+# Chat format overhead per message (role and separators), as counted by OpenAI
+TOKENS_PER_MESSAGE = 4
+
+HTML_TAG_RE = re.compile(r"<(?:[a-zA-Z][a-zA-Z0-9]*\b[^>]*|/[a-zA-Z][a-zA-Z0-9]*\s*)>")
+HTML_COMMENT_RE = re.compile(r"<!--.*?-->", re.DOTALL)
+MARKDOWN_IMAGE_RE = re.compile(r"!\[([^\]]*)\]\([^)]*\)")
+SPACES_RE = re.compile(r"[ \t]+")
+BLANK_LINES_RE = re.compile(r"\n\s*\n+")
+WORD_RE = re.compile(r"\w+")
+
+
+@lru_cache(maxsize=8)
+def _encoding(model: str):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model.split("/")[-1])
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        # The BPE files are downloaded on first use; fall back to the estimate when offline
+        logger.warning("tokenizer_unavailable model=%s error=%r fallback=estimate", model, e)
+        return None
+
+
+def count_tokens(text: str, model: str) -> int:
+    encoding = _encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def count_message_tokens(messages: List[Dict[str, str]], model: str) -> int:
+    """Prompt tokens of a chat request (message contents plus per-message overhead)."""
+    return sum(count_tokens(m["content"], model) + TOKENS_PER_MESSAGE for m in messages) + 3
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str) -> str:
+    """Cuts `text` to at most `max_tokens`, backing off to the last whitespace."""
+    encoding = _encoding(model)
+    if encoding is not None:
+        tokens = encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        cut = encoding.decode(tokens[:max_tokens])
+    else:
+        if len(text) <= max_tokens * CHARS_PER_TOKEN:
+            return text
+        cut = text[: max_tokens * CHARS_PER_TOKEN]
+    space = cut.rfind(" ")
+    return (cut[:space] if space > len(cut) // 2 else cut).rstrip() + " ..."
+
+
+def strip_markup(text: str) -> str:
+    """Plain text of an HTML or markdown passage, with whitespace collapsed."""
+    if HTML_TAG_RE.search(text):
+        text = html_to_text(HTML_COMMENT_RE.sub("", text))
+    text = MARKDOWN_IMAGE_RE.sub(r"\1", text)
+    text = SPACES_RE.sub(" ", text)
+    return BLANK_LINES_RE.sub("\n\n", text).strip()
+
+
+def shingles(text: str) -> Set[tuple]:
+    words = WORD_RE.findall(text.lower())
+    if len(words) < SHINGLE_WORDS:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+
+def duplicate_of(candidate: Set[tuple], kept: List[Set[tuple]]) -> Optional[int]:
+    """Index of the kept passage `candidate` near-duplicates, if any."""
+    if not candidate:
+        return None
+    for i, other in enumerate(kept):
+        if not other:
+            continue
+        overlap = len(candidate & other)
+        if overlap / len(candidate | other) >= NEAR_DUPLICATE_JACCARD or overlap / len(candidate) >= NEAR_DUPLICATE_CONTAINMENT:
+            return i
+    return None
+
+
+def build_context(passages: List[Dict], budget_tokens: int, model: str) -> Dict:
+    """
+    Returns {"text": context for the prompt, "passages": packed passages (best first, each with
+    "tokens" and merged "links"), "stats": {...}}. Passages that are empty after stripping markup,
+    duplicates and passages beyond the budget are left out.
+    """
+    cleaned = []
+    tokens_in = 0
+    for passage in passages:
+        text = strip_markup(passage.get("text") or "")
+        tokens_in += count_tokens(passage.get("text") or "", model)
+        if text:
+            cleaned.append({**passage, "text": text, "links": list(passage.get("links") or [])})
+    cleaned.sort(key=lambda p: p.get("score", 0.0), reverse=True)
+
+    unique: List[Dict] = []
+    unique_shingles: List[Set[tuple]] = []
+    duplicates = 0
+    for passage in cleaned:
+        passage_shingles = shingles(passage["text"])
+        match = duplicate_of(passage_shingles, unique_shingles)
+        if match is not None:
+            duplicates += 1
+            unique[match]["links"].extend(passage["links"])
+            continue
+        unique.append(passage)
+        unique_shingles.append(passage_shingles)
+
+    packed = []
+    used = 0
+    over_budget = 0
+    separator_tokens = count_tokens("\n\n", model)
+    for passage in unique:
+        room = budget_tokens - used - (separator_tokens if packed else 0)
+        if passage.get("max_tokens") is not None:
+            room = min(room, passage["max_tokens"])
+        tokens = count_tokens(passage["text"], model)
+        if tokens > room:
+            if room < MIN_TRUNCATED_TOKENS and packed:
+                over_budget += 1
+                continue
+            passage = {**passage, "text": truncate_to_tokens(passage["text"], max(room - 2, 1), model), "truncated": True}
+            tokens = count_tokens(passage["text"], model)
+        packed.append({**passage, "tokens": tokens})
+        used += tokens + (separator_tokens if len(packed) > 1 else 0)
+
+    return {
+        "text": "\n\n".join(p["text"] for p in packed),
+        "passages": packed,
+        "stats": {
+            "passages": len(passages),
+            "packed": len(packed),
+            "duplicates": duplicates,
+            "over_budget": over_budget,
+            "tokens_in": tokens_in,
+            "tokens": used,
+        },
+    }
@@ -0,0 +1,81 @@
+"""
+Reading the scraped corpora (3_all_course_data.json, 4_discourse_posts_2025.json) into documents,
+and splitting them into the units that get embedded and indexed.
+"""
+import json
+
+from chunking import chunk_html, chunk_markdown, CHUNK_WORDS, CHUNK_OVERLAP_WORDS
+from text_processing import course_page_url, discourse_topic_url, ingest_fields
+
+# Only used with --no-chunk: limit text size to avoid token overflow
+MAX_TOKENS = 512
+
+def truncate_text(text, max_tokens=MAX_TOKENS):
+    return " ".join(text.split()[:max_tokens])
+
+def load_json(filepath):
+    with open(filepath, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+# --- Corpus readers: yield {"source_name", "content", "url"} per document ---
+
+def iter_course_docs(data):
+    """all_course_data.json is {filename: markdown}."""
+    for filename, content in data.items():
+        yield {"source_name": filename, "content": content, "url": course_page_url(filename)}
+
+def iter_discourse_docs(data):
+    """discourse_posts_2025.json is a list of threads, each with a list of posts."""
+    for thread in data:
+        thread_title = thread.get("title", "untitled_thread")
+        for i, post in enumerate(thread.get("posts", [])):
+            # Create a unique key for storage, e.g., thread_title + post number
+            yield {
+                "source_name": f"{thread_title}_post_{i}",
+                "content": post.get("content_html", ""),
+                "url": discourse_topic_url(thread.get("id")),
+            }
+
+DOC_READERS = {
+    "course": iter_course_docs,
+    "discourse": iter_discourse_docs,
+}
+
+# Markdown is split at headings, Discourse HTML at paragraphs
+CHUNKERS = {
+    "course": chunk_markdown,
+    "discourse": chunk_html,
+}
+
+# Corpora whose content is HTML; their stored "text" is the HTML stripped to plain text
+HTML_CORPORA = {"discourse"}
+
+def split_docs(corpus, docs, chunk_words=CHUNK_WORDS, overlap=CHUNK_OVERLAP_WORDS, chunk=True):
+    """
+    Turns documents into embedding units. Each chunk keeps its parent's source_name and url,
+    gets its own key "<source_name>#<n>", and has "content" (stored), "text" (embedded and used
+    in prompts) and the "links" found in its content.
+    """
+    html = corpus in HTML_CORPORA
+    for doc in docs:
+        if not doc["content"]:
+            continue
+        if not chunk:
+            fields = ingest_fields(doc["source_name"], doc["content"], doc["url"], html=html)
+            yield {**doc, **fields, "key": doc["source_name"], "embed_text": truncate_text(fields["text"])}
+            continue
+        for i, piece in enumerate(CHUNKERS[corpus](doc["content"], chunk_words, overlap)):
+            chunk_id = f"{doc['source_name']}#{i}"
+            yield {
+                "key": chunk_id,
+                "source_name": doc["source_name"],
+                "chunk_id": chunk_id,
+                "chunk_index": i,
+                "content": piece["content"],
+                **ingest_fields(doc["source_name"], piece["content"], doc["url"], text=piece["text"]),
+            }
+
+def load_units(corpus, input_path, chunk_words=CHUNK_WORDS, overlap=CHUNK_OVERLAP_WORDS, chunk=True):
+    """All units of one corpus file, as split_docs produces them."""
+    docs = DOC_READERS[corpus](load_json(input_path))
+    return list(split_docs(corpus, docs, chunk_words, overlap, chunk))
@@ -0,0 +1,230 @@
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Host parameters per statement, below SQLite's default limit
+SQLITE_BATCH = 500
+
+
+def normalize_text(text: str) -> str:
+    """Case-folds and collapses whitespace so trivially different questions share a cache entry."""
+    return " ".join(text.split()).casefold()
+
+
+def text_key(model: str, text: str) -> str:
+    return f"{model}:text:{hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()}"
+
+
+def image_key(model: str, image_data: str) -> str:
+    return f"{model}:image:{hashlib.sha256(image_data.encode('utf-8')).hexdigest()}"
+
+
+class SQLiteEmbeddingStore:
+    """
+    Persistent key -> embedding table. Vectors are stored as float32 blobs.
+    WAL mode lets several uvicorn workers read and write the same file.
+
+    The embedding job also records which keys each output store references (`set_refs`), so
+    entries no corpus uses any more can be dropped with `collect_garbage`.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=5.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY,"
+            " embedding BLOB NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS refs ("
+            " owner TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " PRIMARY KEY (owner, key))"
+        )
+        self._conn.commit()
+
+    def get(self, key: str, max_age: Optional[float] = None) -> Optional[List[float]]:
+        with self._lock:
+            row = self._conn.execute("SELECT embedding, created_at FROM embeddings WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        blob, created_at = row
+        if max_age is not None and time.time() - created_at > max_age:
+            return None
+        return array("f", blob).tolist()
+
+    def set(self, key: str, embedding: List[float]) -> None:
+        blob = array("f", embedding).tobytes()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO embeddings (key, embedding, created_at) VALUES (?, ?, ?)",
+                (key, blob, time.time()),
+            )
+            self._conn.commit()
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, List[float]]:
+        """Embeddings of the keys that are stored (no age limit)."""
+        keys = list(keys)
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), SQLITE_BATCH):
+                batch = keys[start:start + SQLITE_BATCH]
+                rows = self._conn.execute(
+                    f"SELECT key, embedding FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                found.update((key, array("f", blob).tolist()) for key, blob in rows)
+        return found
+
+    def set_many(self, embeddings: Dict[str, List[float]]) -> None:
+        now = time.time()
+        rows = [(key, array("f", embedding).tobytes(), now) for key, embedding in embeddings.items() if embedding]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings (key, embedding, created_at) VALUES (?, ?, ?)", rows)
+            self._conn.commit()
+
+    def set_refs(self, owner: str, keys: Iterable[str]) -> None:
+        """Replaces the set of keys `owner` (e.g. an output store) uses."""
+        with self._lock:
+            self._conn.execute("DELETE FROM refs WHERE owner = ?", (owner,))
+            self._conn.executemany("INSERT OR IGNORE INTO refs (owner, key) VALUES (?, ?)", ((owner, key) for key in keys))
+            self._conn.commit()
+
+    def collect_garbage(self, prefix: str = "") -> int:
+        """Deletes entries whose key starts with `prefix` and that no owner references. Returns the count."""
+        with self._lock:
+            deleted = self._conn.execute(
+                "DELETE FROM embeddings WHERE substr(key, 1, ?) = ? AND key NOT IN (SELECT key FROM refs)",
+                (len(prefix), prefix),
+            ).rowcount
+            self._conn.commit()
+        return deleted
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(embedding)), 0) FROM embeddings").fetchone()
+            referenced = self._conn.execute("SELECT COUNT(DISTINCT key) FROM refs").fetchone()[0]
+        return {"entries": entries, "referenced": referenced, "vector_bytes": size}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class EmbeddingCache:
+    """
+    Size-bounded LRU cache with a TTL for question/image embeddings,
+    optionally backed by a SQLiteEmbeddingStore so warm entries survive restarts.
+
+    On the event loop use aget/aset: the SQLite tier is shared with other workers and a read or
+    commit can wait on their locks, so it runs in a worker thread (writes are not waited for).
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 7 * 24 * 3600, disk_path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.disk = SQLiteEmbeddingStore(disk_path) if disk_path else None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[List[float]]:
+        embedding = self._get_memory(key)
+        if embedding is None:
+            embedding = self._get_disk(key)
+        return embedding
+
+    async def aget(self, key: str) -> Optional[List[float]]:
+        """get() for the event loop: the memory tier inline, the SQLite tier in a worker thread."""
+        embedding = self._get_memory(key)
+        if embedding is None:
+            if self.disk is None:
+                return self._get_disk(key)
+            embedding = await asyncio.get_running_loop().run_in_executor(None, self._get_disk, key)
+        return embedding
+
+    def set(self, key: str, embedding: List[float]) -> None:
+        if not embedding:
+            return
+        self._remember(key, embedding, time.time())
+        if self.disk is not None:
+            self._persist(key, embedding)
+
+    async def aset(self, key: str, embedding: List[float]) -> None:
+        """set() for the event loop: stored in memory now, written to SQLite in the background."""
+        if not embedding:
+            return
+        self._remember(key, embedding, time.time())
+        if self.disk is not None:
+            asyncio.get_running_loop().run_in_executor(None, self._persist, key, embedding)
+
+    def _get_memory(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, embedding = entry
+                if time.time() - stored_at <= self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return embedding
+                del self._entries[key]
+        return None
+
+    def _get_disk(self, key: str) -> Optional[List[float]]:
+        """Looks the key up in the SQLite tier (if any), counting the miss when it is not there either."""
+        if self.disk is not None:
+            try:
+                embedding = self.disk.get(key, max_age=self.ttl_seconds)
+            except sqlite3.Error as e:
+                logger.warning("embedding_lookup_failed path=%s error=%r", self.disk.path, e)
+                embedding = None
+            if embedding is not None:
+                self._remember(key, embedding, time.time())
+                with self._lock:
+                    self.disk_hits += 1
+                return embedding
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _persist(self, key: str, embedding: List[float]) -> None:
+        try:
+            self.disk.set(key, embedding)
+        except sqlite3.Error as e:
+            logger.warning("embedding_persist_failed path=%s error=%r", self.disk.path, e)
+
+    def _remember(self, key: str, embedding: List[float], stored_at: float) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (stored_at, embedding)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,266 @@
+"""
+Compact on-disk format for embedded corpora.
+
+A store with prefix `6_embedded_data_768` is two files:
+  6_embedded_data_768.npy         float32 (or float16) matrix, one row per document, memory-mappable
+  6_embedded_data_768.meta.jsonl  one JSON object per row, in row order:
+                                  {"source_name": ..., "content": ..., "url": ...}
+
+Rows written by 5_embedding_768.py also carry the fields the API needs at query time
+("text" without markup, "links" found in the content, canonical "url"). Add them to an
+older store without re-embedding with:
+  python embedding_store.py enrich 6_embedded_data_768
+  python embedding_store.py enrich 7_embedded_discourse_768 --html
+
+Convert an existing embedded JSON file with:
+  python embedding_store.py convert 6_embedded_data_768.json [--float16]
+
+Quantized copies for the in-process index are written next to the store and searched instead of
+the full matrix (see vector_index.py), while the float32 matrix stays on disk for re-ranking:
+  python embedding_store.py quantize 6_embedded_data_768 [--kind int8|float16]
+    -> 6_embedded_data_768.int8.npy (int8 codes) + 6_embedded_data_768.int8.scales.npy (float32, one per row)
+    -> 6_embedded_data_768.float16.npy
+"""
+import argparse
+import json
+import os
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from text_processing import ingest_fields
+
+MATRIX_SUFFIX = ".npy"
+METADATA_SUFFIX = ".meta.jsonl"
+QUANTIZATION_KINDS = ("int8", "float16")
+
+
+def store_prefix(path: str) -> str:
+    """Accepts a prefix or any of the store/JSON file names and returns the bare prefix."""
+    for suffix in (METADATA_SUFFIX, MATRIX_SUFFIX, ".json"):
+        if path.endswith(suffix):
+            return path[: -len(suffix)]
+    return path
+
+
+def store_exists(prefix: str) -> bool:
+    prefix = store_prefix(prefix)
+    return os.path.exists(prefix + MATRIX_SUFFIX) and os.path.exists(prefix + METADATA_SUFFIX)
+
+
+def write_store(prefix: str, metadata: Sequence[Dict], embeddings, dtype: str = "float32") -> None:
+    """
+    Writes the matrix and metadata side by side. Both are written to temporary
+    files first and renamed, so readers never see a half-written store.
+    """
+    prefix = store_prefix(prefix)
+    matrix = np.asarray(embeddings, dtype=np.dtype(dtype))
+    if matrix.ndim != 2 or matrix.shape[0] != len(metadata):
+        raise ValueError("embeddings must be a 2-D matrix with one row per metadata entry")
+
+    tmp_matrix = prefix + ".tmp" + MATRIX_SUFFIX
+    tmp_metadata = prefix + ".tmp" + METADATA_SUFFIX
+    np.save(tmp_matrix, matrix)
+    with open(tmp_metadata, "w", encoding="utf-8") as f:
+        for record in metadata:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    os.replace(tmp_matrix, prefix + MATRIX_SUFFIX)
+    os.replace(tmp_metadata, prefix + METADATA_SUFFIX)
+
+
+def read_metadata(prefix: str) -> List[Dict]:
+    with open(store_prefix(prefix) + METADATA_SUFFIX, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def read_store(prefix: str, mmap: bool = True) -> Tuple[np.ndarray, List[Dict]]:
+    """Returns (matrix, metadata). With mmap=True the matrix is mapped read-only instead of read into memory."""
+    prefix = store_prefix(prefix)
+    matrix = np.load(prefix + MATRIX_SUFFIX, mmap_mode="r" if mmap else None)
+    metadata = read_metadata(prefix)
+    if matrix.shape[0] != len(metadata):
+        raise ValueError(f"{prefix}: {matrix.shape[0]} vectors but {len(metadata)} metadata rows")
+    return matrix, metadata
+
+
+def records_from_json(data: Dict[str, Dict]) -> Tuple[List[Dict], List[List[float]]]:
+    """
+    Splits the legacy {source_name: {"content" | "content_html": ..., "embedding": [...]}} layout
+    into metadata rows and vectors. Entries without an embedding are dropped.
+    """
+    metadata = []
+    vectors = []
+    for source_name, item in data.items():
+        embedding = item.get("embedding")
+        if not embedding:
+            continue
+        record = {"source_name": source_name, "content": item.get("content") or item.get("content_html") or ""}
+        for field, value in item.items():
+            if field not in ("content", "content_html", "embedding", "error"):
+                record[field] = value
+        metadata.append(record)
+        vectors.append(embedding)
+    return metadata, vectors
+
+
+def load_corpus(path: str, mmap: bool = True) -> Tuple[np.ndarray, List[Dict]]:
+    """
+    Loads an embedded corpus from a binary store if one exists for `path`,
+    otherwise from the legacy `<prefix>.json` file.
+    """
+    prefix = store_prefix(path)
+    if store_exists(prefix):
+        return read_store(prefix, mmap=mmap)
+    json_path = path if path.endswith(".json") else prefix + ".json"
+    with open(json_path, "r", encoding="utf-8") as f:
+        metadata, vectors = records_from_json(json.load(f))
+    return np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1), metadata
+
+
+def corpus_version(paths: Sequence[str]) -> str:
+    """
+    Cheap fingerprint of the corpora at `paths` (file sizes and modification times).
+    Changes whenever a store or legacy JSON file is rewritten, i.e. after a re-ingest.
+    """
+    parts = []
+    for path in paths:
+        prefix = store_prefix(path)
+        files = [prefix + MATRIX_SUFFIX, prefix + METADATA_SUFFIX] if store_exists(prefix) else [prefix + ".json"]
+        for file in files:
+            try:
+                stat = os.stat(file)
+            except OSError:
+                continue
+            parts.append(f"{os.path.basename(file)}:{stat.st_size}:{stat.st_mtime_ns}")
+    return ",".join(parts)
+
+
+def normalize_rows(matrix) -> np.ndarray:
+    """Float32 copy of `matrix` with unit-length rows (zero rows stay zero)."""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def quantize_int8(matrix) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Symmetric per-row int8 quantization: row ~= codes * scale, with scale = max|row| / 127.
+    Returns (codes int8 [n, d], scales float32 [n]).
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    scales = np.abs(matrix).max(axis=1) / 127.0 if matrix.size else np.zeros(len(matrix), dtype=np.float32)
+    safe = np.where(scales == 0, 1.0, scales)[:, None]
+    codes = np.clip(np.rint(matrix / safe), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def quantize(matrix, kind: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """Returns (codes, per-row scales or None) for `kind` in QUANTIZATION_KINDS."""
+    if kind == "int8":
+        return quantize_int8(matrix)
+    if kind == "float16":
+        return np.asarray(matrix, dtype=np.float16), None
+    raise ValueError(f"Unknown quantization '{kind}', expected one of {QUANTIZATION_KINDS}")
+
+
+def quantized_paths(prefix: str, kind: str) -> Tuple[str, Optional[str]]:
+    prefix = store_prefix(prefix)
+    return prefix + f".{kind}" + MATRIX_SUFFIX, (prefix + f".{kind}.scales" + MATRIX_SUFFIX if kind == "int8" else None)
+
+
+def write_quantized(prefix: str, kind: str) -> Tuple[str, int]:
+    """Quantizes the (unit-normalized) rows of the store at `prefix`. Returns (codes path, bytes written)."""
+    matrix, _ = read_store(prefix)
+    codes, scales = quantize(normalize_rows(matrix), kind)
+    codes_path, scales_path = quantized_paths(prefix, kind)
+    written = 0
+    for path, array in ((codes_path, codes), (scales_path, scales)):
+        if path is None:
+            continue
+        tmp_path = path[: -len(MATRIX_SUFFIX)] + ".tmp" + MATRIX_SUFFIX
+        np.save(tmp_path, array)
+        os.replace(tmp_path, path)
+        written += os.path.getsize(path)
+    return codes_path, written
+
+
+def read_quantized(prefix: str, kind: str) -> Optional[Tuple[np.ndarray, Optional[np.ndarray]]]:
+    """
+    Memory-maps the quantized copy of the store at `prefix`. Returns None when there is none,
+    or when it is older than the store or has a different row count (the store was rewritten).
+    """
+    prefix = store_prefix(prefix)
+    codes_path, scales_path = quantized_paths(prefix, kind)
+    paths = [p for p in (codes_path, scales_path) if p]
+    if not store_exists(prefix) or not all(os.path.exists(p) for p in paths):
+        return None
+    store_mtime = os.path.getmtime(prefix + MATRIX_SUFFIX)
+    if any(os.path.getmtime(p) < store_mtime for p in paths):
+        return None
+    codes = np.load(codes_path, mmap_mode="r")
+    scales = np.load(scales_path, mmap_mode="r") if scales_path else None
+    rows = np.load(prefix + MATRIX_SUFFIX, mmap_mode="r").shape[0]
+    if codes.shape[0] != rows or (scales is not None and scales.shape[0] != rows):
+        return None
+    return codes, scales
+
+
+def iter_records(path: str) -> Iterator[Dict]:
+    """Yields {"source_name", "content", ..., "embedding": [floats]} dicts, e.g. for uploading."""
+    matrix, metadata = load_corpus(path)
+    for row, record in zip(matrix, metadata):
+        yield {**record, "embedding": row.astype(np.float32).tolist()}
+
+
+def convert_json(json_path: str, prefix: Optional[str] = None, dtype: str = "float32") -> str:
+    with open(json_path, "r", encoding="utf-8") as f:
+        metadata, vectors = records_from_json(json.load(f))
+    prefix = store_prefix(prefix or json_path)
+    write_store(prefix, metadata, vectors, dtype=dtype)
+    return prefix
+
+
+def enrich_store(prefix: str, html: bool = False) -> int:
+    """Recomputes the ingest-time fields (text, links, url) of every row. Returns the row count."""
+    matrix, metadata = read_store(prefix, mmap=False)
+    for record in metadata:
+        record.update(ingest_fields(record["source_name"], record.get("content", ""), record.get("url"), html=html))
+    write_store(prefix, metadata, matrix, dtype=matrix.dtype.name)
+    return len(metadata)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert, enrich or quantize embedding stores.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    convert = subparsers.add_parser("convert", help="Convert embedded JSON file(s) to .npy + .meta.jsonl")
+    convert.add_argument("json_files", nargs="+")
+    convert.add_argument("--float16", action="store_true", help="Store vectors as float16 (half the size)")
+    enrich = subparsers.add_parser("enrich", help="Add plain text, links and canonical url to existing store rows")
+    enrich.add_argument("prefixes", nargs="+")
+    enrich.add_argument("--html", action="store_true", help="Content is HTML (Discourse posts)")
+    quantize_cmd = subparsers.add_parser("quantize", help="Write an int8 or float16 copy of store(s) for the in-process index")
+    quantize_cmd.add_argument("prefixes", nargs="+")
+    quantize_cmd.add_argument("--kind", choices=QUANTIZATION_KINDS, default="int8")
+    args = parser.parse_args()
+
+    if args.command == "enrich":
+        for prefix in args.prefixes:
+            print(f" {store_prefix(prefix)}: enriched {enrich_store(prefix, html=args.html)} rows")
+        return
+
+    if args.command == "quantize":
+        for prefix in args.prefixes:
+            codes_path, written = write_quantized(prefix, args.kind)
+            full_size = os.path.getsize(store_prefix(prefix) + MATRIX_SUFFIX)
+            print(f" {store_prefix(prefix)}{MATRIX_SUFFIX} ({full_size:,} bytes) -> {codes_path} ({written:,} bytes)")
+        return
+
+    for json_path in args.json_files:
+        prefix = convert_json(json_path, dtype="float16" if args.float16 else "float32")
+        matrix_size = os.path.getsize(prefix + MATRIX_SUFFIX)
+        print(f" {json_path} ({os.path.getsize(json_path):,} bytes) -> {prefix}{MATRIX_SUFFIX} ({matrix_size:,} bytes) + {prefix}{METADATA_SUFFIX}")
+
+
+if __name__ == "__main__":
+    main()
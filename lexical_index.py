@@ -0,0 +1,128 @@
+import logging
+import math
+import re
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import corpus
+
+logger = logging.getLogger(__name__)
+
+# Keeps compound tokens such as "gpt-3.5-turbo", "docker-compose" or "ga4" whole (their parts are indexed too)
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:[._\-][a-z0-9]+)*")
+SPLIT_RE = re.compile(r"[._\-]")
+STOPWORDS = frozenset("""
+a an and are as at be but by can do does for from had has have how i if in is it its me my no not of on or
+our should so that the their them then there these they this to was we were what when where which who why
+will with would you your
+""".split())
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for token in TOKEN_RE.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        tokens.append(token)
+        if SPLIT_RE.search(token):
+            tokens.extend(part for part in SPLIT_RE.split(token) if part and part not in STOPWORDS)
+    return tokens
+
+
+class BM25Index:
+    """
+    In-memory inverted index with Okapi BM25 scoring. Each posting list stores the precomputed
+    BM25 weight of the term in every doc containing it, so a query is a few scatter-adds.
+    Docs are the same units the embedding job produces ({"source_name", "chunk_id", "content",
+    "text", "links", "url"}), and results keep those fields like vector search results do.
+    """
+
+    def __init__(self, docs: List[Dict], k1: float = 1.2, b: float = 0.75):
+        self.docs = docs
+        self.k1 = k1
+        n_docs = len(docs)
+        term_freqs = [Counter(tokenize(doc.get("text") or doc.get("content") or "")) for doc in docs]
+        lengths = np.array([sum(tf.values()) for tf in term_freqs], dtype=np.float32)
+        avg_length = float(lengths.mean()) if n_docs else 0.0
+
+        postings: Dict[str, Tuple[List[int], List[int]]] = {}
+        for doc_id, tf in enumerate(term_freqs):
+            for term, count in tf.items():
+                ids, counts = postings.setdefault(term, ([], []))
+                ids.append(doc_id)
+                counts.append(count)
+
+        self.idf: Dict[str, float] = {}
+        self.postings: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        for term, (ids, counts) in postings.items():
+            idf = self._idf(len(ids), n_docs)
+            ids_array = np.array(ids, dtype=np.int32)
+            tf_array = np.array(counts, dtype=np.float32)
+            norm = k1 * (1 - b + b * lengths[ids_array] / avg_length) if avg_length else k1
+            self.idf[term] = idf
+            self.postings[term] = (ids_array, (idf * tf_array * (k1 + 1) / (tf_array + norm)).astype(np.float32))
+
+    @staticmethod
+    def _idf(doc_freq: int, n_docs: int) -> float:
+        return math.log(1 + (n_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    @classmethod
+    def from_corpora(cls, paths: Dict[str, str]) -> "BM25Index":
+        """Builds the index from scraped corpus files, e.g. {"course": "3_all_course_data.json", ...}."""
+        docs = []
+        for name, path in paths.items():
+            try:
+                docs.extend(corpus.load_units(name, path))
+            except FileNotFoundError:
+                logger.warning("corpus_file_missing path=%s", path)
+        return cls(docs)
+
+    def search(self, query: str, k: int = 10) -> Tuple[List[Dict], float]:
+        """
+        Returns the top-k docs ({**doc, "score": bm25}) and a confidence in [0, 1): the top score
+        divided by the best score any doc could reach for these query terms. Query terms that are
+        not in the index count against the confidence.
+        """
+        terms = set(tokenize(query))
+        if not terms or not self.docs:
+            return [], 0.0
+        scores = np.zeros(len(self.docs), dtype=np.float32)
+        max_score = 0.0
+        for term in terms:
+            max_score += self.idf.get(term, self._idf(0, len(self.docs))) * (self.k1 + 1)
+            posting = self.postings.get(term)
+            if posting is not None:
+                # Doc ids are unique within a posting list, so plain fancy-index addition is safe
+                scores[posting[0]] += posting[1]
+
+        k = min(k, len(self.docs))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        results = [{**self.docs[i], "score": float(scores[i])} for i in top if scores[i] > 0]
+        confidence = results[0]["score"] / max_score if results and max_score else 0.0
+        return results, confidence
+
+
+def reciprocal_rank_fusion(rankings: Sequence[List[Dict]], key: Callable[[Dict], Optional[str]], k: int = 60) -> List[Dict]:
+    """
+    Merges ranked result lists: each doc scores sum(1 / (k + rank)) over the lists it appears in.
+    Docs are identified by key(doc); the first list's copy of a doc is kept.
+    """
+    scores: Dict[str, float] = {}
+    docs: Dict[str, Dict] = {}
+    for ranking in rankings:
+        seen = set()
+        for rank, doc in enumerate(ranking, start=1):
+            doc_key = key(doc)
+            if doc_key is None or doc_key in seen:
+                continue
+            seen.add(doc_key)
+            scores[doc_key] = scores.get(doc_key, 0.0) + 1.0 / (k + rank)
+            docs.setdefault(doc_key, doc)
+    ordered = sorted(scores, key=scores.get, reverse=True)
+    return [{**docs[doc_key], "rrf_score": scores[doc_key]} for doc_key in ordered]
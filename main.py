@@ -1,28 +1,41 @@
 from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Tuple
+from contextlib import asynccontextmanager
+import asyncio
+import importlib.util
 import httpx
 from supabase import create_client
 import os
 import json
-from bs4 import BeautifulSoup
-import re
+import logging
+import time
 from fastapi.middleware.cors import CORSMiddleware # Import CORS middleware 
+from vector_index import VectorIndex
+from ann_index import IVFIndex
+from lexical_index import BM25Index, reciprocal_rank_fusion
+import embedding_cache
+from page_cache import PageCache
+from answer_cache import AnswerCache, answer_context
+from singleflight import SingleFlight
+import embedding_store
+from text_processing import ABSOLUTE_URL_RE, course_page_url, extract_links_from_html, parse_page
+import metrics
+from metrics import Counter, Histogram, span
+from context_builder import build_context, count_message_tokens
+from resilience import CircuitOpenError, Upstream
+from offload import BoundedExecutor, PoolSaturated
 
-app = FastAPI()
-
-# Allow requests from ANY origin
-origins = [
-    "*"
-]
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=origins,
-    allow_credentials=True, # Allow cookies/authentication headers to be sent
-    allow_methods=["*"],    # Allow all HTTP methods (GET, POST, PUT, DELETE, etc.)
-    allow_headers=["*"],    # Allow all HTTP headers
-)
+# --- Logging ---
+# LOG_LEVEL=DEBUG adds per-request details. Messages are "event key=value" lines formatted lazily,
+# so disabled debug calls cost little more than a level check.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s %(message)s")
+logger = logging.getLogger("tds_ta")
+# httpx logs every upstream request at INFO; keep that for LOG_LEVEL=DEBUG only
+if logging.getLogger().getEffectiveLevel() > logging.DEBUG:
+    logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # --- Configuration (Used SUPABASE for embedded data storing) ---
 SUPABASE_URL = os.getenv("SUPABASE_URL")
@@ -34,16 +47,403 @@ if not SUPABASE_KEY:
 
 supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
 
-LLM_API_URL = "https://aipipe.org/openrouter/v1/chat/completions"
+# Both upstream URLs can be pointed at local stubs (see bench/stubs.py)
+LLM_API_URL = os.getenv("LLM_API_URL", "https://aipipe.org/openrouter/v1/chat/completions")
+LLM_MODEL = "openai/gpt-4o-mini"
 LLM_API_TOKEN = os.getenv("LLM_API_TOKEN")
 if not LLM_API_TOKEN:
     raise ValueError("LLM_API_TOKEN environment variable is not set.")
 
-JINA_EMBEDDING_URL = "https://api.jina.ai/v1/embeddings"
+JINA_EMBEDDING_URL = os.getenv("JINA_EMBEDDING_URL", "https://api.jina.ai/v1/embeddings")
+JINA_TEXT_MODEL = "jina-embeddings-v2-base-en"
+JINA_IMAGE_MODEL = "jina-clip-v2"
 JINA_API_TOKEN = os.getenv("JINA_API_TOKEN")
 if not JINA_API_TOKEN:
     raise ValueError("JINA_API_TOKEN environment variable is not set.")
 
+# --- Retrieval backend ---
+# "supabase" queries the match_all_vectors RPC; "numpy" searches the embedded corpora
+# in-process and only falls back to the RPC if the local search fails. Each entry of
+# VECTOR_INDEX_FILES is a binary store prefix (memory-mapped) or a legacy embedded JSON file.
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "supabase").lower()
+VECTOR_INDEX_FILES = os.getenv("VECTOR_INDEX_FILES", "6_embedded_data_768,7_embedded_discourse_768")
+MATCH_THRESHOLD = float(os.getenv("MATCH_THRESHOLD", "0.7"))
+MATCH_COUNT = int(os.getenv("MATCH_COUNT", "2"))
+# "int8" or "float16" scans a quantized copy of the corpus (4x / 2x smaller than float32) and re-scores
+# the best VECTOR_RERANK_CANDIDATES rows with the exact vectors, which stay memory-mapped on disk
+VECTOR_QUANTIZATION = os.getenv("VECTOR_QUANTIZATION", "none").lower()
+VECTOR_RERANK_CANDIDATES = int(os.getenv("VECTOR_RERANK_CANDIDATES", "32"))
+# IVF index built offline with `python ann_index.py build` (unset: exact search). Only the rows in the
+# ANN_NPROBE closest lists are scored; raise it for recall, lower it for latency.
+ANN_INDEX_PATH = os.getenv("ANN_INDEX_PATH", "")
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", "16"))
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def vector_index_paths() -> List[str]:
+    return [os.path.join(BASE_DIR, p.strip()) for p in VECTOR_INDEX_FILES.split(",") if p.strip()]
+
+def load_vector_index() -> Optional[VectorIndex]:
+    """Loads the in-process index when the numpy backend is selected. Returns None otherwise or on failure."""
+    if RETRIEVAL_BACKEND != "numpy":
+        return None
+    try:
+        index = VectorIndex.from_files(vector_index_paths(), VECTOR_QUANTIZATION, VECTOR_RERANK_CANDIDATES)
+    except Exception as e:
+        logger.warning("vector_index_unavailable error=%r backend=supabase", e)
+        return None
+    logger.info("vector_index_loaded docs=%d dims=%d quantization=%s search_bytes=%d",
+                len(index), index.dim, index.quantization, index.search_bytes)
+    if ANN_INDEX_PATH:
+        attach_ann_index(index)
+    return index
+
+def attach_ann_index(index: VectorIndex) -> None:
+    """Switches the index to IVF search; rows embedded since the IVF build are inserted in memory."""
+    path = os.path.join(BASE_DIR, ANN_INDEX_PATH)
+    try:
+        ann = IVFIndex.load(path)
+    except Exception as e:
+        logger.warning("ann_index_unavailable path=%s error=%r search=exact", path, e)
+        return
+    added = index.attach_ann(ann, ANN_NPROBE)
+    if added is None:
+        logger.warning("ann_index_stale path=%s search=exact hint='python ann_index.py build'", path)
+        return
+    logger.info("ann_index_loaded path=%s lists=%d rows=%d inserted=%d nprobe=%d", path, ann.n_lists, len(ann), added, ANN_NPROBE)
+
+vector_index = load_vector_index()
+
+# --- Lexical / hybrid retrieval ---
+# RETRIEVAL_MODE=hybrid also searches an in-memory BM25 index over the scraped course and Discourse
+# files and fuses both rankings (reciprocal rank fusion over HYBRID_CANDIDATES from each side).
+# A text-only question whose lexical match reaches LEXICAL_FAST_PATH_CONFIDENCE is answered from
+# the lexical results alone, without the Jina call or the vector search (set it above 1 to disable).
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "vector").lower()
+LEXICAL_CORPUS_FILES = {
+    "course": os.getenv("LEXICAL_COURSE_FILE", "3_all_course_data.json"),
+    "discourse": os.getenv("LEXICAL_DISCOURSE_FILE", "4_discourse_posts_2025.json"),
+}
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "10"))
+LEXICAL_FAST_PATH_CONFIDENCE = float(os.getenv("LEXICAL_FAST_PATH_CONFIDENCE", "0.75"))
+
+def load_lexical_index() -> Optional[BM25Index]:
+    """Builds the BM25 index in hybrid mode. Returns None otherwise or on failure."""
+    if RETRIEVAL_MODE != "hybrid":
+        return None
+    started = time.perf_counter()
+    try:
+        index = BM25Index.from_corpora({name: os.path.join(BASE_DIR, path) for name, path in LEXICAL_CORPUS_FILES.items()})
+    except Exception as e:
+        logger.warning("lexical_index_unavailable error=%r mode=vector", e)
+        return None
+    logger.info("lexical_index_loaded docs=%d terms=%d seconds=%.2f", len(index), len(index.postings), time.perf_counter() - started)
+    return index
+
+lexical_index = load_lexical_index()
+
+# --- Embedding cache ---
+# Repeated questions/images skip the Jina call. Set EMBEDDING_CACHE_PATH to a SQLite file
+# to keep entries across restarts and share them between uvicorn workers.
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "2048"))
+EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", str(7 * 24 * 3600)))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH") or None
+
+question_embedding_cache = embedding_cache.EmbeddingCache(
+    max_entries=EMBEDDING_CACHE_SIZE,
+    ttl_seconds=EMBEDDING_CACHE_TTL,
+    disk_path=EMBEDDING_CACHE_PATH,
+)
+
+# --- Fetched page cache ---
+# Parsed `url` pages (title, main text, links) are reused until PAGE_CACHE_TTL, then revalidated
+# with ETag/Last-Modified. Redirects and pages without main content are cached for PAGE_CACHE_NEGATIVE_TTL.
+fetched_page_cache = PageCache(
+    max_bytes=int(os.getenv("PAGE_CACHE_MAX_BYTES", str(32 * 1024 * 1024))),
+    ttl_seconds=float(os.getenv("PAGE_CACHE_TTL", "600")),
+    negative_ttl_seconds=float(os.getenv("PAGE_CACHE_NEGATIVE_TTL", "60")),
+)
+
+# --- Semantic answer cache ---
+# A paraphrase of an answered question (same url/image, question embeddings at least
+# ANSWER_CACHE_THRESHOLD cosine-similar) gets the stored answer and links without retrieval
+# or an LLM call. Entries are dropped when the embedding stores are rewritten; when the corpus
+# only lives in Supabase, change ANSWER_CACHE_CORPUS_VERSION after each upload instead.
+ANSWER_CACHE_CORPUS_VERSION = os.getenv("ANSWER_CACHE_CORPUS_VERSION", "")
+
+semantic_answer_cache = AnswerCache(
+    max_entries=int(os.getenv("ANSWER_CACHE_SIZE", "512")),
+    ttl_seconds=float(os.getenv("ANSWER_CACHE_TTL", str(24 * 3600))),
+    threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95")),
+)
+# While the LLM is failing, the closest answered question at least this similar is served instead of an error
+ANSWER_CACHE_FALLBACK_THRESHOLD = float(os.getenv("ANSWER_CACHE_FALLBACK_THRESHOLD", "0.85"))
+
+def corpus_version() -> str:
+    return f"{ANSWER_CACHE_CORPUS_VERSION};{embedding_store.corpus_version(vector_index_paths())}"
+
+# --- Prompt context ---
+# Retrieved passages are stripped of markup, de-duplicated and packed best-first into
+# CONTEXT_TOKEN_BUDGET tokens (counted with tiktoken if installed, else estimated).
+# URL_TEXT_MAX_CHARS only bounds what a fetched page keeps in the page cache.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+# Share of the budget a fetched `url` page may take. A page with content is answered from alone
+# (retrieval is skipped), so this is in effect the size limit of the context of URL prompts
+URL_CONTEXT_SHARE = float(os.getenv("URL_CONTEXT_SHARE", "0.5"))
+URL_TEXT_MAX_CHARS = int(os.getenv("URL_TEXT_MAX_CHARS", "20000"))
+
+# --- Request coalescing ---
+# Concurrent identical requests (same normalized question, url and image) await one shared
+# computation instead of each calling Jina, the vector search and the LLM. "coalesced" in
+# /api/stats counts the requests that were served this way.
+answer_flights = SingleFlight()
+retrieval_flights = SingleFlight()
+
+# --- Batch questions ---
+# /api/batch embeds every question of a batch with multi-input Jina requests (JINA_BATCH_SIZE
+# inputs each), scores them against the in-process index in one pass and answers
+# BATCH_CONCURRENCY items at a time, streaming each result as it finishes.
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+JINA_BATCH_SIZE = int(os.getenv("JINA_BATCH_SIZE", "128"))
+
+# --- Metrics ---
+# Exposed on /metrics. Stage timings go to tds_stage_duration_seconds via metrics.span().
+REQUESTS = Counter("tds_requests_total", "Questions received", ["endpoint"])
+REQUEST_SECONDS = Histogram("tds_request_duration_seconds", "Time to answer a question (until the last SSE event for streams)", ["endpoint"])
+UPSTREAM_ERRORS = Counter("tds_upstream_errors_total", "Failed or timed out upstream calls", ["upstream"])
+FALLBACKS = Counter("tds_fallbacks_total", "Degraded paths taken, e.g. 'I don't know' answers", ["kind"])
+LEXICAL_FAST_PATH = Counter("tds_lexical_fast_path_total", "Questions answered from confident BM25 matches without embedding")
+BATCH_ITEMS = Counter("tds_batch_items_total", "Batch items answered, by outcome", ["outcome"])
+PROMPT_TOKENS = Histogram("tds_prompt_tokens", "Prompt tokens sent to the LLM per question",
+                          buckets=(250, 500, 1000, 1500, 2000, 3000, 4000, 6000, 8000, 12000, 16000))
+
+def cache_metrics():
+    """Cache and coalescing counters, read from the components' own stats at scrape time."""
+    caches = {
+        "embedding": question_embedding_cache.stats(),
+        "page": fetched_page_cache.stats(),
+        "answer": semantic_answer_cache.stats(),
+    }
+    yield "# HELP tds_cache_hits_total Cache lookups answered from the cache"
+    yield "# TYPE tds_cache_hits_total counter"
+    for name, stats in caches.items():
+        yield f'tds_cache_hits_total{{cache="{name}"}} {stats["hits"] + stats.get("disk_hits", 0)}'
+    yield "# HELP tds_cache_misses_total Cache lookups that went upstream"
+    yield "# TYPE tds_cache_misses_total counter"
+    for name, stats in caches.items():
+        yield f'tds_cache_misses_total{{cache="{name}"}} {stats["misses"]}'
+    yield "# HELP tds_coalesced_requests_total Requests that joined an identical in-flight computation"
+    yield "# TYPE tds_coalesced_requests_total counter"
+    for name, flights in (("answer", answer_flights), ("stream_retrieval", retrieval_flights)):
+        yield f'tds_coalesced_requests_total{{flight="{name}"}} {flights.coalesced}'
+
+metrics.register_collector(cache_metrics)
+
+# --- Shared HTTP clients ---
+# One pooled client per upstream, created in the app lifespan so connections (and TLS sessions)
+# are reused across requests instead of being re-established on every call.
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+
+JINA_TIMEOUT = float(os.getenv("JINA_TIMEOUT", "10"))
+JINA_IMAGE_TIMEOUT = float(os.getenv("JINA_IMAGE_TIMEOUT", "15"))
+JINA_BATCH_TIMEOUT = float(os.getenv("JINA_BATCH_TIMEOUT", "30"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))
+URL_FETCH_TIMEOUT = float(os.getenv("URL_FETCH_TIMEOUT", "15"))
+
+# Per-stage deadlines for handle_question (fetch + parse of `url`, embedding + vector search)
+URL_STAGE_DEADLINE = float(os.getenv("URL_STAGE_DEADLINE", "15"))
+RETRIEVAL_STAGE_DEADLINE = float(os.getenv("RETRIEVAL_STAGE_DEADLINE", "20"))
+
+UPSTREAM_CLIENTS = {
+    "jina": {
+        "timeout": max(JINA_TIMEOUT, JINA_IMAGE_TIMEOUT, JINA_BATCH_TIMEOUT),
+        "max_connections": int(os.getenv("JINA_MAX_CONNECTIONS", "20")),
+        "http2": True,
+    },
+    "llm": {
+        "timeout": LLM_TIMEOUT,
+        "max_connections": int(os.getenv("LLM_MAX_CONNECTIONS", "20")),
+        "http2": True,
+    },
+    # Arbitrary user-supplied URLs: many hosts, so a smaller keep-alive pool and plain HTTP/1.1
+    "fetch": {
+        "timeout": URL_FETCH_TIMEOUT,
+        "max_connections": int(os.getenv("URL_FETCH_MAX_CONNECTIONS", "10")),
+        "http2": False,
+    },
+}
+
+http_clients: Dict[str, httpx.AsyncClient] = {}
+
+# --- Upstream resilience ---
+# Jina and LLM calls get latency-derived timeouts (ADAPTIVE_TIMEOUT_MULTIPLIER x p99, within
+# [ADAPTIVE_TIMEOUT_MIN, the static timeout above]), a hedged duplicate after the p95 latency,
+# jittered retries on timeouts/connection errors/429/5xx, and a circuit breaker that fails fast
+# for CIRCUIT_OPEN_SECONDS after CIRCUIT_FAILURE_THRESHOLD consecutive failed calls.
+# The static timeouts remain the total budget of a call, retries included.
+UPSTREAM_MAX_ATTEMPTS = int(os.getenv("UPSTREAM_MAX_ATTEMPTS", "3"))
+UPSTREAM_RETRY_BACKOFF = float(os.getenv("UPSTREAM_RETRY_BACKOFF", "0.1"))
+UPSTREAM_RETRY_BACKOFF_MAX = float(os.getenv("UPSTREAM_RETRY_BACKOFF_MAX", "2"))
+ADAPTIVE_TIMEOUT_MULTIPLIER = float(os.getenv("ADAPTIVE_TIMEOUT_MULTIPLIER", "2"))
+ADAPTIVE_TIMEOUT_MIN = float(os.getenv("ADAPTIVE_TIMEOUT_MIN", "0.5"))
+HEDGE_UPSTREAMS = {name.strip() for name in os.getenv("HEDGE_UPSTREAMS", "jina,jina_image,llm").split(",") if name.strip()}
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", "0.1"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))
+
+def create_upstream(name: str, timeout: float) -> Upstream:
+    return Upstream(
+        name,
+        timeout=timeout,
+        min_timeout=ADAPTIVE_TIMEOUT_MIN,
+        timeout_multiplier=ADAPTIVE_TIMEOUT_MULTIPLIER,
+        hedge=name in HEDGE_UPSTREAMS,
+        hedge_budget=HEDGE_BUDGET,
+        max_attempts=UPSTREAM_MAX_ATTEMPTS,
+        backoff_base=UPSTREAM_RETRY_BACKOFF,
+        backoff_max=UPSTREAM_RETRY_BACKOFF_MAX,
+        failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+        open_seconds=CIRCUIT_OPEN_SECONDS,
+    )
+
+upstreams = {
+    "jina": create_upstream("jina", JINA_TIMEOUT),
+    "jina_image": create_upstream("jina_image", JINA_IMAGE_TIMEOUT),
+    # Multi-input requests of /api/batch: their latencies would skew the single-question timeouts
+    "jina_batch": create_upstream("jina_batch", JINA_BATCH_TIMEOUT),
+    "llm": create_upstream("llm", LLM_TIMEOUT),
+}
+
+def resilience_metrics():
+    """Breaker state and retry/hedge counters per upstream, read at scrape time."""
+    stats = {name: upstream.stats() for name, upstream in upstreams.items()}
+    states = ("closed", "half_open", "open")
+    yield "# HELP tds_upstream_circuit_state 1 for the current circuit breaker state of each upstream"
+    yield "# TYPE tds_upstream_circuit_state gauge"
+    for name, row in stats.items():
+        for state in states:
+            yield f'tds_upstream_circuit_state{{upstream="{name}",state="{state}"}} {int(row["circuit"] == state)}'
+    for key, help_text in (("retries", "Upstream attempts retried after a retryable error"),
+                           ("hedges", "Hedged duplicate upstream requests sent"),
+                           ("hedge_wins", "Hedged duplicates that answered first"),
+                           ("short_circuits", "Upstream calls rejected by an open circuit breaker")):
+        yield f"# HELP tds_upstream_{key}_total {help_text}"
+        yield f"# TYPE tds_upstream_{key}_total counter"
+        for name, row in stats.items():
+            yield f'tds_upstream_{key}_total{{upstream="{name}"}} {row[key]}'
+    yield "# HELP tds_upstream_attempt_timeout_seconds Current adaptive per-attempt timeout"
+    yield "# TYPE tds_upstream_attempt_timeout_seconds gauge"
+    for name, row in stats.items():
+        yield f'tds_upstream_attempt_timeout_seconds{{upstream="{name}"}} {row["attempt_timeout_s"]}'
+
+metrics.register_collector(resilience_metrics)
+
+# --- Blocking work offload ---
+# The vector search (the synchronous Supabase RPC, or the numpy scan) runs in a thread pool and
+# HTML parsing in a process pool, so neither stalls the event loop. When all workers are busy,
+# up to *_QUEUE calls wait for one; beyond that the request gets a 503 with Retry-After instead
+# of queueing behind everything else. PARSE_POOL=thread avoids the extra
+# processes at the cost of parsing holding the GIL.
+OFFLOAD_POOLS = {
+    "search": {
+        "kind": "thread",
+        "workers": int(os.getenv("SEARCH_WORKERS", "8")),
+        "max_queue": int(os.getenv("SEARCH_QUEUE", "64")),
+    },
+    "parse": {
+        "kind": os.getenv("PARSE_POOL", "process").lower(),
+        "workers": int(os.getenv("PARSE_WORKERS", "2")),
+        "max_queue": int(os.getenv("PARSE_QUEUE", "32")),
+    },
+}
+
+offload_pools: Dict[str, BoundedExecutor] = {}
+
+def get_pool(name: str) -> BoundedExecutor:
+    """Returns the executor for a kind of blocking work, creating it if the lifespan has not run."""
+    pool = offload_pools.get(name)
+    if pool is None:
+        pool = offload_pools[name] = BoundedExecutor(name, **OFFLOAD_POOLS[name])
+    return pool
+
+def offload_metrics():
+    """Queue depth, busy workers and rejections of the offload pools, read at scrape time."""
+    stats = {name: pool.stats() for name, pool in offload_pools.items()}
+    for key, kind, help_text in (("queue_depth", "gauge", "Blocking calls waiting for a free worker"),
+                                 ("running", "gauge", "Blocking calls running in the pool"),
+                                 ("rejected", "counter", "Blocking calls rejected because the queue was full")):
+        name = f"tds_offload_{key}" + ("_total" if kind == "counter" else "")
+        yield f"# HELP {name} {help_text}"
+        yield f"# TYPE {name} {kind}"
+        for pool, row in stats.items():
+            yield f'{name}{{pool="{pool}"}} {row[key]}'
+
+metrics.register_collector(offload_metrics)
+
+def create_http_client(name: str) -> httpx.AsyncClient:
+    """Builds the pooled client for one upstream from UPSTREAM_CLIENTS."""
+    config = UPSTREAM_CLIENTS[name]
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(config["timeout"], connect=min(5.0, config["timeout"])),
+        limits=httpx.Limits(
+            max_connections=config["max_connections"],
+            max_keepalive_connections=config["max_connections"],
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        ),
+        http2=config["http2"] and HTTP2_AVAILABLE,
+        follow_redirects=False,
+    )
+
+def get_http_client(name: str) -> httpx.AsyncClient:
+    """Returns the shared client for an upstream, creating it if the lifespan has not run (e.g. in scripts)."""
+    client = http_clients.get(name)
+    if client is None or client.is_closed:
+        client = http_clients[name] = create_http_client(name)
+    return client
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    for name in UPSTREAM_CLIENTS:
+        http_clients[name] = create_http_client(name)
+    logger.info("http_clients_created clients=%s http2=%s", list(http_clients), HTTP2_AVAILABLE)
+    for name in OFFLOAD_POOLS:
+        get_pool(name).warm_up()
+    logger.info("offload_pools_created pools=%s", {name: pool.kind for name, pool in offload_pools.items()})
+    try:
+        yield
+    finally:
+        await asyncio.gather(*(client.aclose() for client in http_clients.values()), return_exceptions=True)
+        http_clients.clear()
+        for pool in offload_pools.values():
+            pool.shutdown()
+        offload_pools.clear()
+
+app = FastAPI(lifespan=lifespan)
+
+@app.exception_handler(PoolSaturated)
+async def pool_saturated_handler(request: Request, exc: PoolSaturated):
+    logger.warning("request_rejected reason=pool_saturated pool=%s path=%s", exc.pool, request.url.path)
+    FALLBACKS.inc(kind="overloaded")
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "1"})
+
+# Allow requests from ANY origin
+origins = [
+    "*"
+]
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=origins,
+    allow_credentials=True, # Allow cookies/authentication headers to be sent
+    allow_methods=["*"],    # Allow all HTTP methods (GET, POST, PUT, DELETE, etc.)
+    allow_headers=["*"],    # Allow all HTTP headers
+)
+
+DONT_KNOW_ANSWER = "Sorry, I don't know the answer to that. This information may not be available yet."
+LLM_ERROR_ANSWER = "Sorry, I couldn't process the answer at this moment due to an internal error."
+
 # --- Pydantic Models ---
 class QueryRequest(BaseModel):
     question: str
@@ -52,52 +452,56 @@ class QueryRequest(BaseModel):
 
 # --- Utility Functions ---
 
-def extract_links_from_html(content_html: str, base_url: Optional[str] = None) -> List[Dict[str, str]]:
-    """
-    Extracts URLs and their corresponding text from HTML content.
-    Handles relative URLs by resolving them against an optional base_url.
-    Find URLs associated with the "answers" or "context" that your API fetches
-    """
-    links = []
-    if content_html:
-        soup = BeautifulSoup(content_html, "html.parser")
-        for a in soup.find_all("a", href=True):
-            href = a['href']
-            text = a.get_text(strip=True) or href
-
-            # Resolve relative URLs
-            if href.startswith('/') and base_url:
-                parsed_base = httpx.URL(base_url)
-                href = str(parsed_base.join(href))
-            elif not re.match(r'^[a-zA-Z]+://', href) and base_url: 
-                parsed_base = httpx.URL(base_url)
-                href = str(parsed_base.join(href))
-            elif not re.match(r'^[a-zA-Z]+://', href):
-                continue 
-
-            links.append({"url": href, "text": text})
-    return links
-
 async def embed_text_with_jina(text: str) -> List[float]:
     """Generates text embeddings of question by API call"""
+    return (await embed_texts_with_jina([text]))[0]
+
+async def embed_texts_with_jina(texts: List[str], upstream: str = "jina") -> List[List[float]]:
+    """
+    Text embeddings for several questions, in order. Cached ones are reused and the rest are sent
+    as multi-input requests of up to JINA_BATCH_SIZE texts (identical texts once).
+    """
     if not JINA_API_TOKEN:
         raise ValueError("JINA_API_TOKEN is not set in the environment")
-    
+
+    keys = [embedding_cache.text_key(JINA_TEXT_MODEL, text) for text in texts]
+    unique = dict(zip(keys, texts))
+    cached = await asyncio.gather(*(question_embedding_cache.aget(key) for key in unique))
+    embeddings: Dict[str, List[float]] = {key: hit for key, hit in zip(unique, cached) if hit is not None}
+    missing: Dict[str, str] = {key: text for (key, text), hit in zip(unique.items(), cached) if hit is None}
+
     headers = {
         "Authorization": f"Bearer {JINA_API_TOKEN}",
         "Content-Type": "application/json"
     }
-    payload = {
-        "input": [text],
-        "model": "jina-embeddings-v2-base-en"
-    }
-    async with httpx.AsyncClient(timeout=10) as client:
-        resp = await client.post(JINA_EMBEDDING_URL, headers=headers, json=payload)
-        resp.raise_for_status()
-        data = resp.json()
-        embedding = data.get("data", [{}])[0].get("embedding", [])
-        print(f"Embedding length: {len(embedding)}")
-        return embedding
+    client = get_http_client("jina")
+
+    async def embed_chunk(chunk_keys: List[str]) -> None:
+        payload = {
+            "input": [missing[key] for key in chunk_keys],
+            "model": JINA_TEXT_MODEL
+        }
+
+        async def request() -> Dict:
+            resp = await client.post(JINA_EMBEDDING_URL, headers=headers, json=payload, timeout=upstreams[upstream].timeout)
+            resp.raise_for_status()
+            return resp.json()
+
+        data = await upstreams[upstream].call(request)
+        rows = sorted(data.get("data", []), key=lambda row: row.get("index", 0))
+        if len(rows) != len(chunk_keys):
+            raise ValueError(f"Jina returned {len(rows)} embeddings for {len(chunk_keys)} inputs")
+        for key, row in zip(chunk_keys, rows):
+            embeddings[key] = row.get("embedding", [])
+            await question_embedding_cache.aset(key, embeddings[key])
+
+    if missing:
+        pending = list(missing)
+        with span("embed_text"):
+            await asyncio.gather(*(embed_chunk(pending[i:i + JINA_BATCH_SIZE])
+                                   for i in range(0, len(pending), max(1, JINA_BATCH_SIZE))))
+        logger.debug("text_embedded texts=%d requested=%d", len(texts), len(missing))
+    return [embeddings[key] for key in keys]
 
 async def embed_image(image_data: str) -> List[float]:
     """Generates image embeddings using Jina API.
@@ -106,199 +510,212 @@ async def embed_image(image_data: str) -> List[float]:
     if not JINA_API_TOKEN:
         raise ValueError("JINA_API_TOKEN is not set in the environment")
 
+    cache_key = embedding_cache.image_key(JINA_IMAGE_MODEL, image_data)
+    cached = await question_embedding_cache.aget(cache_key)
+    if cached is not None:
+        return cached
+
     headers = {
         "Authorization": f"Bearer {JINA_API_TOKEN}",
         "Content-Type": "application/json"
     }
     payload = {
         "input": [image_data],
-        "model": "jina-clip-v2", 
+        "model": JINA_IMAGE_MODEL, 
         "input_type": "image"
     }
-    async with httpx.AsyncClient(timeout=15) as client:
-        resp = await client.post(JINA_EMBEDDING_URL, headers=headers, json=payload)
+    client = get_http_client("jina")
+
+    async def request() -> Dict:
+        resp = await client.post(JINA_EMBEDDING_URL, headers=headers, json=payload, timeout=upstreams["jina_image"].timeout)
         resp.raise_for_status()
-        data = resp.json()
-        embedding = data.get("data", [{}])[0].get("embedding", [])
-        return embedding
-
-async def embed_question_and_image(question: str, image: Optional[str]) -> List[float]:
-    """Combines text and image embeddings. Handles cases where image embedding might fail."""
-    text_emb = await embed_text_with_jina(question)
-    if image:
-        try:
-            image_emb = await embed_image(image)
-            return [(t + i) / 2 for t, i in zip(text_emb, image_emb)]
-        except Exception as e:
-            print(f"WARNING: Image embedding failed: {e}. Proceeding with text embedding only.")
-            return text_emb
-    return text_emb
+        return resp.json()
 
-# --- FastAPI Endpoint ---
+    with span("embed_image"):
+        data = await upstreams["jina_image"].call(request)
+    embedding = data.get("data", [{}])[0].get("embedding", [])
+    await question_embedding_cache.aset(cache_key, embedding)
+    return embedding
 
-@app.post("/api/")
-async def handle_question(request: Request):
+async def embed_question_and_image(question: str, image: Optional[str], text_task: Optional[asyncio.Task] = None) -> List[float]:
     """
-    Handles incoming questions, prioritizing URL-based search, then falling back
-    to vector database search, and finally returning "I don't know" if no answer is found.
+    Combines text and image embeddings, requesting both concurrently.
+    Handles cases where image embedding might fail.
+    text_task, if given, is an already started embed_text_with_jina(question) task to reuse.
     """
-    try:
-        body = await request.json()
-        query = QueryRequest(**body)
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Invalid request body: {str(e)}")
+    # Shielded so that cancelling the retrieval stage leaves the shared task running
+    text_embedding = asyncio.shield(text_task) if text_task is not None else embed_text_with_jina(question)
+    if not image:
+        return await text_embedding
 
-    print("DEBUG: API called with question:", query.question, "URL:", query.url, "Image provided:", query.image is not None)
+    text_emb, image_emb = await asyncio.gather(
+        text_embedding,
+        embed_image(image),
+        return_exceptions=True,
+    )
+    if isinstance(text_emb, BaseException):
+        raise text_emb
+    if isinstance(image_emb, BaseException):
+        logger.warning("image_embedding_failed error=%r fallback=text_only", image_emb)
+        if not isinstance(image_emb, CircuitOpenError):
+            UPSTREAM_ERRORS.inc(upstream="jina_image")
+        FALLBACKS.inc(kind="text_only_embedding")
+        return text_emb
+    return [(t + i) / 2 for t, i in zip(text_emb, image_emb)]
 
-    context_texts = []
-    all_candidate_links = [] # Temporary list to collect all potential links
-    found_meaningful_content = False
-    matched_docs = [] # Initialize matched_docs here to ensure it's always accessible
+def match_documents(embedding: List[float], match_count: int = MATCH_COUNT) -> List[Dict]:
+    """Finds the closest docs, using the in-process index if loaded and the Supabase RPC otherwise."""
+    if vector_index is not None:
+        try:
+            return vector_index.search(embedding, MATCH_THRESHOLD, match_count)
+        except Exception as e:
+            logger.warning("local_vector_search_failed error=%r fallback=supabase_rpc", e)
+            FALLBACKS.inc(kind="supabase_rpc")
 
-    # Track if Discourse content is dominant
-    is_discourse_context_dominant = False
-    
-    # 0. Always add the input URL if provided, as the highest priority link candidate
-    # This ensures the input URL is considered for output links regardless of fetch success
-    if query.url:
-        all_candidate_links.append({"url": query.url, "text": "Provided Source"})
-        if "discourse.onlinedegree.iitm.ac.in" in query.url:
-            is_discourse_context_dominant = True
+    response = supabase.rpc(
+        "match_all_vectors",
+        {
+            "query_embedding": embedding,
+            "match_threshold": MATCH_THRESHOLD,
+            "match_count": match_count
+        }
+    ).execute()
+    return response.data if response and response.data else []
 
-    # 1. Handle explicit URL if provided in the request
-    if query.url:
-        print(f"DEBUG: Attempting to fetch content from provided URL: {query.url}")
-        try:
-            async with httpx.AsyncClient(timeout=15.0, follow_redirects=False) as client:
-                response = await client.get(query.url)
-                
-                if 300 <= response.status_code < 400:
-                    print(f"WARNING: Received redirect status {response.status_code} for URL: {query.url}. Redirect location: {response.headers.get('Location')}. Will not extract content, falling back to DB.")
-                else:
-                    response.raise_for_status() 
+def match_documents_many(embeddings: List[List[float]], match_count: int = MATCH_COUNT) -> List[List[Dict]]:
+    """Closest docs for several embeddings at once; only the in-process index can score a batch."""
+    if vector_index is None:
+        raise RuntimeError("batched vector search needs RETRIEVAL_BACKEND=numpy")
+    return vector_index.search_many(embeddings, MATCH_THRESHOLD, match_count)
 
-                    soup = BeautifulSoup(response.text, "html.parser")
-                    page_title_tag = soup.find("title")
-                    # Update text for the input URL in all_candidate_links if a title is found
-                    for link_obj in all_candidate_links:
-                        if link_obj["url"] == query.url and page_title_tag:
-                            link_obj["text"] = page_title_tag.get_text(strip=True) or "Provided Source"
-                            break
+def retrieval_match_count() -> int:
+    """Vector search results per question: more candidates when they are fused with BM25 ones."""
+    return HYBRID_CANDIDATES if lexical_index is not None else MATCH_COUNT
 
-                    main_content_element = soup.find("article") or soup.find("main") or soup.find(class_=re.compile("post-content|main-content|article-body", re.IGNORECASE))
+class EmbeddingError(Exception):
+    """Raised by the retrieval stage when the question embedding could not be generated."""
 
-                    if main_content_element:
-                        extracted_text = main_content_element.get_text(separator="\n", strip=True)
-                        context_texts.append(extracted_text[:4000])
-                        
-                        # Extract other links from the fetched page's content
-                        for link in extract_links_from_html(str(main_content_element), base_url=query.url):
-                            # Add only if not the query.url itself (to avoid simple duplication)
-                            if link["url"] != query.url: 
-                                all_candidate_links.append(link) 
-                                if "discourse.onlinedegree.iitm.ac.in" in link["url"]:
-                                    is_discourse_context_dominant = True 
-                        
-                        if context_texts and len(context_texts[0]) > 50: 
-                            found_meaningful_content = True
-                        else:
-                            print(f"DEBUG: Extracted content from URL was too short or empty for {query.url}. Falling back to DB.")
-                    else:
-                        print(f"DEBUG: No main content element found on URL: {query.url}. Falling back to DB.")
-        except httpx.RequestError as e:
-            print(f"ERROR: Failed to fetch from URL {query.url}: {e}. Falling back to DB.")
-        except Exception as e:
-            print(f"ERROR: Error processing URL {query.url} content: {e}. Falling back to DB.")
+async def retrieve_documents(question: str, image: Optional[str], text_task: Optional[asyncio.Task] = None,
+                             match_count: int = MATCH_COUNT) -> List[Dict]:
+    """Retrieval stage: embeds the question (and image) and runs the vector search."""
+    try:
+        embedding = await embed_question_and_image(question, image, text_task)
+    except Exception as e:
+        if not isinstance(e, CircuitOpenError):
+            UPSTREAM_ERRORS.inc(upstream="jina")
+        raise EmbeddingError(str(e)) from e
 
-    # 2. Fallback to Supabase/Vector DB if no URL provided OR URL search failed to yield meaningful content
-    if not found_meaningful_content:
-        print("DEBUG: No meaningful content from URL or no URL provided. Querying vector DB.")
-        try:
-            embedding = await embed_question_and_image(query.question, query.image)
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Embedding generation failed: {str(e)}")
+    try:
+        with span("vector_search"):
+            return await get_pool("search").run(match_documents, embedding, match_count)
+    except PoolSaturated:
+        raise
+    except Exception as e:
+        logger.error("vector_search_failed error=%r", e)
+        UPSTREAM_ERRORS.inc(upstream="vector_search")
+        return []
 
-        try:
-            response = supabase.rpc(
-                "match_all_vectors",
-                {
-                    "query_embedding": embedding,
-                    "match_threshold": 0.7,
-                    "match_count": 2
-                }
-            ).execute()
+def lexical_search(question: str) -> Tuple[List[Dict], float]:
+    """BM25 candidates for the question and the confidence of the best one (nothing outside hybrid mode)."""
+    if lexical_index is None:
+        return [], 0.0
+    with span("lexical_search"):
+        return lexical_index.search(question, HYBRID_CANDIDATES)
 
-            matched_docs = response.data if response and response.data else [] # Assign to matched_docs initialized earlier
+def fuse_rankings(vector_docs: List[Dict], lexical_docs: List[Dict]) -> List[Dict]:
+    """Reciprocal rank fusion of vector and lexical results, best first."""
+    # Rows stored before chunking (or in Supabase) may have no chunk_id; match those by source_name
+    if all(doc.get("chunk_id") for doc in vector_docs):
+        key = lambda doc: doc.get("chunk_id") or doc.get("source_name")
+    else:
+        key = lambda doc: doc.get("source_name")
+    return reciprocal_rank_fusion([vector_docs, lexical_docs], key)
 
-            print(f"DEBUG: Found {len(matched_docs)} matched docs from vector DB")
+async def fetch_url_content(url: str) -> Optional[Dict]:
+    """
+    URL stage: fetches the page and extracts its title, main text (first URL_TEXT_MAX_CHARS chars)
+    and outgoing links. Returns None when the page redirects.
+    Results are served from fetched_page_cache while fresh and revalidated once stale.
+    """
+    cached = fetched_page_cache.get(url)
+    if cached is not None and cached.fresh:
+        return cached.page
 
-            if matched_docs and not all(len(doc.get("content", "")) < 50 for doc in matched_docs):
-                for doc in matched_docs[:2]: 
-                    content = doc.get("content", "").strip()
-                    if not content:
-                        continue
-                    context_texts.append(content)
+    client = get_http_client("fetch")
+    with span("url_fetch"):
+        response = await client.get(url, headers=cached.validators() if cached is not None else None)
 
-                    # Mark discourse dominant if any matched doc is from discourse
-                    if "discourse" in doc.get("source_name", "").lower() or \
-                       (doc.get("url") and "discourse.onlinedegree.iitm.ac.in" in doc.get("url")):
-                        is_discourse_context_dominant = True
+    if response.status_code == 304 and cached is not None:
+        fetched_page_cache.refresh(url)
+        return cached.page
 
-                    # Extract links from content
-                    for link in extract_links_from_html(content):
-                        all_candidate_links.append(link)
+    if 300 <= response.status_code < 400:
+        logger.warning("url_redirected status=%d url=%s location=%s fallback=vector_db", response.status_code, url, response.headers.get("Location"))
+        fetched_page_cache.put(url, None, negative=True)
+        return None
+    response.raise_for_status() 
 
-                    source_name = doc.get("source_name", "")
-                    doc_url = doc.get("url") # Canonical URL for the document, if stored
+    with span("html_parse"):
+        page = await get_pool("parse").run(parse_page, response.text, url, URL_TEXT_MAX_CHARS)
 
-                    # Try to derive a specific TDS link from source_name if it looks like a .md file
-                    derived_tds_link = None
-                    if source_name and source_name.endswith(".md"):
-                        base_name = source_name.replace(".md", "").replace("\\", "/").split("/")[-1]
-                        # Ensure base_name is URL-friendly (e.g., lowercase, hyphens) if not already
-                        base_name = base_name.lower().replace(" ", "-") 
-                        derived_tds_link = f"https://tds.s-anand.net/#/{base_name}"
-                    
-                    # Add doc's canonical URL or derived TDS link to candidates
-                    link_to_add_from_doc = None
-                    link_text_from_doc = None
-                    if doc_url and re.match(r'^[a-zA-Z]+://', doc_url):
-                        link_to_add_from_doc = doc_url
-                        link_text_from_doc = source_name or "See source"
-                    elif derived_tds_link:
-                        link_to_add_from_doc = derived_tds_link
-                        link_text_from_doc = source_name or f"See {derived_tds_link.split('/')[-1].replace('-', ' ').title()}" 
-                    
-                    if link_to_add_from_doc:
-                        all_candidate_links.append({"url": link_to_add_from_doc, "text": link_text_from_doc})
+    fetched_page_cache.put(
+        url,
+        page,
+        etag=response.headers.get("ETag"),
+        last_modified=response.headers.get("Last-Modified"),
+        negative=page["text"] is None,
+    )
+    return page
 
+async def cancel_task(task: Optional[asyncio.Task]) -> None:
+    """Cancels a speculative stage that is no longer needed and waits for it to unwind."""
+    if task is None or task.done():
+        return
+    task.cancel()
+    try:
+        await task
+    except BaseException:
+        pass
 
-                if context_texts: 
-                    found_meaningful_content = True
-            else:
-                print("DEBUG: No meaningful documents found from vector DB.")
+def completed(value) -> asyncio.Future:
+    """An already resolved future, standing in for a stage whose result was computed in advance."""
+    future = asyncio.get_running_loop().create_future()
+    future.set_result(value)
+    return future
 
-        except Exception as e:
-            print(f"ERROR: Database query failed: {str(e)}")
+# --- FastAPI Endpoints ---
 
-    # 3. If no meaningful content was found from any source
-    if not found_meaningful_content:
-        print("DEBUG: No meaningful content found from any source. Returning 'I don't know'.")
-        return {
-            "answer": "Sorry, I don't know the answer to that. This information may not be available yet.",
-            "links": []
-        }
+@app.get("/api/stats")
+async def get_stats():
+    """Reports cache counters, e.g. how many Jina calls and page fetches the caches have saved."""
+    return {
+        "embedding_cache": question_embedding_cache.stats(),
+        "page_cache": fetched_page_cache.stats(),
+        "answer_cache": semantic_answer_cache.stats(),
+        "single_flight": {"answers": answer_flights.stats(), "stream_retrievals": retrieval_flights.stats()},
+        "retrieval": {"mode": RETRIEVAL_MODE, "lexical_docs": len(lexical_index) if lexical_index is not None else 0},
+        "upstreams": {name: upstream.stats() for name, upstream in upstreams.items()},
+        "offload": {name: pool.stats() for name, pool in offload_pools.items()},
+    }
 
-    # Prepare context for LLM
-    context_text = "\n\n".join(context_texts)
-    if not context_text.strip():
-        print("DEBUG: Context text ended up empty after processing. Returning 'I don't know'.")
-        return {
-            "answer": "Sorry, I don't know the answer to that. This information may not be available yet.",
-            "links": []
-        }
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus text exposition: stage latency histograms, request/error/fallback counters and cache counters."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
-    # NEW SECTION: Final Link Selection and Prioritization based on Dominant Source
+async def parse_query(request: Request) -> QueryRequest:
+    try:
+        body = await request.json()
+        return QueryRequest(**body)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid request body: {str(e)}")
+
+def select_links(query_url: Optional[str], all_candidate_links: List[Dict[str, str]], context_texts: List[str],
+                 matched_docs: List[Dict], is_discourse_context_dominant: bool) -> List[Dict[str, str]]:
+    """
+    Final link selection: picks up to two links from the candidates, preferring Discourse links
+    when Discourse content dominates the context and course (TDS) pages otherwise.
+    """
     final_links_to_return = []
     seen_urls = set()
 
@@ -306,11 +723,13 @@ async def handle_question(request: Request):
     # This helps ensure if DB returns Discourse, it's considered dominant too.
     if not is_discourse_context_dominant: # Only re-evaluate if not already set by input URL
         discourse_content_found = False
-        # Check `context_texts` for common discourse patterns (less reliable, but indicative)
+        # Check `context_texts` and the links in them for common discourse patterns (less reliable, but indicative)
         for text in context_texts:
             if "discourse.onlinedegree.iitm.ac.in" in text.lower():
                 discourse_content_found = True
                 break
+        if any("discourse.onlinedegree.iitm.ac.in" in link["url"].lower() for link in all_candidate_links):
+            discourse_content_found = True
         if discourse_content_found:
              is_discourse_context_dominant = True
         elif matched_docs: # Re-check if discourse docs were actually part of the matched docs
@@ -323,9 +742,9 @@ async def handle_question(request: Request):
 
     if is_discourse_context_dominant:
         # 1. Prioritize the input Discourse URL if it was provided
-        if query.url and "discourse.onlinedegree.iitm.ac.in" in query.url:
+        if query_url and "discourse.onlinedegree.iitm.ac.in" in query_url:
             for candidate_link in all_candidate_links:
-                if candidate_link["url"] == query.url:
+                if candidate_link["url"] == query_url:
                     final_links_to_return.append(candidate_link)
                     seen_urls.add(candidate_link["url"])
                     break
@@ -374,6 +793,255 @@ async def handle_question(request: Request):
             final_links_to_return.append({"url": "https://tds.s-anand.net/#/2025-01/", "text": "See TDS Knowledge Base"})
             seen_urls.add("https://tds.s-anand.net/#/2025-01/")
 
+    return final_links_to_return
+
+async def prepare_answer(query: QueryRequest, text_embedding: Optional[List[float]] = None,
+                         matched: Optional[List[Dict]] = None) -> Dict:
+    """
+    Runs every stage before the LLM call, prioritizing URL-based search, then falling back
+    to vector database search, then selects the links to return.
+    Returns {"messages": [...], "links": [...], "cache_entry": {...}} for the LLM call, or
+    {"response": {...}} when the answer is already settled ("I don't know" or an answer cache hit).
+    text_embedding and matched, if given, are the question embedding and the vector search results
+    computed in advance (by /api/batch) and replace those stages.
+    """
+    logger.debug("question_received question=%r url=%s image=%s", query.question, query.url, query.image is not None)
+    started = time.monotonic()
+
+    context_texts = []
+    passages = [] # {"text", "score", "links"} per context source, packed into the prompt by build_context
+    all_candidate_links = [] # Temporary list to collect all potential links
+    found_meaningful_content = False
+    matched_docs = [] # Initialize matched_docs here to ensure it's always accessible
+
+    # Track if Discourse content is dominant
+    is_discourse_context_dominant = False
+    
+    # 0. Always add the input URL if provided, as the highest priority link candidate
+    # This ensures the input URL is considered for output links regardless of fetch success
+    if query.url:
+        all_candidate_links.append({"url": query.url, "text": "Provided Source"})
+        if "discourse.onlinedegree.iitm.ac.in" in query.url:
+            is_discourse_context_dominant = True
+
+    # In hybrid mode a confident lexical match for a text-only question skips embedding altogether
+    lexical_docs, lexical_confidence = lexical_search(query.question)
+    lexical_fast_path = bool(lexical_docs) and not query.image and lexical_confidence >= LEXICAL_FAST_PATH_CONFIDENCE
+    if lexical_index is not None:
+        logger.debug("lexical_matched docs=%d confidence=%.2f fast_path=%s", len(lexical_docs), lexical_confidence, lexical_fast_path)
+
+    # Start the retrieval stage (embedding + vector search) and the URL fetch right away. The
+    # retrieval runs speculatively alongside the page fetch and is cancelled if the page alone is enough.
+    # The question embedding is shared with the answer cache lookup.
+    retrieval_started = time.monotonic()
+    question_embedding_task = None
+    retrieval_task = None
+    if not lexical_fast_path:
+        if text_embedding is not None:
+            question_embedding_task = completed(text_embedding)
+        else:
+            question_embedding_task = asyncio.create_task(embed_text_with_jina(query.question))
+        if matched is not None:
+            retrieval_task = completed(matched)
+        else:
+            retrieval_task = asyncio.create_task(
+                retrieve_documents(query.question, query.image, question_embedding_task, retrieval_match_count()))
+    url_task = asyncio.create_task(asyncio.wait_for(fetch_url_content(query.url), timeout=URL_STAGE_DEADLINE)) if query.url else None
+
+    cache_context = answer_context(query.url, query.image)
+    question_embedding = None
+    cache_checked = False
+
+    async def answer_cache_lookup() -> Optional[Dict]:
+        """The cached answer for a similar question, once the question embedding is in."""
+        nonlocal question_embedding, cache_checked
+        cache_checked = True
+        try:
+            question_embedding = await question_embedding_task
+        except Exception as e:
+            logger.warning("question_embedding_failed error=%r answer_cache=skipped", e)
+            return None
+        if not question_embedding:
+            return None
+        semantic_answer_cache.check_corpus(corpus_version())
+        cached = semantic_answer_cache.lookup(question_embedding, cache_context, elapsed=time.monotonic() - started)
+        if cached is not None:
+            logger.debug("answer_cache_hit question=%r", query.question)
+        return cached
+
+    try:
+        # The answer cache must not hold up the URL stage: with a url it is consulted now only if
+        # the embedding arrives before the page, and otherwise only when the page was not enough
+        if question_embedding_task is not None and url_task is not None:
+            await asyncio.wait({question_embedding_task, url_task}, return_when=asyncio.FIRST_COMPLETED)
+        if question_embedding_task is not None and (url_task is None or question_embedding_task.done()):
+            cached = await answer_cache_lookup()
+            if cached is not None:
+                return {"response": cached}
+
+        # 1. Handle explicit URL if provided in the request
+        if query.url:
+            logger.debug("url_fetch_started url=%s", query.url)
+            try:
+                page = await url_task
+                if page:
+                    # Update text for the input URL in all_candidate_links if a title is found
+                    for link_obj in all_candidate_links:
+                        if link_obj["url"] == query.url and page["title"] is not None:
+                            link_obj["text"] = page["title"] or "Provided Source"
+                            break
+
+                    if page["text"] is not None:
+                        context_texts.append(page["text"])
+                        # Packed first, truncated to its share of the budget
+                        page_passage = {"text": page["text"], "score": float("inf"), "links": [],
+                                        "max_tokens": int(CONTEXT_TOKEN_BUDGET * URL_CONTEXT_SHARE)}
+                        passages.append(page_passage)
+
+                        # Extract other links from the fetched page's content
+                        for link in page["links"]:
+                            # Add only if not the query.url itself (to avoid simple duplication)
+                            if link["url"] != query.url: 
+                                page_passage["links"].append(link)
+                                if "discourse.onlinedegree.iitm.ac.in" in link["url"]:
+                                    is_discourse_context_dominant = True 
+
+                        if context_texts and len(context_texts[0]) > 50: 
+                            found_meaningful_content = True
+                        else:
+                            logger.debug("url_content_too_short url=%s fallback=vector_db", query.url)
+                    else:
+                        logger.debug("url_no_main_content url=%s fallback=vector_db", query.url)
+            except asyncio.TimeoutError:
+                logger.error("url_fetch_deadline_exceeded url=%s deadline=%s fallback=vector_db", query.url, URL_STAGE_DEADLINE)
+                UPSTREAM_ERRORS.inc(upstream="url_fetch")
+            except httpx.RequestError as e:
+                logger.error("url_fetch_failed url=%s error=%r fallback=vector_db", query.url, e)
+                UPSTREAM_ERRORS.inc(upstream="url_fetch")
+            except PoolSaturated:
+                raise
+            except Exception as e:
+                logger.error("url_processing_failed url=%s error=%r fallback=vector_db", query.url, e)
+                UPSTREAM_ERRORS.inc(upstream="url_fetch")
+
+        # 2. Fallback to Supabase/Vector DB if no URL provided OR URL search failed to yield meaningful content
+        if not found_meaningful_content:
+            logger.debug("vector_db_query url_provided=%s", query.url is not None)
+            if query.url:
+                FALLBACKS.inc(kind="url_to_vector_db")
+            if lexical_fast_path:
+                LEXICAL_FAST_PATH.inc()
+                matched_docs = lexical_docs[:MATCH_COUNT]
+            else:
+                if not cache_checked:
+                    cached = await answer_cache_lookup()
+                    if cached is not None:
+                        return {"response": cached}
+                remaining = max(0.0, RETRIEVAL_STAGE_DEADLINE - (time.monotonic() - retrieval_started))
+                try:
+                    matched_docs = await asyncio.wait_for(retrieval_task, timeout=remaining)
+                except asyncio.TimeoutError:
+                    logger.error("retrieval_deadline_exceeded deadline=%s", RETRIEVAL_STAGE_DEADLINE)
+                    UPSTREAM_ERRORS.inc(upstream="retrieval_deadline")
+                except EmbeddingError as e:
+                    # Hybrid mode can still answer from the lexical candidates while Jina is unavailable
+                    if not lexical_docs:
+                        raise HTTPException(status_code=500, detail=f"Embedding generation failed: {str(e)}")
+                    logger.warning("embedding_failed error=%s fallback=lexical", e)
+                    FALLBACKS.inc(kind="lexical_only")
+                if lexical_docs:
+                    matched_docs = fuse_rankings(matched_docs, lexical_docs)
+                # Hybrid mode fetches HYBRID_CANDIDATES vector hits; only MATCH_COUNT reach the prompt
+                matched_docs = matched_docs[:MATCH_COUNT]
+    finally:
+        # Drops the speculative retrieval when the URL content was enough (no-op once it has finished)
+        await cancel_task(retrieval_task)
+        await cancel_task(url_task)
+        await cancel_task(question_embedding_task)
+
+    # An embedding that finished while the page was used still lets the answer be cached
+    if (question_embedding is None and question_embedding_task is not None and question_embedding_task.done()
+            and not question_embedding_task.cancelled() and question_embedding_task.exception() is None):
+        question_embedding = question_embedding_task.result()
+
+    if not found_meaningful_content:
+        try:
+            logger.debug("vector_db_matched docs=%d", len(matched_docs))
+
+            if matched_docs and not all(len(doc.get("content", "")) < 50 for doc in matched_docs):
+                for rank, doc in enumerate(matched_docs):
+                    # Plain text and links are extracted at ingest time; rows stored before that
+                    # still carry raw content and are parsed here
+                    content = (doc.get("text") if doc.get("text") is not None else doc.get("content") or "").strip()
+                    if not content:
+                        continue
+                    context_texts.append(content)
+                    doc_passage = {"text": content, "score": float(len(matched_docs) - rank), "links": []}
+                    passages.append(doc_passage)
+
+                    # Mark discourse dominant if any matched doc is from discourse
+                    if "discourse" in doc.get("source_name", "").lower() or \
+                       (doc.get("url") and "discourse.onlinedegree.iitm.ac.in" in doc.get("url")):
+                        is_discourse_context_dominant = True
+
+                    # Links found in the content
+                    doc_links = doc.get("links")
+                    if doc_links is None:
+                        doc_links = await get_pool("parse").run(extract_links_from_html, doc.get("content") or "")
+                    doc_passage["links"].extend(doc_links)
+
+                    source_name = doc.get("source_name", "")
+                    doc_url = doc.get("url") # Canonical URL for the document, if stored
+
+                    # Derive a specific TDS link from source_name for rows stored without a url
+                    derived_tds_link = course_page_url(source_name)
+                    
+                    # Add doc's canonical URL or derived TDS link to candidates
+                    link_to_add_from_doc = None
+                    link_text_from_doc = None
+                    if doc_url and ABSOLUTE_URL_RE.match(doc_url):
+                        link_to_add_from_doc = doc_url
+                        link_text_from_doc = source_name or "See source"
+                    elif derived_tds_link:
+                        link_to_add_from_doc = derived_tds_link
+                        link_text_from_doc = source_name or f"See {derived_tds_link.split('/')[-1].replace('-', ' ').title()}" 
+                    
+                    if link_to_add_from_doc:
+                        doc_passage["links"].append({"url": link_to_add_from_doc, "text": link_text_from_doc})
+
+
+                if context_texts: 
+                    found_meaningful_content = True
+            else:
+                logger.debug("vector_db_no_match")
+
+        except PoolSaturated:
+            raise
+        except Exception as e:
+            logger.error("matched_docs_processing_failed error=%r", e)
+
+    # 3. If no meaningful content was found from any source
+    if not found_meaningful_content:
+        logger.debug("dont_know reason=no_content")
+        FALLBACKS.inc(kind="dont_know")
+        return {"response": {"answer": DONT_KNOW_ANSWER, "links": []}}
+
+    # Prepare context for LLM: markup stripped, duplicates dropped, packed into the token budget.
+    # Only sources that made it into the prompt contribute link candidates.
+    with span("context_build"):
+        context = build_context(passages, CONTEXT_TOKEN_BUDGET, LLM_MODEL)
+    for passage in context["passages"]:
+        all_candidate_links.extend(passage["links"])
+    context_text = context["text"]
+    if not context_text.strip():
+        logger.debug("dont_know reason=empty_context")
+        FALLBACKS.inc(kind="dont_know")
+        return {"response": {"answer": DONT_KNOW_ANSWER, "links": []}}
+
+    # NEW SECTION: Final Link Selection and Prioritization based on Dominant Source
+    with span("link_selection"):
+        packed_texts = [passage["text"] for passage in context["passages"]]
+        final_links_to_return = select_links(query.url, all_candidate_links, packed_texts, matched_docs, is_discourse_context_dominant)
 
     # --- LLM Call ---
     messages = [
@@ -393,39 +1061,314 @@ async def handle_question(request: Request):
         }
     ]
 
+    prompt_tokens = count_message_tokens(messages, LLM_MODEL)
+    PROMPT_TOKENS.observe(prompt_tokens)
+    stats = context["stats"]
+    logger.info("prompt_built prompt_tokens=%d context_tokens=%d context_tokens_in=%d passages=%d packed=%d duplicates=%d over_budget=%d",
+                prompt_tokens, stats["tokens"], stats["tokens_in"], stats["passages"], stats["packed"], stats["duplicates"], stats["over_budget"])
+
+    return {
+        "messages": messages,
+        "links": final_links_to_return,
+        "cache_entry": {"embedding": question_embedding, "context": cache_context, "started": started}
+    }
+
+def remember_answer(prepared: Dict, response_data: Dict) -> None:
+    """Stores a freshly generated answer in the semantic answer cache."""
+    entry = prepared["cache_entry"]
+    if entry["embedding"]:
+        cost = time.monotonic() - entry["started"]
+        semantic_answer_cache.put(entry["embedding"], entry["context"], response_data, cost)
+
+def llm_fallback_answer(prepared: Dict, error: Exception) -> Dict:
+    """
+    Response when the LLM call failed or its circuit is open: the closest cached answer for a
+    similar question (ANSWER_CACHE_FALLBACK_THRESHOLD) if there is one, else LLM_ERROR_ANSWER.
+    """
+    if not isinstance(error, CircuitOpenError):
+        UPSTREAM_ERRORS.inc(upstream="llm")
+    entry = prepared["cache_entry"]
+    if entry["embedding"]:
+        cached = semantic_answer_cache.lookup(entry["embedding"], entry["context"], threshold=ANSWER_CACHE_FALLBACK_THRESHOLD)
+        if cached is not None:
+            logger.warning("llm_unavailable error=%r fallback=cached_answer", error)
+            FALLBACKS.inc(kind="cached_answer")
+            return cached
+    logger.error("llm_request_failed error=%r", error)
+    FALLBACKS.inc(kind="llm_error")
+    return {"answer": LLM_ERROR_ANSWER, "links": []}
+
+def llm_request(messages: List[Dict], stream: bool = False) -> Dict:
+    """Headers and JSON payload for the chat-completions call."""
     headers = {
         "Authorization": f"Bearer {LLM_API_TOKEN}",
         "Content-Type": "application/json"
     }
 
     payload = {
-        "model": "openai/gpt-4o-mini",
+        "model": LLM_MODEL,
         "messages": messages,
         "temperature": 0
     }
+    if stream:
+        payload["stream"] = True
+    return {"headers": headers, "json": payload}
+
+def answer_note(question: str, answer: str) -> str:
+    """Extra text appended to the LLM answer, if any."""
+    if "gpt-3.5-turbo-0125" in question.lower() and "gpt-3.5-turbo-0125" not in answer.lower():
+        return "\n\nNote: This answer clarifies the use of gpt-3.5-turbo-0125 as requested, not gpt-4o-mini."
+    return ""
+
+def flight_key(query: QueryRequest) -> str:
+    """Requests with the same normalized question, url and image share one computation."""
+    return f"{embedding_cache.normalize_text(query.question)}|{answer_context(query.url, query.image)}"
+
+async def answer_question(query: QueryRequest) -> Dict:
+    """Retrieval plus the LLM call; the body of /api/, shared by coalesced identical requests."""
+    prepared = await prepare_answer(query)
+    if "response" in prepared:
+        return prepared["response"]
+    return await complete_answer(query, prepared)
+
+async def complete_answer(query: QueryRequest, prepared: Dict) -> Dict:
+    """The LLM call for a prepared question, with the cached-answer fallback when it fails."""
+    client = get_http_client("llm")
+
+    async def request() -> Dict:
+        llm_response = await client.post(LLM_API_URL, **llm_request(prepared["messages"]))
+        llm_response.raise_for_status()
+        return llm_response.json()
 
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            llm_response = await client.post(LLM_API_URL, headers=headers, json=payload)
-            llm_response.raise_for_status() 
-            llm_data = llm_response.json()
+        with span("llm"):
+            llm_data = await upstreams["llm"].call(request)
     except Exception as e:
-        print(f"ERROR: LLM request failed: {str(e)}")
-        return {
-            "answer": "Sorry, I couldn't process the answer at this moment due to an internal error.",
-            "links": []
-        }
+        return llm_fallback_answer(prepared, e)
 
     answer = llm_data.get("choices", [{}])[0].get("message", {}).get("content", "").strip()
-
-    if "gpt-3.5-turbo-0125" in query.question.lower() and "gpt-3.5-turbo-0125" not in answer.lower():
-        answer += "\n\nNote: This answer clarifies the use of gpt-3.5-turbo-0125 as requested, not gpt-4o-mini."
+    answer += answer_note(query.question, answer)
 
     response_data = {
         "answer": answer.strip(),
-        "links": final_links_to_return 
+        "links": prepared["links"] 
     }
 
-    print("DEBUG: Response sent:", response_data)
+    remember_answer(prepared, response_data)
+    return response_data
+
+@app.post("/api/")
+async def handle_question(request: Request):
+    """
+    Handles incoming questions, prioritizing URL-based search, then falling back
+    to vector database search, and finally returning "I don't know" if no answer is found.
+    Identical questions arriving while one is being answered wait for that answer.
+    """
+    started = time.perf_counter()
+    query = await parse_query(request)
+    REQUESTS.inc(endpoint="/api/")
+    response_data = await answer_flights.do(flight_key(query), lambda: answer_question(query))
+    REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint="/api/")
+
+    logger.debug("response_sent response=%s", response_data)
 
     return response_data
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def stream_llm_deltas(messages: List[Dict]):
+    """
+    Yields content deltas from the upstream chat-completions stream (OpenAI SSE format).
+    A stream is not retried or hedged once started, but it counts towards the LLM circuit breaker.
+    """
+    client = get_http_client("llm")
+    started = time.perf_counter()
+    first_token = True
+    async with upstreams["llm"].guard(), \
+            client.stream("POST", LLM_API_URL, **llm_request(messages, stream=True)) as llm_response:
+        llm_response.raise_for_status()
+        async for line in llm_response.aiter_lines():
+            # Skip blank separators and comment keep-alives such as ": OPENROUTER PROCESSING"
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            chunk = json.loads(data)
+            delta = (chunk.get("choices") or [{}])[0].get("delta", {}).get("content")
+            if delta:
+                if first_token:
+                    metrics.STAGE_SECONDS.observe(time.perf_counter() - started, stage="llm_first_token")
+                    first_token = False
+                yield delta
+    metrics.STAGE_SECONDS.observe(time.perf_counter() - started, stage="llm_stream")
+
+@app.post("/api/stream")
+async def handle_question_stream(request: Request):
+    """
+    Streaming variant of /api/ as Server-Sent Events:
+      event: links  -> the selected links, as soon as retrieval is done
+      event: delta  -> {"content": "..."} for each piece of the answer as the LLM produces it
+      event: done   -> the final {"answer", "links"}, identical to what /api/ returns
+    """
+    started = time.perf_counter()
+    query = await parse_query(request)
+    REQUESTS.inc(endpoint="/api/stream")
+    # Retrieval runs before the response starts so that its errors still surface as HTTP status codes.
+    # Identical in-flight streams share it; each still streams its own completion.
+    prepared = await retrieval_flights.do(flight_key(query), lambda: prepare_answer(query))
+
+    async def events():
+        if "response" in prepared:
+            yield sse_event("links", prepared["response"]["links"])
+            REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint="/api/stream")
+            yield sse_event("done", prepared["response"])
+            return
+
+        yield sse_event("links", prepared["links"])
+        answer = ""
+        try:
+            async for delta in stream_llm_deltas(prepared["messages"]):
+                answer += delta
+                yield sse_event("delta", {"content": delta})
+        except Exception as e:
+            if answer:
+                logger.error("llm_stream_failed error=%r", e)
+                UPSTREAM_ERRORS.inc(upstream="llm")
+                FALLBACKS.inc(kind="llm_error")
+                fallback = {"answer": LLM_ERROR_ANSWER, "links": []}
+            else:
+                # Nothing streamed yet, so a cached answer can still stand in for the whole response
+                fallback = llm_fallback_answer(prepared, e)
+                if fallback["answer"] != LLM_ERROR_ANSWER:
+                    yield sse_event("delta", {"content": fallback["answer"]})
+            REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint="/api/stream")
+            yield sse_event("done", fallback)
+            return
+
+        note = answer_note(query.question, answer)
+        if note:
+            yield sse_event("delta", {"content": note})
+        response_data = {"answer": (answer.strip() + note).strip(), "links": prepared["links"]}
+        remember_answer(prepared, response_data)
+        REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint="/api/stream")
+        yield sse_event("done", response_data)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def prefetch_batch(queries: List[Optional[QueryRequest]]) -> Tuple[Dict[int, List[float]], Dict[int, List[Dict]]]:
+    """
+    Question embeddings (one multi-input Jina call per JINA_BATCH_SIZE questions) and, with the
+    in-process index, the vector search results of the items without an image, by item index.
+    Anything that fails here is left to the items' own retrieval.
+    """
+    indexes = [i for i, query in enumerate(queries) if query is not None]
+    try:
+        vectors = await embed_texts_with_jina([queries[i].question for i in indexes], upstream="jina_batch")
+    except Exception as e:
+        logger.warning("batch_embedding_failed items=%d error=%r fallback=per_item", len(indexes), e)
+        if not isinstance(e, CircuitOpenError):
+            UPSTREAM_ERRORS.inc(upstream="jina_batch")
+        return {}, {}
+    embeddings = dict(zip(indexes, vectors))
+
+    matched: Dict[int, List[Dict]] = {}
+    searchable = [i for i in indexes if not queries[i].image and embeddings[i]]
+    if vector_index is not None and searchable:
+        try:
+            with span("vector_search"):
+                results = await get_pool("search").run(
+                    match_documents_many, [embeddings[i] for i in searchable], retrieval_match_count())
+            matched = dict(zip(searchable, results))
+        except Exception as e:
+            logger.warning("batch_vector_search_failed items=%d error=%r fallback=per_item", len(searchable), e)
+    return embeddings, matched
+
+@app.post("/api/batch")
+async def handle_question_batch(request: Request):
+    """
+    Answers a JSON list of /api/ request bodies as Server-Sent Events, in completion order:
+      event: result -> {"index": i, "answer", "links"}, what /api/ returns for item i
+      event: error  -> {"index": i, "status", "detail"} for an item that could not be answered
+      event: done   -> {"items": n, "failed": k}
+    The questions are embedded together and searched in one pass; BATCH_CONCURRENCY items are
+    prepared and BATCH_CONCURRENCY LLM completions run at a time. A failed item does not stop the others.
+    """
+    started = time.perf_counter()
+    try:
+        body = await request.json()
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid request body: {str(e)}")
+    if not isinstance(body, list):
+        raise HTTPException(status_code=400, detail="Invalid request body: expected a JSON list of questions")
+    if len(body) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_ITEMS} questions per batch")
+    REQUESTS.inc(endpoint="/api/batch")
+
+    queries: List[Optional[QueryRequest]] = []
+    invalid: Dict[int, str] = {}
+    for i, item in enumerate(body):
+        try:
+            queries.append(QueryRequest(**item))
+        except Exception as e:
+            queries.append(None)
+            invalid[i] = f"Invalid request body: {str(e)}"
+
+    embeddings, matched = await prefetch_batch(queries)
+    prepare_slots = asyncio.Semaphore(BATCH_CONCURRENCY)
+    llm_slots = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def answer_item(i: int, query: QueryRequest) -> Dict:
+        async with prepare_slots:
+            prepared = await prepare_answer(query, embeddings.get(i), matched.get(i))
+        if "response" in prepared:
+            return prepared["response"]
+        async with llm_slots:
+            return await complete_answer(query, prepared)
+
+    async def run_item(i: int) -> Tuple[int, Optional[Dict], Optional[Dict]]:
+        """(index, response, error) for one item; errors are returned rather than raised."""
+        if i in invalid:
+            return i, None, {"status": 400, "detail": invalid[i]}
+        query = queries[i]
+        try:
+            return i, await answer_flights.do(flight_key(query), lambda: answer_item(i, query)), None
+        except HTTPException as e:
+            error = {"status": e.status_code, "detail": e.detail}
+        except PoolSaturated as e:
+            error = {"status": 503, "detail": str(e)}
+        except Exception as e:
+            error = {"status": 500, "detail": f"Internal error: {str(e)}"}
+        logger.error("batch_item_failed index=%d status=%d detail=%s", i, error["status"], error["detail"])
+        return i, None, error
+
+    async def events():
+        tasks = [asyncio.create_task(run_item(i)) for i in range(len(queries))]
+        failed = 0
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                i, response_data, error = await next_done
+                if error is not None:
+                    failed += 1
+                    BATCH_ITEMS.inc(outcome="error")
+                    yield sse_event("error", {"index": i, **error})
+                else:
+                    BATCH_ITEMS.inc(outcome="ok")
+                    yield sse_event("result", {"index": i, **response_data})
+        finally:
+            # The client went away: stop answering the rest
+            for task in tasks:
+                task.cancel()
+        REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint="/api/batch")
+        yield sse_event("done", {"items": len(queries), "failed": failed})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
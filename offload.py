@@ -0,0 +1,136 @@
+"""
+Bounded executors that keep blocking work off the event loop.
+
+A uvicorn worker runs every request on one event loop, so a synchronous Supabase RPC or a
+BeautifulSoup parse of a large page stalls all concurrent requests until it returns. Such calls
+go through a BoundedExecutor instead:
+
+    search_pool = BoundedExecutor("search", "thread", workers=8, max_queue=64)
+    docs = await search_pool.run(match_documents, embedding, match_count)
+
+At most `workers` calls run at once and up to `max_queue` more wait for a slot (the queue depth).
+Beyond that calls fail fast with PoolSaturated, so an overloaded worker answers 503 right away
+instead of building a backlog every later request has to wait behind.
+Process pools suit pure-Python CPU work (parsing), which would hold the GIL in a thread; the
+functions and their arguments must then be picklable (module-level functions, plain data).
+"""
+import asyncio
+import logging
+import multiprocessing
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional
+
+from metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+POOL_KINDS = ("thread", "process")
+
+QUEUE_WAIT_SECONDS = Histogram("tds_offload_wait_seconds", "Time blocking calls waited for a free executor slot", ["pool"])
+
+
+class PoolSaturated(Exception):
+    """Raised when an executor's queue is full; the request should be retried later."""
+
+    def __init__(self, pool: str):
+        super().__init__(f"{pool} pool is saturated")
+        self.pool = pool
+
+
+class BoundedExecutor:
+    def __init__(self, name: str, kind: str = "thread", workers: int = 4, max_queue: int = 64):
+        if kind not in POOL_KINDS:
+            raise ValueError(f"Unknown pool kind {kind!r} (use {', '.join(POOL_KINDS)})")
+        self.name = name
+        self.kind = kind
+        self.workers = max(1, workers)
+        self.max_queue = max(0, max_queue)
+        self.executor = self._create_executor()
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.max_waiting = 0
+
+    def _create_executor(self) -> Executor:
+        if self.kind == "thread":
+            return ThreadPoolExecutor(self.workers, thread_name_prefix=f"{self.name}-pool")
+        # spawn: forking a process that already runs threads (the thread pools) can deadlock
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        # Created on first use so it belongs to the running loop
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        return self._slots
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        slots = self._semaphore()
+        if slots.locked() and self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise PoolSaturated(self.name)
+
+        started = time.perf_counter()
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            await slots.acquire()
+        finally:
+            self.waiting -= 1
+        QUEUE_WAIT_SECONDS.observe(time.perf_counter() - started, pool=self.name)
+
+        loop = asyncio.get_running_loop()
+        executor = self.executor
+        self.running += 1
+        try:
+            future = executor.submit(fn, *args)
+        except BaseException as e:
+            self._release()
+            if isinstance(e, BrokenProcessPool):
+                self._replace_broken(executor)
+            raise
+        # The slot is freed when the work ends, not when the caller stops waiting: a cancelled
+        # request cannot stop a call that has already started
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._release))
+        try:
+            return await asyncio.wrap_future(future)
+        except BrokenProcessPool:
+            self._replace_broken(executor)
+            raise
+
+    def _replace_broken(self, executor: Executor) -> None:
+        """Swaps in a new pool for a broken one; calls that failed together replace it only once."""
+        if self.executor is not executor:
+            return
+        logger.error("worker_pool_broken pool=%s action=recreate", self.name)
+        self.executor = self._create_executor()
+        executor.shutdown(wait=False)
+
+    def _release(self) -> None:
+        self.running -= 1
+        self.completed += 1
+        self._semaphore().release()
+
+    def warm_up(self) -> None:
+        """Starts the worker processes now rather than on the first request."""
+        if self.kind == "process":
+            for _ in range(self.workers):
+                self.executor.submit(int)
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self) -> Dict:
+        return {
+            "kind": self.kind,
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "running": self.running,
+            "queue_depth": self.waiting,
+            "max_queue_depth": self.max_waiting,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,109 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+
+class CachedPage:
+    """A parsed page (or a cached negative result, page=None) plus its HTTP validators."""
+
+    __slots__ = ("page", "etag", "last_modified", "expires_at", "size")
+
+    def __init__(self, page: Optional[Dict], etag: Optional[str], last_modified: Optional[str], expires_at: float, size: int):
+        self.page = page
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires_at = expires_at
+        self.size = size
+
+    @property
+    def fresh(self) -> bool:
+        return time.time() < self.expires_at
+
+    def validators(self) -> Dict[str, str]:
+        """Conditional request headers for revalidating a stale entry."""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class PageCache:
+    """
+    Caches the extracted content of fetched `url` pages (title, main text, links), keyed by URL.
+    Bounded by total bytes with LRU eviction. Fresh entries are served directly; stale entries
+    keep their validators so they can be revalidated with a conditional GET. Negative results
+    (redirects, pages without a main content element) use a shorter TTL.
+    """
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, ttl_seconds: float = 600, negative_ttl_seconds: float = 60):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self._entries: "OrderedDict[str, CachedPage]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def get(self, url: str) -> Optional[CachedPage]:
+        """
+        Returns the entry (fresh or stale) for url, or None. Fresh entries count as hits,
+        missing or stale ones as misses (`revalidated` counts the misses answered by a 304).
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(url)
+            if entry.fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return entry
+
+    def put(self, url: str, page: Optional[Dict], etag: Optional[str] = None, last_modified: Optional[str] = None,
+            negative: bool = False) -> None:
+        ttl = self.negative_ttl_seconds if negative else self.ttl_seconds
+        size = len(url) + (len(json.dumps(page)) if page else 0)
+        if size > self.max_bytes:
+            return
+        entry = CachedPage(page, etag, last_modified, time.time() + ttl, size)
+        with self._lock:
+            old = self._entries.pop(url, None)
+            if old is not None:
+                self._bytes -= old.size
+            self._entries[url] = entry
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
+
+    def refresh(self, url: str) -> Optional[CachedPage]:
+        """Marks an entry fresh again after a 304 Not Modified."""
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                return None
+            ttl = self.ttl_seconds if entry.page and entry.page.get("text") is not None else self.negative_ttl_seconds
+            entry.expires_at = time.time() + ttl
+            self.revalidated += 1
+            return entry
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "revalidated": self.revalidated,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
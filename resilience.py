@@ -0,0 +1,292 @@
+"""
+Resilience for the paid upstream calls (Jina embeddings, chat completions).
+
+Each Upstream wraps one kind of call with:
+  - adaptive timeouts: an attempt gets `timeout_multiplier` x the observed p99 latency, clamped to
+    [min_timeout, timeout]. `timeout` (the configured static timeout) is also the budget of the whole
+    call, retries and backoff included, so a call never takes longer than it did without this layer
+  - hedging: an attempt that has not answered by the observed p95 latency gets a duplicate, the first
+    success wins and the other is cancelled. At most `hedge_budget` of calls are hedged, so a slow
+    upstream is not hit with twice the traffic
+  - retries with full-jitter exponential backoff for retryable errors (timeouts, connection errors,
+    408/429/5xx responses)
+  - a circuit breaker: after `failure_threshold` consecutive failed calls it opens and calls fail fast
+    with CircuitOpenError for `open_seconds`; then a single probe call is let through and its outcome
+    closes or re-opens the circuit
+
+    jina = Upstream("jina", timeout=10)
+    data = await jina.call(lambda: post_and_parse(...))
+
+State is per process; with several uvicorn workers each keeps its own latency window and breaker.
+"""
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS = frozenset({408, 425, 429, 500, 502, 503, 504})
+# Latency-derived timeouts and hedging kick in once this many calls have succeeded
+MIN_LATENCY_SAMPLES = 20
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Timeouts, connection failures and overload/server-error responses; not 4xx request errors."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_STATUS
+    return isinstance(error, (asyncio.TimeoutError, httpx.TransportError))
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit breaker is open."""
+
+    def __init__(self, upstream: str, retry_in: float):
+        super().__init__(f"{upstream} circuit is open, next attempt in {retry_in:.1f}s")
+        self.upstream = upstream
+        self.retry_in = retry_in
+
+
+class LatencyTracker:
+    """Latencies (seconds) of the most recent successful attempts."""
+
+    def __init__(self, window: int = 200, min_samples: int = MIN_LATENCY_SAMPLES):
+        self._samples: deque = deque(maxlen=window)
+        self.min_samples = min_samples
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def observe(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """Nearest-rank percentile, or None until `min_samples` latencies have been seen."""
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, open_seconds: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.opened = 0
+        self._probing = False
+
+    def is_open(self) -> bool:
+        """True while calls are being rejected without a probe being due."""
+        return self.state == self.OPEN and time.monotonic() - self.opened_at < self.open_seconds
+
+    def retry_in(self) -> float:
+        return max(0.0, self.opened_at + self.open_seconds - time.monotonic()) if self.state == self.OPEN else 0.0
+
+    def allow(self) -> bool:
+        """Whether a call may go ahead. Once the open period is over, one probe call at a time is allowed."""
+        if self.state == self.CLOSED:
+            return True
+        if self.is_open():
+            return False
+        if self.state == self.OPEN:
+            self.state = self.HALF_OPEN
+            logger.info("circuit_half_open upstream=%s", self.name)
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def record_success(self) -> None:
+        self.consecutive_failures = 0
+        self._probing = False
+        if self.state != self.CLOSED:
+            self.state = self.CLOSED
+            logger.info("circuit_closed upstream=%s", self.name)
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        self._probing = False
+        if self.state == self.OPEN:
+            return
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.opened += 1
+            logger.warning("circuit_opened upstream=%s failures=%d open_seconds=%s",
+                           self.name, self.consecutive_failures, self.open_seconds)
+
+    def release(self) -> None:
+        """Ends a probe that finished without a verdict (cancelled, or failed with a non-retryable error)."""
+        self._probing = False
+
+
+class Upstream:
+    def __init__(self, name: str, timeout: float, min_timeout: float = 0.5, timeout_multiplier: float = 2.0,
+                 hedge: bool = True, hedge_budget: float = 0.1, max_attempts: int = 3,
+                 backoff_base: float = 0.1, backoff_max: float = 2.0,
+                 failure_threshold: int = 5, open_seconds: float = 30.0, window: int = 200):
+        self.name = name
+        self.timeout = timeout
+        self.min_timeout = min(min_timeout, timeout)
+        self.timeout_multiplier = timeout_multiplier
+        self.hedge = hedge
+        self.hedge_budget = hedge_budget
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.latency = LatencyTracker(window)
+        self.breaker = CircuitBreaker(name, failure_threshold, open_seconds)
+        self.calls = 0
+        self.failures = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.short_circuits = 0
+
+    def attempt_timeout(self) -> float:
+        p99 = self.latency.percentile(99)
+        if p99 is None:
+            return self.timeout
+        return min(self.timeout, max(self.min_timeout, p99 * self.timeout_multiplier))
+
+    def hedge_delay(self) -> Optional[float]:
+        """Seconds after which an attempt is duplicated (the p95 latency), or None to not hedge."""
+        if not self.hedge or self.hedges >= self.hedge_budget * self.calls:
+            return None
+        return self.latency.percentile(95)
+
+    def _reject(self) -> CircuitOpenError:
+        self.short_circuits += 1
+        return CircuitOpenError(self.name, self.breaker.retry_in())
+
+    async def call(self, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Runs `fn` (one complete request, e.g. post + raise_for_status + json) with the timeouts,
+        hedging, retries and breaker above. Raises CircuitOpenError without calling `fn` while the
+        breaker is open, and the last error once the attempts or the time budget are used up.
+        """
+        if not self.breaker.allow():
+            raise self._reject()
+        self.calls += 1
+        deadline = time.monotonic() + self.timeout
+        settled = False
+        try:
+            attempt = 1
+            while True:
+                try:
+                    result = await self._attempt(fn, min(self.attempt_timeout(), deadline - time.monotonic()))
+                except Exception as e:
+                    if not is_retryable(e):
+                        raise
+                    delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+                    if (attempt >= self.max_attempts or delay >= deadline - time.monotonic() - self.min_timeout
+                            or self.breaker.is_open()):
+                        self.failures += 1
+                        self.breaker.record_failure()
+                        settled = True
+                        raise
+                    logger.debug("upstream_retry upstream=%s attempt=%d delay=%.3f error=%r", self.name, attempt, delay, e)
+                    self.retries += 1
+                    attempt += 1
+                    await asyncio.sleep(delay)
+                    continue
+                self.breaker.record_success()
+                settled = True
+                return result
+        finally:
+            if not settled:
+                self.breaker.release()
+
+    async def _attempt(self, fn: Callable[[], Awaitable[Any]], timeout: float) -> Any:
+        primary = asyncio.ensure_future(self._timed(fn, timeout))
+        delay = self.hedge_delay()
+        if delay is None or delay >= timeout:
+            return await primary
+
+        pending = {primary}
+        errors = []
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if not done:
+                self.hedges += 1
+                logger.debug("upstream_hedged upstream=%s after=%.3f", self.name, delay)
+                pending.add(asyncio.ensure_future(self._timed(fn, timeout - delay)))
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.hedge_wins += 1
+                        return task.result()
+                    errors.append(task.exception())
+            raise errors[0]
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _timed(self, fn: Callable[[], Awaitable[Any]], timeout: float) -> Any:
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(fn(), timeout=max(timeout, 0.001))
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        self.latency.observe(time.monotonic() - started)
+        return result
+
+    @asynccontextmanager
+    async def guard(self):
+        """
+        Breaker accounting only, for calls that cannot be retried or hedged once they have started
+        producing output (a streamed completion). Raises CircuitOpenError while the breaker is open.
+        """
+        if not self.breaker.allow():
+            raise self._reject()
+        self.calls += 1
+        settled = False
+        try:
+            yield
+        except Exception as e:
+            if is_retryable(e):
+                self.failures += 1
+                self.breaker.record_failure()
+                settled = True
+            raise
+        else:
+            self.breaker.record_success()
+            settled = True
+        finally:
+            if not settled:
+                self.breaker.release()
+
+    def stats(self) -> Dict:
+        p50 = self.latency.percentile(50)
+        p95 = self.latency.percentile(95)
+        return {
+            "circuit": self.breaker.state,
+            "circuit_opened": self.breaker.opened,
+            "calls": self.calls,
+            "failures": self.failures,
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "short_circuits": self.short_circuits,
+            "latency_p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+            "latency_p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            "attempt_timeout_s": round(self.attempt_timeout(), 3),
+        }
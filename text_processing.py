@@ -0,0 +1,122 @@
+import re
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from bs4 import BeautifulSoup, NavigableString, Tag
+
+TDS_BASE_URL = "https://tds.s-anand.net/#/"
+DISCOURSE_BASE_URL = "https://discourse.onlinedegree.iitm.ac.in"
+
+ABSOLUTE_URL_RE = re.compile(r'^[a-zA-Z]+://')
+MAIN_CONTENT_CLASS_RE = re.compile("post-content|main-content|article-body", re.IGNORECASE)
+
+
+def course_page_url(source_name: str) -> Optional[str]:
+    """Maps a course markdown file (e.g. 'docker.md') to its page on tds.s-anand.net."""
+    if not source_name or not source_name.endswith(".md"):
+        return None
+    base_name = source_name.replace(".md", "").replace("\\", "/").split("/")[-1]
+    # Ensure base_name is URL-friendly (e.g., lowercase, hyphens) if not already
+    base_name = base_name.lower().replace(" ", "-")
+    return f"{TDS_BASE_URL}{base_name}"
+
+
+def discourse_topic_url(topic_id) -> Optional[str]:
+    if topic_id is None:
+        return None
+    return f"{DISCOURSE_BASE_URL}/t/{topic_id}"
+
+
+def html_blocks(content_html: str) -> List[Tuple[str, str]]:
+    """
+    Splits cooked Discourse HTML into its top-level blocks (paragraphs, lists, code, quotes).
+    Returns (html, plain_text) pairs, skipping empty blocks.
+    """
+    blocks = []
+    soup = BeautifulSoup(content_html or "", "html.parser")
+    for child in soup.children:
+        if isinstance(child, Tag):
+            text = child.get_text(" ", strip=True)
+            html = str(child)
+        elif isinstance(child, NavigableString):
+            text = str(child).strip()
+            html = text
+        else:
+            continue
+        if text:
+            blocks.append((html, text))
+    return blocks
+
+
+def html_to_text(content_html: str) -> str:
+    """Plain text of an HTML fragment, one paragraph per block."""
+    return "\n\n".join(text for _, text in html_blocks(content_html))
+
+
+def extract_links_from_html(content_html: str, base_url: Optional[str] = None) -> List[Dict[str, str]]:
+    """
+    Extracts URLs and their corresponding text from HTML content.
+    Handles relative URLs by resolving them against an optional base_url.
+    Find URLs associated with the "answers" or "context" that your API fetches
+    """
+    links = []
+    if content_html:
+        soup = BeautifulSoup(content_html, "html.parser")
+        for a in soup.find_all("a", href=True):
+            href = a['href']
+            text = a.get_text(strip=True) or href
+
+            # Resolve relative URLs
+            if href.startswith('/') and base_url:
+                parsed_base = httpx.URL(base_url)
+                href = str(parsed_base.join(href))
+            elif not ABSOLUTE_URL_RE.match(href) and base_url: 
+                parsed_base = httpx.URL(base_url)
+                href = str(parsed_base.join(href))
+            elif not ABSOLUTE_URL_RE.match(href):
+                continue 
+
+            links.append({"url": href, "text": text})
+    return links
+
+
+def parse_page(html: str, url: str, max_chars: int) -> Dict:
+    """
+    Title, main text (first `max_chars` chars; None without an article/main element) and outgoing
+    links of a fetched page. Pure function of its arguments, so it can run in a worker process.
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    page_title_tag = soup.find("title")
+    page = {
+        "title": page_title_tag.get_text(strip=True) if page_title_tag else None,
+        "text": None,
+        "links": []
+    }
+
+    main_content_element = soup.find("article") or soup.find("main") or soup.find(class_=MAIN_CONTENT_CLASS_RE)
+    if main_content_element:
+        page["text"] = main_content_element.get_text(separator="\n", strip=True)[:max_chars]
+        page["links"] = extract_links_from_html(str(main_content_element), base_url=url)
+    return page
+
+
+def canonical_url(source_name: str, url: Optional[str]) -> Optional[str]:
+    """The document's own absolute url if it has one, otherwise its tds.s-anand.net page."""
+    if url and ABSOLUTE_URL_RE.match(url):
+        return url
+    return course_page_url(source_name)
+
+
+def ingest_fields(source_name: str, content: str, url: Optional[str] = None, html: bool = False,
+                  text: Optional[str] = None) -> Dict:
+    """
+    Fields stored next to each document at ingest time so the API never parses them per request:
+    canonical "url", plain "text" for the prompt (HTML stripped) and the "links" found in the content.
+    """
+    if text is None:
+        text = html_to_text(content) if html else content
+    return {
+        "url": canonical_url(source_name, url),
+        "text": text,
+        "links": extract_links_from_html(content),
+    }
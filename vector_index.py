@@ -0,0 +1,225 @@
+import logging
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import embedding_store
+from ann_index import IVFIndex, row_key
+
+logger = logging.getLogger(__name__)
+
+QUANTIZATIONS = ("none",) + embedding_store.QUANTIZATION_KINDS
+# Rows converted to float32 at a time when scanning a quantized matrix; small enough that the
+# converted block (768 KB at 768 dims) stays in cache for the matrix-vector product
+SCAN_BLOCK_ROWS = 256
+
+
+class VectorIndex:
+    """
+    In-process replacement for the Supabase `match_all_vectors` RPC.
+    All embeddings live in one contiguous, pre-normalized float32 matrix with a
+    parallel metadata list, so a query is a single matrix-vector product.
+
+    With quantization="int8" (per-row scales) or "float16" the scan runs over the smaller
+    quantized matrix instead, scored against the float32 query. The best `rerank_candidates`
+    rows are then re-scored with the exact vectors, which can stay memory-mapped on disk.
+
+    With an IVF index attached (see ann_index.py) only the rows in the `nprobe` closest lists
+    are scored instead of the whole matrix.
+    """
+
+    def __init__(self, embeddings, metadata: List[Dict[str, Optional[str]]], quantization: str = "none",
+                 rerank_candidates: int = 0, quantized: Optional[Tuple[np.ndarray, Optional[np.ndarray]]] = None):
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization '{quantization}', expected one of {QUANTIZATIONS}")
+        matrix = np.asarray(embeddings)
+        if matrix.ndim != 2 or matrix.shape[0] != len(metadata):
+            raise ValueError("embeddings must be a 2-D matrix with one row per metadata entry")
+        if matrix.dtype != np.float32 and quantization == "none":
+            matrix = matrix.astype(np.float32)
+        norms = np.linalg.norm(np.asarray(matrix, dtype=np.float32), axis=1, keepdims=True)
+        # Jina vectors are already unit length; skip the copy so a memory-mapped store stays mapped
+        if not np.allclose(norms, 1.0, atol=1e-3):
+            norms[norms == 0] = 1.0
+            matrix = np.ascontiguousarray(matrix / norms, dtype=np.float32)
+        self.metadata = metadata
+        self.quantization = quantization
+        self.rerank_candidates = rerank_candidates if quantization != "none" else 0
+
+        if quantization == "none":
+            self.codes, self.scales = matrix, None
+        elif quantized is not None:
+            self.codes, self.scales = quantized
+        else:
+            self.codes, self.scales = embedding_store.quantize(matrix, quantization)
+        # Exact vectors are only needed for re-ranking (or as the search matrix itself)
+        self.matrix = matrix if quantization == "none" or self.rerank_candidates > 0 else None
+        self.ann: Optional[IVFIndex] = None
+        self.nprobe = 0
+
+    def __len__(self) -> int:
+        return self.codes.shape[0]
+
+    @property
+    def dim(self) -> int:
+        return self.codes.shape[1]
+
+    @property
+    def search_bytes(self) -> int:
+        """Bytes read per query by the full scan (the quantized matrix and its scales)."""
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    @classmethod
+    def from_files(cls, paths: Sequence[str], quantization: str = "none", rerank_candidates: int = 0) -> "VectorIndex":
+        """
+        Builds the index from embedded corpora, given as binary store prefixes (see embedding_store.py)
+        or legacy embedded JSON files. Missing files and entries without an embedding are skipped.
+        Quantized copies written by `embedding_store.py quantize` are used when they are up to date;
+        otherwise the vectors are quantized at load time.
+        """
+        matrices = []
+        quantized = []
+        metadata = []
+        for path in paths:
+            try:
+                matrix, rows = embedding_store.load_corpus(path)
+            except FileNotFoundError:
+                logger.warning("embedding_file_missing path=%s", path)
+                continue
+            if not rows:
+                continue
+            matrices.append(matrix)
+            if quantization != "none":
+                stored = embedding_store.read_quantized(path, quantization)
+                if stored is None:
+                    logger.info("quantized_store_missing path=%s kind=%s action=quantize_at_load", path, quantization)
+                    stored = embedding_store.quantize(embedding_store.normalize_rows(matrix), quantization)
+                quantized.append(stored)
+            metadata.extend({
+                "source_name": row.get("source_name"),
+                "chunk_id": row.get("chunk_id"),
+                "content": row.get("content", ""),
+                "url": row.get("url"),
+                "text": row.get("text"),
+                "links": row.get("links"),
+            } for row in rows)
+        if not matrices:
+            raise ValueError(f"No embeddings found in {list(paths)}")
+        if quantization != "none":
+            codes = np.concatenate([q[0] for q in quantized]) if len(quantized) > 1 else quantized[0][0]
+            scales = None
+            if quantization == "int8":
+                scales = np.concatenate([q[1] for q in quantized]) if len(quantized) > 1 else quantized[0][1]
+            return cls(matrices[0] if len(matrices) == 1 else np.concatenate(matrices), metadata,
+                       quantization, rerank_candidates, quantized=(codes, scales))
+        return cls(matrices[0] if len(matrices) == 1 else np.concatenate(matrices), metadata)
+
+    def row_keys(self) -> List[str]:
+        return [row_key(record) for record in self.metadata]
+
+    def vectors_from(self, start: int) -> np.ndarray:
+        """Float32 vectors of rows `start` onwards: exact if kept, otherwise dequantized."""
+        if self.matrix is not None:
+            return np.asarray(self.matrix[start:], dtype=np.float32)
+        vectors = np.asarray(self.codes[start:], dtype=np.float32)
+        return vectors * self.scales[start:, None] if self.scales is not None else vectors
+
+    def attach_ann(self, ann: IVFIndex, nprobe: int) -> Optional[int]:
+        """
+        Searches through `ann` from now on, after inserting any rows added to the corpus since it
+        was built. Returns the number of rows inserted, or None (and keeps exact search) when the
+        index does not match the corpus.
+        """
+        added = ann.sync(self.row_keys(), self.vectors_from)
+        if added is not None:
+            self.ann = ann
+            self.nprobe = nprobe
+        return added
+
+    def scores(self, query: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Similarity of the unit-length float32 `query` to every row (or to `rows` only),
+        computed on the search matrix.
+        """
+        if rows is not None:
+            scores = np.asarray(self.codes[rows], dtype=np.float32) @ query
+            return scores * self.scales[rows] if self.scales is not None else scores
+        if self.codes.dtype == np.float32:
+            return self.codes @ query
+        scores = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), SCAN_BLOCK_ROWS):
+            block = np.asarray(self.codes[start:start + SCAN_BLOCK_ROWS], dtype=np.float32)
+            scores[start:start + len(block)] = block @ query
+        if self.scales is not None:
+            scores *= self.scales
+        return scores
+
+    def search(self, query_embedding: Sequence[float], match_threshold: float = 0.7, match_count: int = 2) -> List[Dict]:
+        """
+        Returns up to `match_count` docs with cosine similarity above `match_threshold`,
+        best first, in the same shape as the `match_all_vectors` RPC rows.
+        """
+        query = np.asarray(query_embedding, dtype=np.float32)
+        if query.shape != (self.dim,):
+            raise ValueError(f"Query embedding has dimension {query.shape}, index expects {self.dim}")
+        norm = np.linalg.norm(query)
+        if norm == 0 or match_count <= 0:
+            return []
+
+        query = query / norm
+        rows = self.ann.candidates(query, self.nprobe) if self.ann is not None else None
+        return self._top(query, self.scores(query, rows), rows, match_threshold, match_count)
+
+    def search_many(self, query_embeddings: Sequence[Sequence[float]], match_threshold: float = 0.7,
+                    match_count: int = 2) -> List[List[Dict]]:
+        """
+        search() for several queries at once. Without an IVF index the whole batch is scored with one
+        matrix-matrix product, so the search matrix is read once rather than once per query.
+        """
+        if self.ann is not None or len(query_embeddings) == 0:
+            return [self.search(q, match_threshold, match_count) for q in query_embeddings]
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        if queries.ndim != 2 or queries.shape[1] != self.dim:
+            raise ValueError(f"Query embeddings have shape {queries.shape}, index expects (n, {self.dim})")
+        norms = np.linalg.norm(queries, axis=1)
+        queries = queries / np.where(norms == 0, 1.0, norms)[:, None]
+        scores = self.batch_scores(queries)
+        return [self._top(query, row_scores, None, match_threshold, match_count) if norm and match_count > 0 else []
+                for query, row_scores, norm in zip(queries, scores, norms)]
+
+    def batch_scores(self, queries: np.ndarray) -> np.ndarray:
+        """Similarity of each unit-length query (rows of `queries`) to every row, as a queries x rows matrix."""
+        if self.codes.dtype == np.float32:
+            return queries @ self.codes.T
+        scores = np.empty((len(queries), len(self)), dtype=np.float32)
+        for start in range(0, len(self), SCAN_BLOCK_ROWS):
+            block = np.asarray(self.codes[start:start + SCAN_BLOCK_ROWS], dtype=np.float32)
+            scores[:, start:start + len(block)] = queries @ block.T
+        if self.scales is not None:
+            scores *= self.scales
+        return scores
+
+    def _top(self, query: np.ndarray, scores: np.ndarray, rows: Optional[np.ndarray],
+             match_threshold: float, match_count: int) -> List[Dict]:
+        """The best `match_count` results above the threshold, given the scores of all rows (or of `rows`)."""
+        k = min(max(match_count, self.rerank_candidates), len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top_scores = scores[top]
+        if rows is not None:
+            top = rows[top]
+        if self.rerank_candidates:
+            # Exact scores for the candidates only; with a memory-mapped store this reads k rows
+            top = np.sort(top)
+            top_scores = np.asarray(self.matrix[top], dtype=np.float32) @ query
+        order = np.argsort(-top_scores)[:match_count]
+        top, top_scores = top[order], top_scores[order]
+
+        results = []
+        for i, score in zip(top, top_scores):
+            similarity = float(score)
+            if similarity <= match_threshold:
+                break
+            results.append({**self.metadata[i], "similarity": similarity})
+        return results